@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the Obsidian -> Jekyll converter on a synthetic vault.
+
+Generates a vault with a configurable shape, points obsidian_to_jekyll at it and times
+the hot paths. Results are printed (or written with --output) as JSON, so that runs can
+be compared and regressions caught before they slow down every commit.
+
+Example:
+    python3 .scripts/bench_obsidian_to_jekyll.py --notes 500 --images 100 --output bench.json
+"""
+
+import io
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import time
+
+from pathlib import Path
+from functools import partial
+
+import obsidian_to_jekyll as otj
+
+WORDS = ("instruction register memory pipeline cache branch vault note markdown jekyll "
+         "compiler operand address stack heap kernel process thread signal").split()
+
+
+def generate_vault(root: Path, notes: int = 200, note_size: int = 4096, link_density: float = 0.02,
+                   images: int = 50, image_size: int = 64 * 1024, seed: int = 0) -> dict:
+    """
+    Builds a synthetic vault (and an empty Jekyll site next to it) under root.
+
+    Args:
+        notes: number of publish notes, split between posts and projects
+        note_size: approximate size of each note in bytes
+        link_density: fraction of words replaced by a reference - a wiki-link to another
+                      note, an Obsidian embed or a Markdown image (when there are images)
+        images: number of images in assets/images
+        image_size: size of each image in bytes
+
+    Returns:
+        Dictionary with the generated paths and totals
+    """
+    rng = random.Random(seed)
+    vault = root / "vault"
+    jekyll = vault / ".jekyll_repository"
+    image_dir = vault / "assets" / "images"
+    collections = [vault / "publish" / "posts", vault / "publish" / "projects"]
+    for directory in [image_dir, jekyll / "_posts", jekyll / "_projects", jekyll / "assets" / "img", *collections]:
+        directory.mkdir(parents=True, exist_ok=True)
+
+    image_names = [f"Pasted image {20240000000000 + i}.png" for i in range(images)]
+    for name in image_names:
+        (image_dir / name).write_bytes(rng.randbytes(image_size))
+
+    note_names = [f"Synthetic Note {i}" for i in range(notes)]
+    note_bytes = 0
+    for i, name in enumerate(note_names):
+        is_post = i % 2 == 0
+        lines = ["---", f"title: {name}"]
+        if is_post:
+            lines += ["layout: post", f"date: 2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}"]
+        lines += ["---", f"# {name}", ""]
+        size = sum(len(line) + 1 for line in lines)
+        words = []
+        while size < note_size:
+            if rng.random() < link_density:
+                kind = rng.randrange(3) if image_names else 0
+                if kind == 0:
+                    word = f"[[{rng.choice(note_names)}|{rng.choice(WORDS)}]]"
+                elif kind == 1:
+                    word = f"![[{rng.choice(image_names)}|{rng.choice((200, 400))}]]"
+                else:
+                    word = f"![{rng.choice(WORDS)}]({rng.choice(image_names)})"
+            else:
+                word = rng.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+            if len(words) == 12:
+                lines.append(" ".join(words))
+                words = []
+        lines.append(" ".join(words))
+        content = "\n".join(lines) + "\n"
+        (collections[0 if is_post else 1] / f"{name}.md").write_text(content, encoding='utf-8')
+        note_bytes += len(content.encode('utf-8'))
+
+    return {
+        "vault": vault,
+        "jekyll": jekyll,
+        "notes": notes,
+        "note_bytes": note_bytes,
+        "images": images,
+        "image_bytes": images * image_size,
+    }
+
+
+def configure_vault(vault: Path, jekyll: Path) -> otj.Config:
+    """Points the converter at the synthetic vault, returns the configuration it replaced."""
+    return otj.configure(otj.Config(obsidian_root=vault, jekyll_root=jekyll))
+
+
+def two_pass_transform(content: str, src_dir: Path, dest_dir: Path, context=None) -> str:
+    """The former transform_content(): one substitution per reference type, code not skipped. Baseline of the scanner."""
+    content = otj.MD_LINK_PATTERN.sub(
+        partial(otj.transform_md_match, src_dir=src_dir, dest_dir=dest_dir, context=context), content)
+    return otj.OBSIDIAN_LINK_PATTERN.sub(
+        partial(otj.transform_obsidian_match, src_dir=src_dir, dest_dir=dest_dir, context=context), content)
+
+
+def empty_directory(directory: Path):
+    """Removes everything in one of the benchmark's own directories, keeping the directory."""
+    for entry in directory.iterdir():
+        if entry.is_dir() and not entry.is_symlink():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
+
+
+def timed(function, repeat: int, setup=None) -> float:
+    """Best wall time of repeat runs, setup (untimed) runs before each of them."""
+    best = float("inf")
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def result(scenario: str, seconds: float, notes: int = 0, nbytes: int = 0) -> dict:
+    return {
+        "scenario": scenario,
+        "seconds": round(seconds, 6),
+        "notes_per_sec": round(notes / seconds, 2) if notes and seconds else None,
+        "mb_per_sec": round(nbytes / seconds / 1e6, 3) if nbytes and seconds else None,
+    }
+
+
+def run_benchmarks(vault_info: dict, repeat: int = 3, jobs: int = 1) -> list[dict]:
+    vault, jekyll = vault_info["vault"], vault_info["jekyll"]
+    configure_vault(vault, jekyll)
+    notes = sorted((vault / "publish").glob("*/*.md"))
+    texts = [note.read_text(encoding='utf-8') for note in notes]
+    images = sorted(otj.get_config().obsidian_image_dir.iterdir())
+    note_count, note_bytes = len(notes), vault_info["note_bytes"]
+    image_bytes = vault_info["image_bytes"]
+    results = []
+
+    def slugify_all():
+        for note in notes:
+            otj.slugify(note)
+    # Front matter read from the notes, not from read_md_metadata()'s cache of the previous repeat
+    results.append(result("slugify", timed(slugify_all, repeat, otj._front_matter_cache.clear), note_count, note_bytes))
+
+    def front_matter_all():
+        for text in texts:
+            otj.parse_front_matter(text)
+    results.append(result("front_matter", timed(front_matter_all, repeat), note_count, note_bytes))
+
+    def clear_images():
+        empty_directory(otj.get_config().jekyll_image_dir)
+
+    def sync_images():
+        image_sync = otj.ImageSync()
+        for image in images:
+            image_sync.sync(image, otj.get_config().jekyll_image_dir / image.name)
+    results.append(result("image_sync_cold", timed(sync_images, repeat, clear_images), 0, image_bytes))
+    results.append(result("image_sync_warm", timed(sync_images, repeat), 0, image_bytes))
+
+    def transform_all(transform=otj.transform_content):
+        context = otj.ConversionContext(otj.ImageSync())
+        for text in texts:
+            transform(text, otj.get_config().obsidian_image_dir, otj.get_config().jekyll_image_dir, context)
+    results.append(result("transform_references", timed(transform_all, repeat), note_count, note_bytes))
+    results.append(result("transform_references_two_pass", timed(lambda: transform_all(two_pass_transform), repeat),
+                          note_count, note_bytes))
+
+    def scan_all():
+        for text in texts:
+            otj.extract_references(text)
+    results.append(result("scan_references", timed(scan_all, repeat), note_count, note_bytes))
+
+    def clear_site():
+        for directory in (jekyll / "_posts", jekyll / "_projects", otj.get_config().jekyll_image_dir):
+            empty_directory(directory)
+        shutil.rmtree(otj.get_config().cache_dir, ignore_errors=True)
+
+    def run(incremental: bool):
+        with contextlib.redirect_stdout(io.StringIO()):
+            otj.publish(incremental=incremental, jobs=jobs)
+
+    total_bytes = note_bytes + image_bytes
+    results.append(result("publish_cold", timed(lambda: run(False), repeat, clear_site), note_count, total_bytes))
+    results.append(result("publish_warm_full", timed(lambda: run(False), repeat), note_count, total_bytes))
+    results.append(result("publish_warm_incremental", timed(lambda: run(True), repeat), note_count, total_bytes))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the Obsidian -> Jekyll converter on a synthetic vault.")
+    parser.add_argument("--notes", type=int, default=200, help="Number of notes (default: 200).")
+    parser.add_argument("--note-size", type=int, default=4096, help="Approximate note size in bytes (default: 4096).")
+    parser.add_argument("--link-density", type=float, default=0.02,
+                        help="Fraction of words that are links or embeds (default: 0.02).")
+    parser.add_argument("--images", type=int, default=50, help="Number of images (default: 50).")
+    parser.add_argument("--image-size", type=int, default=64 * 1024, help="Image size in bytes (default: 65536).")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario, the best one is reported (default: 3).")
+    parser.add_argument("--jobs", type=otj.parse_jobs, default=1, help="--jobs passed to the publish scenarios.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Write the JSON report here instead of stdout.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        vault_info = generate_vault(Path(tmp), args.notes, args.note_size, args.link_density,
+                                    args.images, args.image_size, args.seed)
+        results = run_benchmarks(vault_info, args.repeat, args.jobs)
+
+    report = {
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n", encoding='utf-8')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,204 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import json
+import hashlib
+import sqlite3
+import time
+import struct
+import threading
+import contextlib
+import select
+import argparse
+import ctypes
+import ctypes.util
+import uuid
+import errno
+import fnmatch
+import shutil
+import subprocess
 import unicodedata
+import urllib.parse
 import re
+import asyncio
+import codecs
+import itertools
 
-from typing import Union, TypeVar, Type, Optional
+from typing import Iterable, NewType, Union, Optional
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+# gitignore-style rules for the publish directory, see PublishIgnore
+PUBLISH_IGNORE_FILE = ".publishignore"
+
+# Patterns for different reference types
+OBSIDIAN_LINK_PATTERN = re.compile(r'(!?)\[\[([^\]\[]+)\]\]')  # ![[ ]] or [[ ]]
+MD_LINK_PATTERN = re.compile(r'(!?)\[([^\]]+)\]\(([^)]+)\)')    # ![]() or []()
+# Single pass over a note: code is matched as a whole so that references inside it are left alone.
+# Plain text is consumed in runs up to the next character that can start a token, so the
+# alternatives are only tried there, and every line starts at a token boundary (for fences).
+# Inside a code span backtick runs are taken whole ((?=(?P<run>`+))(?P=run) does not backtrack),
+# so a span that never closes is given up in linear time.
+REFERENCE_SCANNER = re.compile(r"""
+    (?P<fence>^[ \t]*(?P<fence_mark>`{3,}|~{3,}).*?(?:\n[ \t]*(?P=fence_mark)[`~]*[ \t]*(?=\n|\Z)|\Z))  # ``` block ```
+  | (?P<code>(?P<ticks>`+)(?:                                  # `code`, within a paragraph:
+        (?:[^`\n]|\n(?![ \t]*\n)|(?=(?P<run>`+))(?P=run))*?(?P=ticks)(?!`)          # closed by a run as long as the opening,
+      | (?:[^`\n]|\n(?![ \t]*\n)|(?=(?P<tail>`+))(?P=tail))*`+(?P=ticks)(?!`)))     # else by the tail of the last longer run
+  | (?P<ticks_text>`+)                    # backticks that open no code span
+  | (?P<wiki>!?\[\[[^\]\[]+\]\])            # ![[ ]] or [[ ]]
+  | (?P<md>!?\[[^\]\[\n]+\]\([^)\]\[\n]+\))    # ![]() or []() on one line, keeps the scan linear
+  | (?P<text>[^`!\[\n]+\n?|.)             # anything else
+""", re.MULTILINE | re.DOTALL | re.VERBOSE)
+# End of a paragraph, inline code spans cannot cross it; see scan_reference_stream()
+BLANK_LINE = re.compile(r'\n[ \t]*\n')
+# A [[ whose link may still close further on
+OPEN_WIKI_LINK = re.compile(r'!?\[\[[^\]\[]*\]?\Z')
+
+# Notes larger than this (bytes) are read, transformed and written in chunks of STREAM_CHUNK_SIZE
+# (characters), so converting them takes about the same memory as converting a small note
+STREAM_THRESHOLD = 4 << 20
+STREAM_CHUNK_SIZE = 1 << 18
+
+def pillow():
+    """PIL.Image, imported on first use (optional and slow to import); None when Pillow is not installed."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+def pyyaml():
+    """The yaml module, imported on first use (optional, only complex front matter needs it); None when PyYAML is not installed."""
+    try:
+        import yaml
+    except ImportError:
+        return None
+    return yaml
+
+class ConfigError(RuntimeError):
+    """The configured directories do not exist or do not fit together."""
+
+class Config:
+    """
+    Where the converter reads the vault from and writes the Jekyll site to.
+
+    Nothing is checked when a Config is created, validate() runs when a publish starts, so the
+    module can be imported (and its functions used) without a checked out site.
+    Directories that are not given are derived from the two roots:
+        obsidian_root       the vault this script lives in
+        jekyll_root         obsidian_root/.jekyll_repository
+        publish_dir         obsidian_root/publish
+        obsidian_image_dir  obsidian_root/assets/images
+        jekyll_image_dir    jekyll_root/assets/img
+        cache_dir           obsidian_root/.publish_cache - local, untracked state (build manifest, ...)
+    """
+    FIELDS = ("obsidian_root", "jekyll_root", "publish_dir", "obsidian_image_dir", "jekyll_image_dir", "cache_dir")
+    ENV_PREFIX = "OBSIDIAN_TO_JEKYLL_"
+
+    def __init__(self, obsidian_root: Optional[Path] = None, jekyll_root: Optional[Path] = None,
+                 publish_dir: Optional[Path] = None, obsidian_image_dir: Optional[Path] = None,
+                 jekyll_image_dir: Optional[Path] = None, cache_dir: Optional[Path] = None):
+        def resolved(path: Optional[Path], default: Path) -> Path:
+            return (Path(path).expanduser() if path is not None else default).resolve()
+        self.obsidian_root = resolved(obsidian_root, Path(__file__).parent.parent)
+        self.jekyll_root = resolved(jekyll_root, self.obsidian_root / ".jekyll_repository")
+        self.publish_dir = resolved(publish_dir, self.obsidian_root / "publish")
+        self.obsidian_image_dir = resolved(obsidian_image_dir, self.obsidian_root / "assets" / "images")
+        self.jekyll_image_dir = resolved(jekyll_image_dir, self.jekyll_root / "assets" / "img")
+        self.cache_dir = resolved(cache_dir, self.obsidian_root / ".publish_cache")
+
+    @classmethod
+    def from_sources(cls, config_file: Optional[Path] = None, environ=None, **overrides) -> "Config":
+        """
+        Config from, later ones win: a JSON file with FIELDS as keys, OBSIDIAN_TO_JEKYLL_<FIELD>
+        environment variables and overrides (command line flags, None = not given).
+        Relative paths in the file are relative to the file. Without config_file, the
+        OBSIDIAN_TO_JEKYLL_CONFIG environment variable names it.
+        """
+        environ = os.environ if environ is None else environ
+        values = {}
+        config_file = config_file or environ.get(f"{cls.ENV_PREFIX}CONFIG")
+        if config_file:
+            config_file = Path(config_file)
+            try:
+                data = json.loads(config_file.read_text(encoding='utf-8'))
+            except (OSError, ValueError) as error:
+                raise ConfigError(f"Cannot read config file {config_file}: {error}")
+            if not isinstance(data, dict):
+                raise ConfigError(f"Config file {config_file} must contain a JSON object")
+            unknown = set(data) - set(cls.FIELDS)
+            if unknown:
+                raise ConfigError(f"Unknown keys in {config_file}: {', '.join(sorted(unknown))}")
+            values.update({key: config_file.parent / Path(value).expanduser() for key, value in data.items()})
+        for field in cls.FIELDS:
+            if environ.get(cls.ENV_PREFIX + field.upper()):
+                values[field] = Path(environ[cls.ENV_PREFIX + field.upper()])
+        values.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**values)
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.cache_dir / "manifest.json"
+
+    @property
+    def vault_index_path(self) -> Path:
+        return self.cache_dir / "vault_index.sqlite"
 
-# Get the directory where this script is located
-SCRIPT_DIR = Path(__file__).parent.resolve()
+    @property
+    def history_path(self) -> Path:
+        return self.cache_dir / "history.jsonl"
 
-JEKYLL_ROOT = (SCRIPT_DIR / "../.jekyll_repository/").resolve()
-OBSIDIAN_ROOT = (SCRIPT_DIR / "..").resolve()
+    @property
+    def search_index_path(self) -> Path:
+        return self.cache_dir / "search_index.json"
 
-PUBLISH_DIR = OBSIDIAN_ROOT / "publish"
-OBSIDIAN_IMAGE_DIR = OBSIDIAN_ROOT / "assets" / "images"
-JEKYLL_IMAGE_DIR = JEKYLL_ROOT / "assets" / "img"
+    @property
+    def jekyll_search_dir(self) -> Path:
+        """The client-side search index, see SearchIndex"""
+        return self.jekyll_root / "assets" / "search"
 
-#Check if directories exist:
-assert JEKYLL_ROOT.is_dir()
-assert OBSIDIAN_ROOT.is_dir()
-assert PUBLISH_DIR.is_dir()
-assert OBSIDIAN_IMAGE_DIR.is_dir()
-assert JEKYLL_IMAGE_DIR.is_dir()
-assert JEKYLL_IMAGE_DIR.is_relative_to(JEKYLL_ROOT)
-assert OBSIDIAN_IMAGE_DIR.is_relative_to(OBSIDIAN_ROOT)
+    @property
+    def jekyll_staging_dir(self) -> Path:
+        """Collections are built here first and then applied to the live site; hidden, so Jekyll ignores it"""
+        return self.jekyll_root / ".publish_staging"
+
+    def validate(self, site: bool = True) -> "Config":
+        """
+        Raises ConfigError unless every directory exists where the converter expects it.
+        With site=False only the vault is checked (--check does not need the Jekyll site).
+        """
+        fields = [field for field in self.FIELDS if field != "cache_dir" and (site or not field.startswith("jekyll"))]
+        problems = [f"{field} {getattr(self, field)} is not a directory" for field in fields if not getattr(self, field).is_dir()]
+        nested = [("jekyll_image_dir", "jekyll_root")] if site else []
+        for inner, outer in nested + [("obsidian_image_dir", "obsidian_root"), ("publish_dir", "obsidian_root")]:
+            if not getattr(self, inner).is_relative_to(getattr(self, outer)):
+                problems.append(f"{inner} {getattr(self, inner)} is not inside {outer} {getattr(self, outer)}")
+        if problems:
+            raise ConfigError("Invalid configuration:\n  " + "\n  ".join(problems))
+        return self
+
+    def __repr__(self) -> str:
+        return f"Config({', '.join(f'{field}={str(getattr(self, field))!r}' for field in self.FIELDS)})"
+
+# Configuration of the current run, see get_config()
+_config: Optional[Config] = None
+
+def get_config() -> Config:
+    """The active Config, Config.from_sources() without overrides unless configure() set another."""
+    global _config
+    if _config is None:
+        _config = Config.from_sources()
+    return _config
+
+def configure(config: Optional[Config]) -> Optional[Config]:
+    """Makes config the active Config (None - back to the default), returns the previous one."""
+    global _config
+    previous, _config = _config, config
+    return previous
 
 
-T = TypeVar('T', bound='BaseValidatedPath')
 
 class PublishTransformError(Exception):
     """Exception raised when a file cannot be transformed for publishing."""
@@ -45,120 +215,563 @@ class PublishTransformError(Exception):
         message = f"Failed to transform '{filepath}': {reason}"
         super().__init__(message)
 
-class BaseValidatedPath:
-    """Base class for validated path wrappers."""
-    _root: Path  # Must be set in child classes or via configure_root()
+    def __reduce__(self):
+        # Keeps the exception picklable, so it survives the trip back from a worker process
+        return (self.__class__, (self.filepath, self.reason))
 
-    def __init__(self, path: Union[str, Path]):
-        self._path = Path(path).expanduser().absolute()
-        self._validate()
+# Paths within the Obsidian vault and within the Jekyll site. In annotations they say which root
+# a path belongs to; obsidian_path() and jekyll_path() check it. The roots themselves are checked
+# once per run by Config.validate(); paths the converter derives from them (walking the publish
+# directory, joining a slug to a collection) are not checked again.
+ObsidianPath = NewType("ObsidianPath", Path)
+JekyllPath = NewType("JekyllPath", Path)
 
-    def _validate(self):
-        """Ensure path is within the configured root."""
-        try:
-            if not self._path.is_relative_to(self.__class__._root):
-                raise ValueError(f"Path {self._path} is outside {self.__class__.__name__} root")
-        except (FileNotFoundError, RuntimeError) as e:
-            raise ValueError(f"Invalid path: {e}")
-    
-    # Overrding root - for testing purposes
-    @classmethod
-    def configure_root(cls: Type[T], root: Union[str, Path]) -> None:
-        """Configure the root directory for validation."""
-        cls._root = Path(root).resolve()
+def path_within(path: Union[str, Path], root: Path, name: str) -> Path:
+    """path made absolute, ValueError if it is not within root (name says which root)."""
+    try:
+        path = Path(path).expanduser().absolute()
+    except (FileNotFoundError, RuntimeError) as e:
+        raise ValueError(f"Invalid path: {e}")
+    if not path.is_relative_to(root):
+        raise ValueError(f"Path {path} is outside the {name}")
+    return path
+
+def obsidian_path(path: Union[str, Path]) -> ObsidianPath:
+    """path checked to be within the Obsidian vault of the active Config."""
+    return ObsidianPath(path_within(path, get_config().obsidian_root, "Obsidian vault"))
+
+def jekyll_path(path: Union[str, Path]) -> JekyllPath:
+    """path checked to be within the Jekyll site of the active Config."""
+    return JekyllPath(path_within(path, get_config().jekyll_root, "Jekyll site"))
+
+class ConversionContext:
+    """
+    Collects what a single note conversion touched.
 
-    @property
-    def path(self) -> Path:
-        """Access the raw Path object when needed."""
-        return self._path
+    Passed down through the reference transformers so that the caller learns which
+    inputs (besides the note itself) the produced file depends on.
+    """
+    def __init__(self, image_sync: Optional["ImageSync"] = None, record: Optional["NoteRecord"] = None,
+                 link_resolver: Optional["LinkResolver"] = None, attachments: Optional["AttachmentIndex"] = None):
+        # Absolute paths of the Obsidian images the note references
+        self.images: set[Path] = set()
+        # Absolute paths of the Jekyll images the produced file links to
+        self.published_images: set[Path] = set()
+        # Shared by all notes of a run so that an image is synced at most once
+        self.image_sync = image_sync
+        # Vault index entry of the note, used instead of re-parsing it while it is current
+        self.record = record
+        # Resolves wiki-links to published notes, shared by all notes of a run
+        self.link_resolver = link_resolver
+        # Vault attachments, resolves embeds the way Obsidian does; shared by all notes of a run
+        self.attachments = attachments
+        # Wiki-link targets of the note and what they resolved to (None - not published)
+        self.links: dict[str, Optional[str]] = {}
+        # Links and embeds of the note as extract_references() lists them, found while transforming it
+        self.refs: list[tuple[str, str]] = []
+        # How many of the referenced images were copied / found already up to date, bytes copied
+        self.images_copied = 0
+        self.images_skipped = 0
+        self.images_bytes = 0
+        # Background copies (CopyJob, whether this note submitted it) the note waits for, see settle_images()
+        self.image_jobs: list[tuple["CopyJob", bool]] = []
+        # [size, mtime_ns] and SHA-256 of the note as it was read for the conversion
+        self.source_stat: Optional[list[int]] = None
+        self.source_digest: Optional[str] = None
+
+class _Span:
+    """A running timed span of Profiler, recorded as a Chrome trace "complete" event on exit."""
+    __slots__ = ("profiler", "name", "category", "args", "start")
+
+    def __init__(self, profiler: "Profiler", name: str, category: str, args: dict):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        self.profiler.events.append({
+            "name": self.name,
+            "cat": self.category,
+            "ph": "X",
+            "ts": self.start / 1000,
+            "dur": (end - self.start) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": self.args,
+        })
+
+class Profiler:
+    """
+    Collects timed spans of the conversion stages.
+
+    Events use the Chrome trace event format (chrome://tracing, https://ui.perfetto.dev).
+    Timestamps come from the system wide monotonic clock, so events of worker processes
+    line up with the ones of the main process.
+    """
+    def __init__(self):
+        self.events: list[dict] = []
+
+    def span(self, name: str, category: str = "stage", args: Optional[dict] = None) -> _Span:
+        return _Span(self, name, category, args or {})
+
+    def drain(self) -> list[dict]:
+        """Returns and forgets the collected events (used to ship them from a worker process)."""
+        events, self.events = self.events, []
+        return events
+
+    def summary(self) -> dict:
+        """Count, total and maximum duration (ms) per span name."""
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event["name"], {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            duration = event["dur"] / 1000
+            stage["count"] += 1
+            stage["total_ms"] += duration
+            stage["max_ms"] = max(stage["max_ms"], duration)
+        for stage in stages.values():
+            stage["total_ms"] = round(stage["total_ms"], 3)
+            stage["max_ms"] = round(stage["max_ms"], 3)
+        return stages
+
+    def write(self, directory: Path) -> tuple[Path, Path]:
+        """Writes summary.json and trace.json (Chrome trace) into directory."""
+        directory.mkdir(parents=True, exist_ok=True)
+        summary_path = directory / "summary.json"
+        trace_path = directory / "trace.json"
+        summary_path.write_text(json.dumps(self.summary(), indent=2), encoding='utf-8')
+        trace = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+        trace_path.write_text(json.dumps(trace, default=str), encoding='utf-8')
+        return summary_path, trace_path
+
+class _StageTimer:
+    """A running top level stage of RunStats, wrapping the profiler's span of the same block."""
+    __slots__ = ("stats", "name", "inner", "start")
+
+    def __init__(self, stats: "RunStats", name: str, inner):
+        self.stats = stats
+        self.name = name
+        self.inner = inner
+
+    def __enter__(self):
+        self.stats.depth += 1
+        self.inner.__enter__()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter_ns() - self.start
+        self.stats.depth -= 1
+        self.stats.stages[self.name] = self.stats.stages.get(self.name, 0) + elapsed
+        return self.inner.__exit__(*exc_info)
+
+class RunStats:
+    """
+    Duration (ns) of the top level stages of a publish run, for the run history.
 
-    # Delegate all other attributes to the wrapped Path
-    def __getattr__(self, name):
-        return getattr(self._path, name)
+    Only "stage" spans of the main process that are not inside another one are timed, so
+    the stages add up to (almost) the whole run. Unlike Profiler it is always on - a couple
+    of clock reads per stage.
+    """
+    __slots__ = ("stages", "depth")
 
-class ObsidianPath(BaseValidatedPath):
-    """Path guaranteed to be within the Obsidian vault."""
-    _root = OBSIDIAN_ROOT
+    def __init__(self):
+        self.stages: dict[str, int] = {}
+        self.depth = 0
 
-class JekyllPath(BaseValidatedPath):
-    """Path guaranteed to be within the Jekyll site."""
-    _root = JEKYLL_ROOT
+    def stages_ms(self) -> dict[str, float]:
+        return {name: round(elapsed / 1e6, 3) for name, elapsed in self.stages.items()}
+
+# Active profiler of this process, None unless --profile is given
+_profiler: Optional[Profiler] = None
+# Stage timings of the publish run in progress in this process
+_run_stats: Optional[RunStats] = None
+_NO_SPAN = contextlib.nullcontext()
+
+def span(name: str, category: str = "stage", **args):
+    """Times a block when profiling is on or it is a stage of a publish run; a shared no-op context manager otherwise."""
+    inner = _NO_SPAN if _profiler is None else _profiler.span(name, category, args)
+    if _run_stats is None or category != "stage" or _run_stats.depth:
+        return inner
+    return _StageTimer(_run_stats, name, inner)
+
+def set_profiler(profiler: Optional[Profiler]):
+    global _profiler
+    _profiler = profiler
+
+def set_run_stats(stats: Optional[RunStats]):
+    global _run_stats
+    _run_stats = stats
 
 # Example: "$PUBLISH_DIR/Posts" -> "$JEKYLL_DIR/_posts"
-def get_jekyll_directory(publish_subdir: ObsidianPath, jekyll_root: JekyllPath = JEKYLL_ROOT, publish_dir: ObsidianPath = PUBLISH_DIR) -> JekyllPath:
+def get_jekyll_directory(publish_subdir: ObsidianPath, jekyll_root: Optional[JekyllPath] = None, publish_dir: Optional[ObsidianPath] = None,
+                         must_exist: bool = True) -> JekyllPath:
+    jekyll_root = jekyll_root or get_config().jekyll_root
+    publish_dir = publish_dir or get_config().publish_dir
     if publish_subdir.parent != publish_dir:
         raise RuntimeError(f"Provided directory \"{publish_subdir}\" is not part of publish directory")
     # All capital to lower-case + add "_" to the start
     jekyll_root = Path(jekyll_root / str("_" + publish_subdir.name.lower()))
     #3. Check if it exists in Jekyll dir structure
-    if not jekyll_root.is_dir():
+    if must_exist and not jekyll_root.is_dir():
         raise RuntimeError(f"Directory {jekyll_root} does not exist in Jekyll directory.")
     return jekyll_root
 
-def get_publish_subdirectories(publish_dir: ObsidianPath = PUBLISH_DIR):
+def get_publish_subdirectories(publish_dir: Optional[ObsidianPath] = None, ignore: Optional["PublishIgnore"] = None):
+    publish_dir = publish_dir or get_config().publish_dir
     subdirectories = []
     for file in publish_dir.iterdir():
+        # Hidden entries (.publishignore, .DS_Store, ...) and ignored ones are not collections
+        if file.name.startswith('.') or (ignore is not None and ignore.ignored(file, file.is_dir())):
+            continue
         if not file.is_dir():
             raise RuntimeError(f"File {file.name} located in the publish directory")
         subdirectories.append(file)
-    return subdirectories
+    return sorted(subdirectories)
 
-# DANGEROUS method, use with care!
-# Usable only in this directory
-def remove_contents_of(directory: JekyllPath):
-    if not directory.is_relative_to(JEKYLL_ROOT):
-        raise RuntimeError("Trying to remove contents outside of this project! Aborted.")
+class PublishIgnore:
+    """
+    Rules of the .publishignore file of the publish directory.
+
+    One gitignore-style pattern per line, blank lines and lines starting with "#" are skipped:
+        drafts/           - directories (with everything in them) of that name, at any depth
+        *.excalidraw.md   - file or directory names, at any depth
+        posts/old-*.md    - patterns containing a "/" match the path relative to the publish directory
+        !posts/old-keep.md - re-includes what an earlier pattern ignored
+    The last matching pattern decides. Contents of an ignored directory cannot be re-included.
+    """
+    def __init__(self, base: Path, lines=()):
+        self.base = Path(base)
+        # (pattern, negated, directories only, matched against the relative path instead of the name)
+        self.rules: list[tuple[str, bool, bool, bool]] = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            line = line.lstrip('!')
+            directory_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            self.rules.append((line.lstrip('/'), negated, directory_only, anchored))
 
-    for root, dirs, files in os.walk(directory, topdown=False):
-        for name in files:
-            (Path(root) / name).unlink()
-        for name in dirs:
-            (Path(root) / name).rmdir()
+    @classmethod
+    def load(cls, base: Path) -> "PublishIgnore":
+        """Rules of base/.publishignore, none when there is no such file."""
+        try:
+            lines = (Path(base) / PUBLISH_IGNORE_FILE).read_text(encoding='utf-8').splitlines()
+        except FileNotFoundError:
+            lines = []
+        return cls(base, lines)
+
+    def ignored(self, path: Path, is_dir: bool = False) -> bool:
+        relative = Path(path).relative_to(self.base).as_posix()
+        ignored = False
+        for pattern, negated, directory_only, anchored in self.rules:
+            if directory_only and not is_dir:
+                continue
+            if fnmatch.fnmatchcase(relative if anchored else Path(path).name, pattern):
+                ignored = not negated
+        return ignored
+
+class OutputTarget:
+    """Where a note is published: its slug in a Jekyll collection directory."""
+    __slots__ = ("collection", "slug")
+
+    def __init__(self, collection: Path, slug: str):
+        self.collection = collection
+        self.slug = slug
+
+    @property
+    def path(self) -> Path:
+        return self.collection / self.slug
+
+    @property
+    def jekyll_file(self) -> str:
+        """Path relative to the Jekyll root, as Liquid link tags and the build manifest use it."""
+        return self.path.relative_to(get_config().jekyll_root).as_posix()
+
+class Note:
+    """
+    A publish note and what the incremental and the parallel paths know about it.
+
+    Created by walk_publish_tree() with the [size, mtime_ns] of the walk (see stat_signature()),
+    the Jekyll collection it is published into and, once the vault index is refreshed, its
+    NoteRecord. The record travels with the note to a worker process, so nothing is looked up
+    twice. Slotted, so holding every note of the vault stays cheap.
+    """
+    __slots__ = ("path", "signature", "collection", "record")
+
+    def __init__(self, path: Path, signature: Optional[list[int]] = None, collection: Optional[Path] = None,
+                 record: Optional["NoteRecord"] = None):
+        self.path = path
+        self.signature = signature
+        self.collection = collection
+        self.record = record
+
+    @property
+    def target(self) -> Optional[OutputTarget]:
+        """Where the note is published, None until its record is known or if slugify() rejected it."""
+        if self.collection is None or self.record is None or self.record.slug is None:
+            return None
+        return OutputTarget(self.collection, self.record.slug)
+
+    def __repr__(self) -> str:
+        return f"Note({str(self.path)!r})"
+
+def reject_output_clashes(notes: list[Note]) -> list[Note]:
+    """
+    Notes that publish to the same file as an earlier note of the list (notes in different
+    subfolders of a collection can end up with the same slug). Their records are replaced by
+    ones whose slug_error names the clash, so they fail to convert - and are neither linked
+    to nor recorded - instead of overwriting the earlier note's output.
+    """
+    owners: dict[Path, Note] = {}
+    clashing = []
+    for note in notes:
+        target = note.target
+        if target is None:
+            continue
+        owner = owners.setdefault(target.path, note)
+        if owner is not note:
+            record = note.record
+            note.record = NoteRecord(record.path, record.size, record.mtime_ns, record.front_matter, None,
+                                     f"Publishes to {target.jekyll_file} like {vault_key(owner.path)}.", record.refs)
+            clashing.append(note)
+    return clashing
+
+def walk_publish_tree(directory: Path, ignore: Optional[PublishIgnore] = None, collection: Optional[Path] = None):
+    """
+    Yields a Note for every note (*.md) under directory, at any depth, published into collection.
+
+    One os.scandir() per directory; entries come in name order, a directory's notes before
+    those of its subdirectories. Hidden files and directories, symlinked directories and
+    whatever the ignore rules match are skipped. Symlinked notes are included.
+    """
+    with os.scandir(directory) as iterator:
+        entries = sorted(iterator, key=lambda entry: (entry.is_dir(follow_symlinks=False), entry.name))
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if ignore is not None and ignore.ignored(Path(entry.path), is_dir):
+            continue
+        if is_dir:
+            yield from walk_publish_tree(Path(entry.path), ignore, collection)
+        elif entry.name.endswith('.md') and entry.is_file():
+            st = entry.stat()
+            yield Note(Path(entry.path), [st.st_size, st.st_mtime_ns], collection)
+
+def changed_publish_tree(directory: Path, ignore: Optional[PublishIgnore], collection: Optional[Path],
+                         known: dict[str, list[int]], changed: set[Path]) -> list[Note]:
+    """
+    The notes walk_publish_tree() would yield for a restricted run, without walking directory:
+    the notes known (vault_key() to [size, mtime_ns], e.g. VaultIndex.signatures()) that did not
+    change, trusted to be as recorded, and the changed paths that are notes under directory.
+    Changed paths that are gone, hidden, ignored or below a symlinked directory are left out.
+    """
+    notes = []
+    root = get_config().obsidian_root
+    for key, signature in known.items():
+        path = root / key
+        if path.is_relative_to(directory) and path not in changed:
+            notes.append(Note(path, signature, collection))
+    for path in changed:
+        if not path.is_relative_to(directory) or not path.name.endswith('.md'):
+            continue
+        parents = list(reversed(path.relative_to(directory).parents))[1:]
+        if any(part.startswith('.') for part in path.relative_to(directory).parts) \
+                or any((directory / parent).is_symlink() for parent in parents) \
+                or (ignore is not None and (any(ignore.ignored(directory / parent, True) for parent in parents)
+                                            or ignore.ignored(path))):
+            continue
+        if path.is_file():
+            st = path.stat()
+            notes.append(Note(path, [st.st_size, st.st_mtime_ns], collection))
+    # walk_publish_tree() order: by name, a directory's notes before those of its subdirectories
+    return sorted(notes, key=lambda note: [(1, part) for part in note.path.relative_to(directory).parts[:-1]]
+                                          + [(0, note.path.name)])
 
 """
 Retrieves the publish files that will be converted to jekyll-friendly files and published to the web
-- currently it does assume that Publish subdirectories will not contain any nested subdirectories, if such a feature is wanted, it needs to be implemented here first and foremost
+- notes in nested subdirectories are included, see walk_publish_tree()
 """
-def get_directory_md_files(directory: Path) -> list[Path]:
-    return list(directory.glob("*.md"))
+def get_directory_md_files(directory: Path, ignore: Optional[PublishIgnore] = None) -> list[Path]:
+    return [entry.path for entry in walk_publish_tree(directory, ignore)]
+
+
 
+# Closing "---" of the front matter, searched for so that the note body is never split into lines
+FRONT_MATTER_END = re.compile(r'^---[ \t]*$', re.MULTILINE)
+# "key: value" line of the flat front matter that parse_simple_front_matter() reads
+SIMPLE_FRONT_MATTER_LINE = re.compile(r'([^\s#?:\-\[\]{}"\'|>&*!%@`][^:]*?)[ \t]*:(?:[ \t]+(.*?))?[ \t]*')
+# Item of a block list ("  - item") under a key without a value
+SIMPLE_FRONT_MATTER_ITEM = re.compile(r'[ \t]*-(?:[ \t]+(.*?))?[ \t]*')
 
+def parse_front_matter(lines) -> dict:
+    """Extract metadata from the front matter of a note's text or an iterable of its lines.
+
+    The front matter starts with "---" on the first line. Only the lines up to the closing
+    "---" are consumed; a note's text is searched for the delimiter, its body is never split.
+
+    Returns:
+        Dictionary containung the metadata, see parse_front_matter_block().
+        Returns empty dict if no (closed) front matter is found - Jekyll reads such a note as all content.
+    """
+    if isinstance(lines, str):
+        text = lines.lstrip('\ufeff')
+        first_end = text.find('\n')
+        if first_end == -1 or text[:first_end].rstrip() != "---":
+            return {}
+        end = FRONT_MATTER_END.search(text, first_end + 1)
+        if end is None:
+            return {}
+        return parse_front_matter_block(text[first_end + 1:end.start()].splitlines())
+
+    lines = iter(lines)
+    if next(lines, "").lstrip('\ufeff').rstrip() != "---":
+        return {}
+    block = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.rstrip() == "---":
+            return parse_front_matter_block(block)
+        block.append(line)
+    return {}
+
+# Whether parse_front_matter_block() already told that PyYAML is missing
+_missing_pyyaml_reported = False
+
+def parse_front_matter_block(lines: list[str]) -> dict:
+    """
+    Parses the lines between the front matter delimiters.
+
+    Notes almost always have flat front matter - "key: value" lines, quoted values and lists -
+    which a hand-written fast path reads. Anything else (block scalars, nested mappings,
+    comments, anchors, ...) goes to PyYAML. Scalars are not resolved, dates, numbers and booleans
+    stay strings, so both paths give the same result. Front matter that is not valid YAML, or
+    that needs PyYAML when it is not installed, is read line by line as "key: value" pairs.
+    """
+    metadata = parse_simple_front_matter(lines)
+    if metadata is not None:
+        return metadata
+    yaml = pyyaml()
+    if yaml is None:
+        global _missing_pyyaml_reported
+        if not _missing_pyyaml_reported:
+            print("Warning: front matter beyond flat 'key: value' lines needs PyYAML (pip install PyYAML), "
+                  "reading it line by line")
+            _missing_pyyaml_reported = True
+        return parse_flat_front_matter(lines)
+    try:
+        metadata = yaml.load('\n'.join(lines), Loader=getattr(yaml, 'CBaseLoader', yaml.BaseLoader))
+    except yaml.YAMLError:
+        return parse_flat_front_matter(lines)
+    if metadata is None or metadata == "":
+        return {}  # Only comments
+    return metadata if isinstance(metadata, dict) else parse_flat_front_matter(lines)
+
+def parse_simple_front_matter(lines: list[str]) -> Optional[dict]:
+    """Fast path of parse_front_matter_block(), None when the lines need a YAML parser."""
+    metadata = {}
+    list_key = None  # Key without a value, block list items that follow belong to it
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        if line[0] in ' \t-':
+            item = SIMPLE_FRONT_MATTER_ITEM.fullmatch(line)
+            if list_key is None or item is None:
+                return None  # Continuation line, nested mapping, ...
+            value = simple_front_matter_scalar(item.group(1) or "")
+            if value is None:
+                return None
+            if not isinstance(metadata[list_key], list):
+                metadata[list_key] = []
+            metadata[list_key].append(value)
+            continue
+        match = SIMPLE_FRONT_MATTER_LINE.fullmatch(line)
+        if match is None:
+            if ':' in line:
+                return None
+            # Not YAML, the full parser would fail and fall back to skipping the line
+            list_key = None
+            continue
+        key, raw = match.group(1), match.group(2) or ""
+        value = simple_front_matter_list(raw) if raw.startswith('[') else simple_front_matter_scalar(raw)
+        if value is None:
+            return None
+        metadata[key] = value
+        list_key = key if not raw else None
+    return metadata
+
+def simple_front_matter_scalar(raw: str) -> Optional[str]:
+    """Plain or simply quoted YAML scalar, None for anything that needs a YAML parser."""
+    if raw[:1] in ('"', "'"):
+        quote = raw[0]
+        inner = raw[1:-1]
+        if len(raw) < 2 or raw[-1] != quote or quote in inner or '\\' in inner:
+            return None  # Escapes, doubled quotes, trailing comments
+        return inner
+    if raw[:1] in tuple('[]{}|>&*!%@`#') or ' #' in raw or '\t#' in raw:
+        return None
+    return raw
+
+def simple_front_matter_list(raw: str) -> Optional[list[str]]:
+    """Flow list of plain scalars ("[a, b]"), None for anything that needs a YAML parser."""
+    inner = raw[1:-1] if raw.endswith(']') else None
+    if inner is None or any(char in inner for char in '[]{}"\'#'):
+        return None
+    items = [item.strip() for item in inner.split(',')]
+    if items[-1] == "":
+        items.pop()  # "[a, b, ]"
+    if "" in items:
+        return None
+    return items
+
+def parse_flat_front_matter(lines: list[str]) -> dict:
+    """Front matter read line by line as "key: value" pairs, lines without a colon are skipped."""
+    metadata = {}
+    for line in lines:
+        line = line.strip()
+        if not line or ':' not in line:
+            continue
+        key, value = line.split(':', 1)
+        metadata[key.strip()] = value.strip()
+    return metadata
+
+# Front matter of the notes read_md_metadata() parsed: path -> ([size, mtime_ns], metadata)
+_front_matter_cache: dict[Path, tuple[list[int], dict]] = {}
 
 def read_md_metadata(markdown_path: Path):
     """Extract metadata from markdown file's front matter.
 
+    The file is read only up to the closing "---", and the result is cached until the file's
+    size or mtime changes.
+
     Args:
         markdown_path: Path to a markdown file
-    
+
     Returns:
         Dictionary containung the metadata key-value pairs.
         Returns empty dict if no metadata is found or file can't be read.
     """
-    metadata = {}
     try:
         with markdown_path.open('r', encoding='utf-8') as file:
-            lines = iter(file)
-
-            #Find the opening "---"
-            for line in lines:
-                if line.strip() == "---":
-                    break
-            # No front matter found
-            else:
-                return metadata
-
-            for line in lines:
-                line = line.strip()
-                if line == "---":
-                    return metadata
-                if not line or ':' not in line:
-                    continue #Skip empty or invalid lines
-                
-                key,value = line.split(':', 1)
-                metadata[key.strip()] = value.strip()
+            st = os.fstat(file.fileno())
+            signature = [st.st_size, st.st_mtime_ns]
+            cached = _front_matter_cache.get(markdown_path)
+            if cached is not None and cached[0] == signature:
+                return dict(cached[1])
+            metadata = parse_front_matter(file)
     except (IOError, UnicodeDecodeError):
         return {}
-    return {}
+    _front_matter_cache[markdown_path] = (signature, metadata)
+    return dict(metadata)
 
 
 def parse_date(date_str: str) -> Optional[datetime.date]:
@@ -199,12 +812,13 @@ def parse_date(date_str: str) -> Optional[datetime.date]:
             continue
     return None
 
-def slugify(filepath: ObsidianPath):
+def slugify(filepath: ObsidianPath, metadata: Optional[dict] = None):
     """
     Transform a filename into a URL-safe slug following Jekyll conventions.
     
     Args:
         file_path: Path object or string filename to convert
+        metadata: Already parsed front matter of the file, read from the file if not provided
         
     Returns:
         A sanitized filename with:
@@ -238,7 +852,8 @@ def slugify(filepath: ObsidianPath):
     slug = stem.lower() + ext.lower()
 
     # Special case for post layouts
-    metadata = read_md_metadata(filepath)
+    if metadata is None:
+        metadata = read_md_metadata(filepath)
     if metadata.get("layout") == "post":
         date_str = metadata.get("date")
         if not date_str:
@@ -246,7 +861,8 @@ def slugify(filepath: ObsidianPath):
                 filepath=str(filepath),
                 reason="Missing date field for post layout"
             )
-        parsed_date = parse_date(date_str)
+        # A list or a mapping is no date either
+        parsed_date = parse_date(date_str) if isinstance(date_str, str) else None
         if parsed_date is not None:
             date_prefix = f"{parsed_date.year:04d}-{parsed_date.month:02d}-{parsed_date.day:02d}"
             slug = f"{date_prefix}-{slug}"
@@ -259,7 +875,7 @@ def slugify(filepath: ObsidianPath):
     return slug
 
 
-def transform_md_match(match: re.Match, src_dir: ObsidianPath = OBSIDIAN_IMAGE_DIR, dest_dir: JekyllPath = JEKYLL_IMAGE_DIR):
+def transform_md_match(match: re.Match, src_dir: Optional[ObsidianPath] = None, dest_dir: Optional[JekyllPath] = None, context: Optional[ConversionContext] = None):
     """
     Transforms standard Markdown links and images - ![]() or []() - into Jekyll-compatible format.
 
@@ -296,24 +912,30 @@ def transform_md_match(match: re.Match, src_dir: ObsidianPath = OBSIDIAN_IMAGE_D
     url = match.group(3)
     
     if is_image and not url.startswith(('http://', 'https://')):
-        img_path = Path(url)
-        src_path = src_dir / img_path
-        dst_path = dest_dir / img_path
+        src_dir = src_dir or get_config().obsidian_image_dir
+        dest_dir = dest_dir or get_config().jekyll_image_dir
+        # The image is published under the name the URL decodes to ("My%20Image.png" -> "My Image.png")
+        img_path = Path(urllib.parse.unquote(url))
+        src_path = resolve_image_source(url, src_dir, context)
+        dst_path = dest_dir / published_image_path(img_path, context=context)
         
-        if ensure_image_available(src_path, dst_path):
-            rel_path = dst_path.relative_to(dest_dir)
+        if ensure_image_available(src_path, dst_path, context):
+            rel_path = dst_path.relative_to(dest_dir).as_posix()
+            if img_path.as_posix() != url:
+                rel_path = urllib.parse.quote(rel_path)  # Written URL-encoded, stays so
             return f"![{alt_text}]({rel_path})"
         return alt_text
     return match.group(0)  # Leave external links and doc links unchanged
 
-def transform_obsidian_match(match, src_dir: ObsidianPath = OBSIDIAN_IMAGE_DIR, dest_dir: JekyllPath = JEKYLL_IMAGE_DIR):
+def transform_obsidian_match(match, src_dir: Optional[ObsidianPath] = None, dest_dir: Optional[JekyllPath] = None, context: Optional[ConversionContext] = None):
     """
     Transforms Obsidian-style links ([[ ]]) into Jekyll-compatible format.
 
     Args:
         match: re.Match object from Obsidian link pattern
-        src_dir: Source directory for images (default: OBSIDIAN_IMAGE_DIR)
-        dest_dir: Destination directory for images (default: JEKYLL_IMAGE_DIR)
+        src_dir: Source directory for images (default: the configured obsidian_image_dir)
+        dest_dir: Destination directory for images (default: the configured jekyll_image_dir)
+        context: Optional collector of the images the note depends on
 
     Returns:
         Transformed markdown string or display text
@@ -327,6 +949,10 @@ def transform_obsidian_match(match, src_dir: ObsidianPath = OBSIDIAN_IMAGE_DIR,
         Input:  [[README.md|Readme File]]
         Output: Readme File
 
+        # Link to a published note (with a LinkResolver in the context)
+        Input:  [[Turing Machine#Definition|TM]]
+        Output: [TM]({% link _posts/2024-12-20-turing-machine.md %}#definition)
+
         # Obsidian image with alt text
         Input:  ![[logo.png|Company Logo]]
         Output: ![Company Logo](../assets/logo.png)
@@ -334,28 +960,40 @@ def transform_obsidian_match(match, src_dir: ObsidianPath = OBSIDIAN_IMAGE_DIR,
     is_image = match.group(1) == '!'
     full_ref = match.group(2)
     if is_image:
-        new_content, relative_src_path = transform_image_ref(full_ref, dest_dir, JEKYLL_ROOT)
-        dst_path = dest_dir / relative_src_path
-        src_path = src_dir / relative_src_path
+        src_dir = src_dir or get_config().obsidian_image_dir
+        dest_dir = dest_dir or get_config().jekyll_image_dir
+        ref = ImageRef.parse(full_ref)
+        published_path = published_image_path(ref.path, ref.width, ref.height, context)
+        new_content, _ = transform_image_ref(ref, dest_dir, get_config().jekyll_root, published_path)
+        dst_path = dest_dir / published_path
+        src_path = resolve_image_source(ref.path.as_posix(), src_dir, context)
 
         ensure_image_available(
             src_path,
-            dst_path
+            dst_path,
+            context,
+            (ref.width, ref.height)
         )
         return new_content
     else:
-        return transform_md_ref(full_ref) #do nothing with non-image references
+        link = WikiLink.parse(full_ref)
+        if context is not None and context.link_resolver is not None:
+            resolved = context.link_resolver.resolve(link, context)
+            if resolved is not None:
+                return resolved
+        return link.display # Unpublished notes are reduced to their display text
     
-def transform_references(filepath: JekyllPath, src_dir: ObsidianPath = OBSIDIAN_IMAGE_DIR, dest_dir: JekyllPath = JEKYLL_IMAGE_DIR):
+def transform_references(filepath: JekyllPath, src_dir: Optional[ObsidianPath] = None, dest_dir: Optional[JekyllPath] = None, context: Optional[ConversionContext] = None):
     """
     Transform Obsidian-style references to Jekyll-compatible format.
     Handles both document links and image references.
 
-    Currently simply deletes document links. No complex linking for non-images is implemented as of now, 
-    but may be implemented in the future.
-    If this will ever be implemented: https://jekyllrb.com/docs/liquid/tags/#links this is the way to do it
+    Document links ([[note]], [[note|alias]], [[note#heading]]) to published notes become Liquid
+    links (https://jekyllrb.com/docs/liquid/tags/#links) when the context carries a LinkResolver,
+    links to anything else are reduced to their display text.
+    References inside code blocks and inline code are left as they are.
 
-    The only exceptions are images, which are transfered from their source to JEKYLL_IMAGE_DIR
+    The only exceptions are images, which are transfered from their source to the Jekyll image directory
         Image reference can be in form:
         1. ![Alt text](path/to/image.png)
         2. ![[image.png]]                           - has to be in image folder (specified in Obsidian config) 
@@ -364,28 +1002,407 @@ def transform_references(filepath: JekyllPath, src_dir: ObsidianPath = OBSIDIAN_
         5. ![[path/to/image.png|My Alt Text]]       - alt text
         6. ![[path/to/image.png|My Alt Text|200]]   - alt text + resize
     """
-    content = filepath.read_text(encoding='utf-8')
+    with open(filepath, encoding='utf-8') as file:
+        write_atomic(filepath, transform_stream(iter(lambda: file.read(STREAM_CHUNK_SIZE), ''), src_dir, dest_dir, context))
 
-    # Patterns for different reference types
-    obsidian_link_pattern = re.compile(r'(!?)\[\[([^\]\[]+)\]\]')  # ![[ ]] or [[ ]]
-    md_link_pattern = re.compile(r'(!?)\[([^\]]+)\]\(([^)]+)\)')    # ![]() or []()
-    # Transform all reference types
-    content = md_link_pattern.sub(transform_md_match, content)
-    content = obsidian_link_pattern.sub(transform_obsidian_match, content)
+def scan_references(content: str):
+    """
+    Walks a note once, yielding (kind, match) for every reference outside of code.
 
-    filepath.write_text(content, encoding='utf-8')
+    kind is "wiki" with a match of OBSIDIAN_LINK_PATTERN or "md" with a match of MD_LINK_PATTERN,
+    so the matches can go straight to transform_obsidian_match() / transform_md_match().
+    Fenced code blocks (``` or ~~~) and inline code spans are skipped.
+    """
+    for token in REFERENCE_SCANNER.finditer(content):
+        kind = token.lastgroup
+        if kind == "wiki":
+            yield kind, OBSIDIAN_LINK_PATTERN.match(content, token.start(), token.end())
+        elif kind == "md":
+            yield kind, MD_LINK_PATTERN.match(content, token.start(), token.end())
+
+def scan_reference_stream(chunks: Iterable[str]):
+    """
+    scan_references() over a note given as chunks of text (split anywhere), without holding all of it.
+
+    Yields (None, text) for text to copy as is and (kind, match) for the references, in
+    document order. The tokens are the ones REFERENCE_SCANNER finds in the whole note: a token
+    is only taken once the text after it cannot change it: its line is complete, inline code
+    (or backticks that did not open any) has the end of its paragraph after it, a [[ that did
+    not close has enough text after it to tell. So at most an unfinished paragraph is held
+    back. Fenced code blocks are passed through as they come, their closing fence is searched
+    for in each new chunk.
+    """
+    chunks = iter(chunks)
+    buffer = "\n"  # Keeps the character before the unprocessed text, so that ^ only matches at line starts
+    pos = 1
+    closing_fence = None  # Inside a fenced code block: pattern of its closing fence
+    eof = False
+    while not eof:
+        chunk = next(chunks, None)
+        eof = chunk is None
+        buffer = buffer[pos - 1:] + (chunk or "")
+        pos = literal = 1  # literal: start of the text not yielded yet
+        limit = len(buffer) if eof else buffer.rfind('\n') + 1  # Only complete lines are taken
+        paragraph_end = None  # Start of the last blank line of the complete lines, looked up once per chunk
+        waiting = False
+        while pos < limit and not waiting:
+            if closing_fence is not None:
+                closing = closing_fence.search(buffer, pos)
+                if closing is not None and (closing.end() < limit or eof):
+                    pos = closing.end()
+                    closing_fence = None
+                else:
+                    # The last newline may start the closing fence
+                    pos = len(buffer) if eof else limit - 1
+                    waiting = True
+                continue
+            for token in REFERENCE_SCANNER.finditer(buffer, pos):
+                kind = token.lastgroup
+                end = token.end()
+                if kind == "fence" and end == len(buffer) and not eof:
+                    closing_fence = re.compile(r'\n[ \t]*' + re.escape(token.group("fence_mark")) + r'[`~]*[ \t]*(?=\n|\Z)')
+                    pos = token.end("fence_mark")
+                    break
+                if end > limit:
+                    waiting = True
+                    break
+                if not eof and (kind == "code" or kind == "ticks_text"):
+                    if paragraph_end is None:
+                        paragraph_end = max((blank.start() for blank in BLANK_LINE.finditer(buffer, pos, limit)), default=-1)
+                    if paragraph_end < end:
+                        waiting = True
+                        break
+                if not eof and kind == "text" and buffer[token.start()] in "![" \
+                        and OPEN_WIKI_LINK.match(buffer, token.start()) is not None:
+                    waiting = True
+                    break
+                if kind == "wiki" or kind == "md":
+                    if literal < token.start():
+                        yield None, buffer[literal:token.start()]
+                    pattern = OBSIDIAN_LINK_PATTERN if kind == "wiki" else MD_LINK_PATTERN
+                    yield kind, pattern.match(buffer, token.start(), end)
+                    literal = end
+                pos = end
+                if pos >= limit:
+                    break
+        if literal < pos:
+            yield None, buffer[literal:pos]
+
+def transform_stream(chunks: Iterable[str], src_dir: Optional[ObsidianPath] = None, dest_dir: Optional[JekyllPath] = None,
+                     context: Optional[ConversionContext] = None):
+    """transform_content() of a note given as chunks of text, yields the transformed note piece by piece."""
+    handlers = {"wiki": transform_obsidian_match, "md": transform_md_match}
+    src_dir = src_dir or get_config().obsidian_image_dir
+    dest_dir = dest_dir or get_config().jekyll_image_dir
+    for kind, item in scan_reference_stream(chunks):
+        if kind is None:
+            yield item
+            continue
+        if context is not None:
+            context.refs.append(reference_of(kind, item))
+        yield handlers[kind](item, src_dir, dest_dir, context)
+
+def transform_content(content: str, src_dir: Optional[ObsidianPath] = None, dest_dir: Optional[JekyllPath] = None, context: Optional[ConversionContext] = None) -> str:
+    """In-memory variant of transform_references(), returns the transformed note content."""
+    handlers = {"wiki": transform_obsidian_match, "md": transform_md_match}
+    src_dir = src_dir or get_config().obsidian_image_dir
+    dest_dir = dest_dir or get_config().jekyll_image_dir
+    parts = []
+    end = 0
+    for kind, match in scan_references(content):
+        if context is not None:
+            context.refs.append(reference_of(kind, match))
+        parts.append(content[end:match.start()])
+        parts.append(handlers[kind](match, src_dir, dest_dir, context))
+        end = match.end()
+    parts.append(content[end:])
+    return ''.join(parts)
+
+# Characters the GFM header ids drop: all but word characters (unicode letters, digits, "_"), "-" and blanks
+HEADING_ANCHOR_DROPPED = re.compile(r'[^\w\- \t]')
+
+def heading_anchor(heading: str) -> str:
+    """
+    Anchor that kramdown generates for a heading with `input: GFM`, Jekyll's default: the
+    lowercased text without punctuation, blanks turned into "-". Digits and accented letters stay.
+
+    Example:
+        "2. Formal Definition!" -> "2-formal-definition"
+        "Café & Crème"          -> "café--crème"
+    """
+    anchor = HEADING_ANCHOR_DROPPED.sub('', heading.strip().lower())
+    return anchor.replace(' ', '-').replace('\t', '-')
+
+def front_matter_list(value) -> list[str]:
+    """Front matter value that may be a list or a "a, b" / "[a, b]" string, as a list of strings."""
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip()]
+    if not value:
+        return []
+    value = str(value).strip()
+    if value.startswith('[') and value.endswith(']'):
+        value = value[1:-1]
+    return [item.strip().strip('"\'') for item in value.split(',') if item.strip().strip('"\'')]
+
+class AttachmentIndex:
+    """
+    Every non-note file of the vault, indexed in one os.scandir pass.
+    The names of the notes are collected too (note_names, as LinkResolver keys), so that a
+    link to an unpublished note can be told from a broken one.
+
+    Obsidian resolves an embed by its path or, most commonly, by its bare file name anywhere in
+    the vault ("shortest path when possible"). The index has a key per vault-relative path and
+    per file name, both case-folded. When several files share a name, the one in the attachment
+    folder (attachment_dir) wins, then the one with the shortest path; the clash is kept
+    in `collisions` so it can be reported.
+    A lazy() index skips the scan until a reference does not name an existing file by its path.
+    """
+    def __init__(self, root: Path, attachment_dir: Optional[Path] = None):
+        self.root = Path(root)
+        self.attachment_dir = Path(attachment_dir) if attachment_dir is not None else None
+        self.files: set[Path] = set()
+        self._by_path: dict[str, Path] = {}
+        self._by_name: dict[str, Path] = {}
+        self.collisions: dict[str, list[Path]] = {}
+        self.note_names: set[str] = set()
+        # Set by lazy(), the vault is scanned on the first reference a path does not resolve
+        self.scan_pending = False
+
+    @classmethod
+    def build(cls, root: Path, attachment_dir: Optional[Path] = None) -> "AttachmentIndex":
+        index = cls(root, attachment_dir)
+        index._scan(index.root)
+        return index
+
+    @classmethod
+    def lazy(cls, root: Path, attachment_dir: Optional[Path] = None) -> "AttachmentIndex":
+        """
+        Index for runs that resolve the embeds of a few notes (restricted runs): references
+        that name a file by its path are stat'ed, the vault is only scanned for the others
+        (embeds by bare name, missing images). collisions are known only after the scan.
+        """
+        index = cls(root, attachment_dir)
+        index.scan_pending = True
+        return index
+
+    def _scan_now(self):
+        self.scan_pending = False
+        self._scan(self.root)
+
+    def _existing_file(self, path: Path) -> Optional[Path]:
+        """path if the scan would index it (an existing non-note file outside hidden trees)."""
+        if not path.is_relative_to(self.root):
+            return None
+        parts = path.relative_to(self.root).parts
+        if any(part.startswith('.') for part in parts) or path.name.endswith('.md') or not path.is_file():
+            return None
+        return path
+
+    def _scan(self, directory: Path):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # Hidden trees: .git, .obsidian, .jekyll_repository, the converter's caches...
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    self._scan(Path(entry.path))
+                elif not entry.name.endswith('.md'):
+                    self.add(Path(entry.path))
+                else:
+                    self.note_names.add(LinkResolver.key(entry.name))
+
+    def _preference(self, path: Path):
+        in_attachment_dir = self.attachment_dir is not None and path.is_relative_to(self.attachment_dir)
+        return (not in_attachment_dir, len(path.parts), str(path))
+
+    def add(self, path: Path):
+        self.files.add(path)
+        self._by_path[path.relative_to(self.root).as_posix().casefold()] = path
+        name = path.name.casefold()
+        current = self._by_name.get(name)
+        if current is None:
+            self._by_name[name] = path
+            return
+        self.collisions.setdefault(name, [current]).append(path)
+        if self._preference(path) < self._preference(current):
+            self._by_name[name] = path
+
+    def __contains__(self, path) -> bool:
+        if self.scan_pending:
+            return self._existing_file(Path(path)) is not None
+        return Path(path) in self.files
+
+    def resolve(self, reference: str, src_dir: Optional[Path] = None) -> Optional[Path]:
+        """
+        File an embed reference points to, None if there is none.
+
+        Tried in order: relative to src_dir (the attachment folder), relative to the vault
+        root, then by file name alone. URL-encoded references ("Pasted%20image.png") are decoded.
+        """
+        if self.scan_pending:
+            for candidate in dict.fromkeys((reference, urllib.parse.unquote(reference))):
+                candidate = candidate.strip().lstrip('/')
+                if not candidate or '..' in Path(candidate).parts:
+                    continue
+                bases = [Path(src_dir)] if src_dir is not None and Path(src_dir).is_relative_to(self.root) else []
+                for base in bases + [self.root]:
+                    found = self._existing_file(base / candidate)
+                    if found is not None:
+                        return found
+            self._scan_now()
+        for candidate in dict.fromkeys((reference, urllib.parse.unquote(reference))):
+            candidate = candidate.strip().lstrip('/')
+            if src_dir is not None and Path(src_dir).is_relative_to(self.root):
+                key = (Path(src_dir).relative_to(self.root) / candidate).as_posix().casefold()
+                if key in self._by_path:
+                    return self._by_path[key]
+            found = self._by_path.get(candidate.casefold()) or self._by_name.get(Path(candidate).name.casefold())
+            if found is not None:
+                return found
+        return None
+
+class LinkResolver:
+    """
+    Maps wiki-link targets to the Jekyll files of published notes.
+
+    Built once per run from the note titles (file names) and their front matter aliases,
+    each lookup is a single dictionary access. Keys are case-insensitive file names, as in
+    Obsidian; a note title wins over an alias of another note.
+    Links are emitted as Liquid `link` tags, so Jekyll fills in the real URL (whatever the
+    permalink settings are) and fails the build if the target disappears.
+    """
+    def __init__(self):
+        self._targets: dict[str, str] = {}
+
+    @staticmethod
+    def key(name: str) -> str:
+        name = name.strip().replace('\\', '/').rsplit('/', 1)[-1]
+        if name.lower().endswith('.md'):
+            name = name[:-3]
+        return name.strip().casefold()
+
+    def add(self, name: str, jekyll_file: str, overwrite: bool = False):
+        """jekyll_file is relative to the Jekyll root, e.g. "_posts/2024-12-20-turing-machine.md"."""
+        key = self.key(name)
+        if key and (overwrite or key not in self._targets):
+            self._targets[key] = jekyll_file
+
+    @classmethod
+    def from_notes(cls, notes) -> "LinkResolver":
+        """Resolver over the notes that can be published (their record is known and slugify() accepted them)."""
+        resolver = cls()
+        published = [(note, note.target.jekyll_file) for note in sorted(notes, key=lambda note: note.path)
+                     if note.target is not None]
+        for note, jekyll_file in published:
+            resolver.add(note.path.stem, jekyll_file)
+        for note, jekyll_file in published:
+            front_matter = note.record.front_matter
+            for alias in front_matter_list(front_matter.get("aliases") or front_matter.get("alias")):
+                resolver.add(alias, jekyll_file)
+        return resolver
+
+    @classmethod
+    def from_records(cls, records: dict[Path, "NoteRecord"], collection_of: dict[Path, Path]) -> "LinkResolver":
+        """from_notes() for notes given as their records and collections."""
+        return cls.from_notes(Note(source, collection=collection_of[source], record=record)
+                              for source, record in records.items())
+
+    def without(self, jekyll_files: set[str]) -> "LinkResolver":
+        """Copy of the resolver that leaves links to jekyll_files (notes that failed to convert) unresolved."""
+        resolver = LinkResolver()
+        resolver._targets = {key: jekyll_file for key, jekyll_file in self._targets.items() if jekyll_file not in jekyll_files}
+        return resolver
+
+    def lookup(self, link_target: str) -> Optional[str]:
+        return self._targets.get(self.key(link_target))
+
+    def resolve(self, link: Union[str, "WikiLink"], context: Optional[ConversionContext] = None) -> Optional[str]:
+        """
+        Markdown link for a [[ ]] reference (or its content), None if the target is not published.
+
+        Examples:
+            "Turing Machine"              -> [Turing Machine]({% link _posts/2024-12-20-turing-machine.md %})
+            "Turing Machine#Tape|the tape" -> [the tape]({% link _posts/2024-12-20-turing-machine.md %}#tape)
+            "#Tape"                        -> [Tape](#tape)
+        """
+        if isinstance(link, str):
+            link = WikiLink.parse(link)
+        target, heading, alias = link.target, link.heading, link.alias
+        anchor = f"#{heading_anchor(heading)}" if heading else ""
+
+        if not target:
+            # Link to a heading of the same note
+            return f"[{alias or heading}]({anchor})" if heading else None
+
+        jekyll_file = self.lookup(target)
+        if context is not None:
+            context.links[self.key(target)] = jekyll_file
+        if jekyll_file is None:
+            return None
+        text = alias or (f"{target} > {heading}" if heading else target)
+        return f"[{text}]({{% link {jekyll_file} %}}{anchor})"
+
+class WikiLink:
+    """
+    A link to a note, the content of [[target#heading|alias]].
+
+    alias is the first non-empty part after the target, display the text an unpublished
+    target is reduced to - the first part that is not a number ("" if there is none).
+    """
+    __slots__ = ("target", "heading", "alias", "display")
+
+    def __init__(self, target: str, heading: str = "", alias: Optional[str] = None, display: str = ""):
+        self.target = target
+        self.heading = heading
+        self.alias = alias
+        self.display = display
+
+    @classmethod
+    def parse(cls, full_ref: str) -> "WikiLink":
+        parts = [part.strip() for part in full_ref.split('|')]
+        target, _, heading = parts[0].partition('#')
+        alias = next((part for part in parts[1:] if part), None)
+        display = next((part for part in parts[1:] if not part.isdigit()), "")
+        return cls(target.strip(), heading.strip(), alias, display)
 
 def transform_md_ref(full_ref: str) -> str:
     """
     Currently simply deletes document links and extracts alt text from reference if it exists.
     """
-    parts = [part.strip() for part in full_ref.split('|')]
-    for part in parts[1:]:
-        if not (part.isdigit()):
-            return part
-    return ""
+    return WikiLink.parse(full_ref).display
+
+class ImageRef:
+    """An image embed: its path as written, alt text and the size it is embedded with."""
+    __slots__ = ("path", "alt", "width", "height")
+
+    def __init__(self, path: Path, alt: str = "Image", width: Optional[str] = None, height: Optional[str] = None):
+        self.path = path
+        self.alt = alt
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def parse(cls, full_ref: str) -> "ImageRef":
+        """Splits the content of an Obsidian embed, ![[path|alt|200x100]], into its parts."""
+        # Split into components and strip whitespace
+        parts = [part.strip() for part in full_ref.split('|')]
+        ref = cls(Path(parts[0]))
+
+        # Process additional parameters
+        for part in parts[1:]:
+            if 'x' in part and all(s.isdigit() for s in part.split('x')):
+                # Case 3 & 7: Dimensions (200x100)
+                ref.width, ref.height = part.split('x')[:2]
+            elif part.isdigit():
+                # Case 2 & 5: Single dimension (200)
+                ref.width = part
+            else:
+                # Case 4 & 5 & 7: Alt text (non-numeric)
+                ref.alt = part
+        return ref
 
-def transform_image_ref(full_ref: str, new_parent_dir: JekyllPath = JEKYLL_IMAGE_DIR, root: JekyllPath = JEKYLL_ROOT) -> str:
+def transform_image_ref(full_ref: Union[str, ImageRef], new_parent_dir: Optional[JekyllPath] = None, root: Optional[JekyllPath] = None,
+                        published_path: Optional[Path] = None) -> str:
     """
     Transform Obsidian-style image references to standard Markdown.
     Handles all these cases:
@@ -396,30 +1413,17 @@ def transform_image_ref(full_ref: str, new_parent_dir: JekyllPath = JEKYLL_IMAGE
     5. ![[image.png|alt text|200]]      → ![alt text](image.png){:width="200"}
     6. ![[subdir/image.png]]            → ![Image](subdir/image.png)
     7. ![[image.png|alt text|200x100]]  → ![alt text](image.png){:width="200" height="100"}
+
+    published_path replaces the image path in the tag when the image is published under
+    another name (an optimized variant, see ImageOptimizer).
     """
-    # Split into components and strip whitespace
-    parts = [part.strip() for part in full_ref.split('|')]
-    relative_img_path = Path(parts[0])
-    
-    # Default values
-    alt_text = "Image"
-    width = None
-    height = None
-    
-    # Process additional parameters
-    for part in parts[1:]:
-        if 'x' in part and all(s.isdigit() for s in part.split('x')):
-            # Case 3 & 7: Dimensions (200x100)
-            width, height = part.split('x')[:2]
-        elif part.isdigit():
-            # Case 2 & 5: Single dimension (200)
-            width = part
-        else:
-            # Case 4 & 5 & 7: Alt text (non-numeric)
-            alt_text = part
-    
+    ref = ImageRef.parse(full_ref) if isinstance(full_ref, str) else full_ref
+    relative_img_path, alt_text, width, height = ref.path, ref.alt, ref.width, ref.height
+    new_parent_dir = new_parent_dir or get_config().jekyll_image_dir
+    root = root or get_config().jekyll_root
+
     # Build the image tag - 
-    img_tag = f"![{alt_text}](/{(new_parent_dir/relative_img_path).relative_to(root)})"
+    img_tag = f"![{alt_text}](/{(new_parent_dir/(published_path or relative_img_path)).relative_to(root)})"
 
     # Add dimensions if specified
     if width and height:
@@ -430,54 +1434,2255 @@ def transform_image_ref(full_ref: str, new_parent_dir: JekyllPath = JEKYLL_IMAGE
     return img_tag, relative_img_path
     
 
+# Errors meaning "this kind of kernel side copy is not possible here", not a failed copy
+_NO_KERNEL_COPY = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EPERM, errno.EBADF}
+COPY_CHUNK_SIZE = 1 << 20
+
+def copy_file_content(src_fd: int, dst_fd: int, size: int):
+    """
+    Copies size bytes between two file descriptors without holding the content in memory.
+
+    Uses os.copy_file_range (the kernel copies the data, possibly as a reflink), then
+    os.sendfile, and falls back to streaming fixed-size chunks when neither is supported.
+    """
+    copied = 0
+    kernel_copies = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copies.append(lambda count: os.copy_file_range(src_fd, dst_fd, count, copied, copied))
+    if hasattr(os, "sendfile"):
+        kernel_copies.append(lambda count: os.sendfile(dst_fd, src_fd, copied, count))
+
+    for kernel_copy in kernel_copies:
+        # sendfile writes at the current position of dst
+        os.lseek(dst_fd, copied, os.SEEK_SET)
+        try:
+            while copied < size:
+                sent = kernel_copy(min(size - copied, 1 << 30))
+                if sent == 0:
+                    return  # Source got shorter
+                copied += sent
+            return
+        except OSError as e:
+            if e.errno not in _NO_KERNEL_COPY:
+                raise
+
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while True:
+        chunk = os.read(src_fd, COPY_CHUNK_SIZE)
+        if not chunk:
+            return
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
 def copy_file(src: Path, dst: Path):
-    dst.write_bytes(src.read_bytes())
+    """
+    Copies content and modification time (so that later runs can compare stats).
+
+    The copy goes through a temporary file and a rename, so concurrent copies of the
+    same file (from parallel conversions) never expose a partially written dst.
+    The content is copied by the kernel where possible, memory use does not depend on the file size.
+    """
+    tmp = temporary_sibling(dst)
+    try:
+        with open(src, 'rb', buffering=0) as fsrc, open(tmp, 'xb', buffering=0) as fdst:
+            st = os.fstat(fsrc.fileno())
+            copy_file_content(fsrc.fileno(), fdst.fileno(), st.st_size)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+def link_file(src: Path, dst: Path):
+    """
+    Makes dst a hard link of src, through a temporary link and a rename.
+
+    Falls back to copy_file() when src and dst are on different filesystems
+    (or the filesystem does not support hard links).
+    """
+    tmp = temporary_sibling(dst)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        copy_file(src, dst)
+        return
+    try:
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
 
-def ensure_image_available(obsidian_img_path: Path, jekyll_img_path: Path) -> bool:
-    """Copy image if needed, returns success status"""
-    if not obsidian_img_path.exists():
+def is_identical_file(src: Path, dst: Path) -> bool:
+    """
+    Checks whether dst already holds the content of src.
+
+    Size and mtime are compared first; the content hash is computed only when sizes match
+    but mtimes do not. In that case dst gets src's mtime, so the next check is stat-only.
+    """
+    try:
+        src_stat = os.stat(src)
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True  # Hard linked
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+        return True
+    if file_digest(src) != file_digest(dst):
+        return False
+    os.utime(dst, ns=(dst_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return True
+
+class ImageSync:
+    """
+    Copies images into the Jekyll site, skipping the ones that are already there.
+
+    Each destination is synced at most once per run, no matter how many references
+    point at it, and is only written when its content differs from the source.
+    With link=True images are hard linked instead of copied (when on the same filesystem).
+    With an optimizer, raster images are published as its cached variants instead of as is.
+    With a scheduler, submit() publishes the images in the background.
+    """
+    def __init__(self, link: bool = False, optimizer: Optional["ImageOptimizer"] = None,
+                 scheduler: Optional["CopyScheduler"] = None):
+        self.link = link
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.copied = 0
+        self.skipped = 0
+        self._synced: set[Path] = set()
+        self._jobs: dict[Path, CopyJob] = {}
+        self._lock = threading.Lock()  # Scheduled syncs update _synced and the counters from the copy threads
+
+    def submit(self, src: Path, dst: Path, size: tuple = (None, None)) -> tuple["CopyJob", bool]:
+        """
+        sync() on the scheduler. Every reference to dst in the run shares the first one's job.
+
+        Returns:
+            The job and whether this call submitted it
+        """
+        dst = Path(dst)
+        job = self._jobs.get(dst)
+        if job is not None:
+            return job, False
+        job = self._jobs[dst] = CopyJob(src, dst, self.scheduler.submit(lambda: self.sync(src, dst, size)))
+        return job, True
+
+    def sync(self, src: Path, dst: Path, size: tuple = (None, None)) -> bool:
+        """Returns True if the image had to be copied. size is the (width, height) the image is embedded with."""
+        dst = Path(dst)
+        with self._lock:
+            if dst in self._synced:
+                self.skipped += 1
+                return False
+        if self.optimizer is not None and self.optimizer.accepts(src):
+            src = self.optimizer.variant(src, dst.suffix, *size)
+        if is_identical_file(src, dst):
+            with self._lock:
+                self._synced.add(dst)
+                self.skipped += 1
+            return False
+        if not dst.parent.exists():
+            dst.parent.mkdir(parents=True, exist_ok=True)
+        if self.link:
+            link_file(src, dst)
+        else:
+            copy_file(src, dst)
+        with self._lock:
+            self._synced.add(dst)
+            self.copied += 1
+        return True
+
+class CopyJob:
+    """An image ImageSync publishes in the background; future gives sync()'s result or its error."""
+    __slots__ = ("src", "dst", "future")
+
+    def __init__(self, src: Path, dst: Path, future: Future):
+        self.src = src
+        self.dst = dst
+        self.future = future
+
+class CopyScheduler:
+    """
+    Runs image copies in the background while the notes are transformed.
+
+    An asyncio event loop in a daemon thread takes jobs from a bounded queue and runs them on
+    a thread pool - copies are system calls that release the GIL, so they overlap with the
+    regex work of the conversion. submit() blocks while `queue_size` jobs are waiting
+    (backpressure: the conversion cannot run arbitrarily far ahead of the disk). Each job
+    reports its result or error through its own future; wait() waits for all of them.
+    """
+    def __init__(self, workers: int = 4, queue_size: int = 64):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="image-copy")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="copy-scheduler", daemon=True)
+        self.thread.start()
+        self.consumers: list[asyncio.Task] = []
+        self.queue: asyncio.Queue = self._call(self._start(queue_size))
+
+    def _call(self, coroutine):
+        """Runs a coroutine on the scheduler's loop and waits for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _start(self, queue_size: int) -> asyncio.Queue:
+        queue = asyncio.Queue(queue_size)
+        self.consumers = [asyncio.create_task(self._consume(queue)) for _ in range(self.workers)]
+        return queue
+
+    async def _consume(self, queue: asyncio.Queue):
+        while True:
+            function, future = await queue.get()
+            try:
+                future.set_result(await self.loop.run_in_executor(self.pool, function))
+            except Exception as error:
+                future.set_exception(error)
+            finally:
+                queue.task_done()
+
+    async def _stop(self):
+        await self.queue.join()
+        for consumer in self.consumers:
+            consumer.cancel()
+        await asyncio.gather(*self.consumers, return_exceptions=True)
+
+    def submit(self, function) -> Future:
+        """Queues function() to run on the thread pool, blocks while the queue is full."""
+        future = Future()
+        self._call(self.queue.put((function, future)))
+        return future
+
+    def wait(self):
+        """Blocks until every submitted job is done."""
+        self._call(self.queue.join())
+
+    def close(self):
+        """Waits for the submitted jobs and stops the loop and the threads."""
+        if self.loop.is_closed():
+            return
+        self._call(self._stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.pool.shutdown()
+
+    def __enter__(self) -> "CopyScheduler":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ImageOptimizer:
+    """
+    Publishes downscaled, recompressed variants of raster images (needs Pillow).
+
+    An embed with a size (![[img.png|200]], ![[img.png|200x100]]) is published as a variant
+    that fits that size, the rest are only recompressed; with webp=True every variant is WebP.
+    Variants are rendered into cache_dir under a key of the source content and the transform
+    parameters, so each one is computed once - later notes and runs copy it from the cache.
+    cache_dir/sources maps a source's [size, mtime_ns] to that key, so a warm cache does not
+    hash the source again. An image Pillow cannot read fails the note with a PublishTransformError.
+    """
+    VERSION = 1 # Bump when the rendering changes, invalidates the cached variants
+    FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP'}
+    SAVE_OPTIONS = {
+        'PNG': {'optimize': True},
+        'JPEG': {'quality': 85, 'optimize': True, 'progressive': True},
+        'WEBP': {'quality': 80, 'method': 6},
+    }
+
+    def __init__(self, cache_dir: Path, webp: bool = False):
+        if pillow() is None:
+            raise RuntimeError("Image optimization needs Pillow (pip install Pillow).")
+        self.cache_dir = Path(cache_dir)
+        self.webp = webp
+
+    def settings(self) -> dict:
+        """What the published site depends on, see BuildManifest.options"""
+        return {"image_variants": self.VERSION, "webp": self.webp}
+
+    def accepts(self, path: Path) -> bool:
+        return Path(path).suffix.lower() in self.FORMATS
+
+    def variant_path(self, relative_path: Path, width: Optional[str] = None, height: Optional[str] = None) -> Path:
+        """Name of the variant: image.png embedded with |200 → image-200w.png (image-200w.webp with webp)"""
+        relative_path = Path(relative_path)
+        size = f"-{width}x{height}" if width and height else f"-{width}w" if width else ""
+        suffix = ".webp" if self.webp else relative_path.suffix
+        return relative_path.with_name(f"{relative_path.stem}{size}{suffix}")
+
+    def variant(self, src: Path, suffix: str, width: Optional[str] = None, height: Optional[str] = None) -> Path:
+        """Cached variant of src in the format of suffix, rendered on a cache miss."""
+        params = f"{self.VERSION}:{width}x{height}:{suffix.lower()}"
+        signature = stat_signature(src)
+        pointer = self.cache_dir / "sources" / hashlib.sha256(f"{Path(src).resolve()}:{signature}:{params}".encode()).hexdigest()
+        try:
+            cached = self.cache_dir / pointer.read_text(encoding='utf-8')
+            if cached.exists():
+                return cached
+        except OSError:
+            pass
+        key = hashlib.sha256(f"{file_digest(src)}:{params}".encode()).hexdigest()
+        cached = self.cache_dir / f"{key}{suffix.lower()}"
+        if not cached.exists():
+            with span("optimize_image", "image", image=src):
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                try:
+                    self.render(src, cached, width, height)
+                except (OSError, ValueError, pillow().DecompressionBombError) as error:
+                    # Unreadable, truncated or oversized image (UnidentifiedImageError is an OSError)
+                    raise PublishTransformError(str(src), f"Cannot optimize image: {error}")
+        pointer.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(pointer, cached.name)
+        return cached
+
+    def render(self, src: Path, dst: Path, width: Optional[str] = None, height: Optional[str] = None):
+        fmt = self.FORMATS[dst.suffix.lower()]
+        with pillow().open(src) as image:
+            image.load()
+            if width or height:
+                # Fits the box keeping the aspect ratio, never upscales
+                image.thumbnail((int(width or image.width), int(height or image.height)))
+            if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            tmp = temporary_sibling(dst)
+            try:
+                image.save(tmp, fmt, **self.SAVE_OPTIONS[fmt])
+                # Recompressing an already small image can make it larger, keep the original then
+                if not (width or height) and fmt == self.FORMATS.get(src.suffix.lower()) \
+                        and tmp.stat().st_size >= src.stat().st_size:
+                    copy_file(src, tmp)
+                os.replace(tmp, dst)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+
+def published_image_path(relative_path: Path, width: Optional[str] = None, height: Optional[str] = None,
+                         context: Optional[ConversionContext] = None) -> Path:
+    """Path (relative to the Jekyll image directory) an image reference is published under."""
+    image_sync = context.image_sync if context is not None else None
+    optimizer = image_sync.optimizer if image_sync is not None else None
+    if optimizer is None or not optimizer.accepts(relative_path):
+        return Path(relative_path)
+    return optimizer.variant_path(relative_path, width, height)
+
+def resolve_image_source(reference: str, src_dir: Path, context: Optional[ConversionContext] = None) -> Path:
+    """
+    Source file of an image reference.
+
+    Without an attachment index in the context the reference is relative to src_dir. With one,
+    it is resolved like Obsidian does (see AttachmentIndex.resolve). Unresolvable references
+    map to src_dir / reference, which ensure_image_available() then reports as missing.
+    """
+    if context is not None and context.attachments is not None:
+        found = context.attachments.resolve(reference, src_dir)
+        if found is not None:
+            return found
+    return src_dir / reference
+
+def ensure_image_available(obsidian_img_path: Path, jekyll_img_path: Path, context: Optional[ConversionContext] = None,
+                           size: tuple = (None, None)) -> bool:
+    """Copy image if needed, returns success status. size is the (width, height) the image is embedded with."""
+    attachments = context.attachments if context is not None else None
+    # The attachment index already knows every file of the vault, no need to stat each reference
+    exists = obsidian_img_path in attachments if attachments is not None else obsidian_img_path.exists()
+    if not exists:
         raise PublishTransformError(obsidian_img_path, "Obsidian image path does not exist.")
-    if not jekyll_img_path.parent.exists():
-        jekyll_img_path.parent.mkdir(parents=True)
-    copy_file(obsidian_img_path, jekyll_img_path)
+    image_sync = None
+    if context is not None:
+        context.images.add(Path(obsidian_img_path))
+        context.published_images.add(Path(jekyll_img_path))
+        image_sync = context.image_sync
+    if image_sync is not None and image_sync.scheduler is not None:
+        # Published in the background, the note's result waits for it (settle_images())
+        context.image_jobs.append(image_sync.submit(obsidian_img_path, jekyll_img_path, size))
+        return True
+    with span("ensure_image_available", "image", image=obsidian_img_path):
+        try:
+            copied = (image_sync or ImageSync()).sync(obsidian_img_path, jekyll_img_path, size)
+        except PublishTransformError:
+            raise
+        except Exception as error:
+            # Like a failed background copy (see settle_images()), the note fails, not the run
+            raise PublishTransformError(str(obsidian_img_path),
+                                        f"Publishing image {obsidian_img_path} to {jekyll_img_path} failed: {error}")
+    if context is not None:
+        if copied:
+            context.images_copied += 1
+            context.images_bytes += os.stat(jekyll_img_path).st_size
+        else:
+            context.images_skipped += 1
     return True
 
-def transfer_publish_file(source_filepath: ObsidianPath, target_directory: JekyllPath):
-    jekyll_filename = slugify(source_filepath)
+def temporary_sibling(path: Path) -> Path:
+    """Unique hidden path next to path, for write-then-rename updates."""
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
 
+def write_atomic(dst: Path, content: Union[str, Iterable[str]]):
+    """
+    Writes content (a string or the pieces of one) through a temporary file in the same
+    directory, so dst is never left half-written.
+    """
+    tmp = temporary_sibling(dst)
     try:
-        dst = target_directory / jekyll_filename
-        copy_file(source_filepath, dst)
+        with open(tmp, 'x', encoding='utf-8', newline='\n') as file:
+            if isinstance(content, str):
+                file.write(content)
+            else:
+                file.writelines(content)
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+def transfer_publish_file(source_filepath: ObsidianPath, target_directory: JekyllPath, context: Optional[ConversionContext] = None) -> Path:
+    """
+    Converts a single publish note into target_directory.
+
+    The note is read once; front matter, slug and transformed body all come from that buffer,
+    and the output is written once, atomically. A failed conversion leaves no output behind.
+
+    Returns:
+        Path of the produced Jekyll file
+    """
+    with span("convert_note", "note", note=source_filepath):
+        with open(source_filepath, 'rb') as file:
+            st = os.fstat(file.fileno())
+            if st.st_size > STREAM_THRESHOLD:
+                return transfer_large_note(file, st, source_filepath, target_directory, context)
+            raw = file.read()
+        if context is not None:
+            context.source_stat = [st.st_size, st.st_mtime_ns]
+            context.source_digest = hashlib.sha256(raw).hexdigest()
+        try:
+            text = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            raise PublishTransformError(str(source_filepath), "Note is not valid UTF-8.")
+        # Same newline handling as reading the note in text mode
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+        record = context.record if context is not None else None
+        if record is not None and record.is_current([st.st_size, st.st_mtime_ns]):
+            if record.slug_error is not None:
+                raise PublishTransformError(str(source_filepath), record.slug_error)
+            dst = target_directory / record.slug
+            # Nothing to rewrite in a note known to have no links and embeds
+            with span("transform_references", note=source_filepath):
+                content = text if record.refs == [] else transform_content(text, context=context)
+        else:
+            with span("slugify", note=source_filepath):
+                metadata = parse_front_matter(text)
+                dst = target_directory / slugify(source_filepath, metadata)
+            with span("transform_references", note=source_filepath):
+                content = transform_content(text, context=context)
+        write_atomic(dst, content)
+        return dst
+
+def read_text_chunks(file, digest=None, size: Optional[int] = None):
+    """
+    Text of a binary UTF-8 file in chunks, with the newlines of transfer_publish_file()
+    (\\r\\n and \\r become \\n). digest is updated with the raw bytes.
+    Raises UnicodeDecodeError when the file is not valid UTF-8.
+    """
+    size = size or STREAM_CHUNK_SIZE
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    carriage_return = False  # \\r at the end of the previous chunk, a \\n may follow
+    while True:
+        raw = file.read(size)
+        if digest is not None:
+            digest.update(raw)
+        text = decoder.decode(raw, final=not raw)
+        if carriage_return:
+            text = '\r' + text
+        carriage_return = bool(raw) and text.endswith('\r')
+        if carriage_return:
+            text = text[:-1]
+        if text:
+            yield text.replace('\r\n', '\n').replace('\r', '\n')
+        if not raw:
+            return
+
+def text_lines(file):
+    """Lines of the text read_text_chunks() gives, for parse_front_matter() to stop reading at the closing ---."""
+    rest = ""
+    for chunk in read_text_chunks(file, size=1 << 16):
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+def transfer_large_note(file, st: os.stat_result, source_filepath: Path, target_directory: Path,
+                        context: Optional[ConversionContext] = None) -> Path:
+    """
+    transfer_publish_file() for a note larger than STREAM_THRESHOLD, given as its open binary file.
+
+    The note is read, hashed, transformed and written in chunks (transform_stream()), so
+    the memory the conversion takes does not grow with the note.
+    """
+    record = context.record if context is not None else None
+    if record is not None and record.is_current([st.st_size, st.st_mtime_ns]):
+        if record.slug_error is not None:
+            raise PublishTransformError(str(source_filepath), record.slug_error)
+        dst = target_directory / record.slug
+        transform = record.refs != []  # Nothing to rewrite in a note known to have no links and embeds
+    else:
+        with span("slugify", note=source_filepath):
+            try:
+                metadata = parse_front_matter(text_lines(file))
+            except UnicodeDecodeError:
+                raise PublishTransformError(str(source_filepath), "Note is not valid UTF-8.")
+            dst = target_directory / slugify(source_filepath, metadata)
+        transform = True
+    file.seek(0)
+    digest = hashlib.sha256()
+    chunks = read_text_chunks(file, digest)
+    try:
+        with span("transform_references", note=source_filepath):
+            write_atomic(dst, transform_stream(chunks, context=context) if transform else chunks)
+    except UnicodeDecodeError:
+        raise PublishTransformError(str(source_filepath), "Note is not valid UTF-8.")
+    if context is not None:
+        context.source_stat = [st.st_size, st.st_mtime_ns]
+        context.source_digest = digest.hexdigest()
+    return dst
+
+def file_digest(filepath: Path) -> str:
+    """SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def stat_signature(filepath: Path) -> Optional[list[int]]:
+    """Cheap change detector - [size, mtime_ns], or None if the file is gone."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
 
-        transform_references(dst)
+def vault_key(filepath: Path) -> str:
+    """Path relative to the vault root, as stored in the converter's caches."""
+    return Path(filepath).relative_to(get_config().obsidian_root).as_posix()
+
+# BuildManifest.converter_fingerprint(), the manifest and the search index check it on every load and save
+_converter_fingerprint: Optional[str] = None
+
+class BuildManifest:
+    """
+    Record of what the previous publish produced, used to rebuild only changed notes.
+
+    Stored as JSON in Config.manifest_path:
+        {
+          "version": 3,
+          "converter": "<sha256 of this script>",
+          "options": {"image_variants": 1, "webp": false},
+          "notes": {
+            "publish/posts/Note.md": {
+              "stat": [size, mtime_ns],
+              "sha256": "...",
+              "output": "_posts/2024-12-20-note.md",
+              "images": {"assets/images/img.png": [size, mtime_ns]},
+              "published": ["assets/img/img.png"],
+              "links": {"turing machine": "_posts/2024-12-20-turing-machine.md", "draft": null}
+            }
+          }
+        }
+    Note paths are relative to the vault root, outputs and published images relative to the Jekyll root.
+    A note that failed to convert but whose previous output stays published keeps its entry,
+    with "failed": true (see keep_failed()). A failed note without such an output loses its
+    entry. The images a failed note published - in earlier runs, or in this one before the
+    conversion failed - are held under "held_images" (by note path, like "published") until
+    the note converts again or is deleted, so they are neither removed while the note is
+    broken nor forgotten by the image collection afterwards.
+    A manifest written by a different version of the converter, or with different options
+    (the command line switches that change the outputs), is ignored, since the outputs it
+    describes may no longer be what the converter would produce.
+    """
+    VERSION = 3
+
+    def __init__(self, path: Path = None, notes: Optional[dict] = None, options: Optional[dict] = None,
+                 held_images: Optional[dict] = None):
+        self.path = path
+        self.notes: dict[str, dict] = notes if notes is not None else {}
+        self.options: dict = options or {}
+        self.held_images: dict[str, list[str]] = held_images if held_images is not None else {}
+
+    @staticmethod
+    def converter_fingerprint() -> str:
+        """Digest of this script, computed once per process."""
+        global _converter_fingerprint
+        if _converter_fingerprint is None:
+            _converter_fingerprint = file_digest(Path(__file__))
+        return _converter_fingerprint
+
+    @classmethod
+    def load(cls, path: Path, options: Optional[dict] = None) -> "BuildManifest":
+        """Loads the manifest, falling back to an empty one when missing, corrupt or outdated."""
+        options = options or {}
+        try:
+            data = json.loads(Path(path).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return cls(path, options=options)
+        if not isinstance(data, dict) \
+                or data.get("version") != cls.VERSION \
+                or data.get("converter") != cls.converter_fingerprint() \
+                or data.get("options", {}) != options:
+            return cls(path, options=options)
+        return cls(path, data.get("notes", {}), options, data.get("held_images", {}))
+
+    @staticmethod
+    def recorded_images(path: Path) -> dict[str, set[Path]]:
+        """
+        Jekyll images (absolute) the manifest at path records as published or held, by note
+        key. Read whichever converter or options wrote the manifest, so that images published
+        by an outdated run can still be collected; empty when missing or corrupt.
+        """
+        try:
+            data = json.loads(Path(path).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        jekyll_root = get_config().jekyll_root
+        recorded = {}
+        notes = data.get("notes")
+        for key, entry in (notes.items() if isinstance(notes, dict) else ()):
+            if isinstance(entry, dict):
+                recorded.setdefault(key, set()).update(jekyll_root / image for image in entry.get("published", ()))
+        held_images = data.get("held_images")
+        for key, images in (held_images.items() if isinstance(held_images, dict) else ()):
+            recorded.setdefault(key, set()).update(jekyll_root / image for image in images)
+        return recorded
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "version": self.VERSION,
+            "converter": self.converter_fingerprint(),
+            "options": self.options,
+            "notes": self.notes,
+            "held_images": self.held_images,
+        }
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(data, indent=1, sort_keys=True), encoding='utf-8')
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def note_key(source_filepath: Path) -> str:
+        return vault_key(source_filepath)
+
+    def output_of(self, source_filepath: Path) -> Optional[Path]:
+        """Recorded output of a note (absolute), None if the note is not in the manifest."""
+        entry = self.notes.get(self.note_key(source_filepath))
+        if entry is None:
+            return None
+        return get_config().jekyll_root / entry["output"]
+
+    def is_up_to_date(self, source_filepath: Path, target_directory: Path, link_resolver: Optional["LinkResolver"] = None,
+                      signature: Optional[list[int]] = None) -> bool:
+        """
+        Decides whether the recorded output of a note can be kept as it is.
+
+        The note is considered changed when:
+        - it has never been converted, or was converted into a different directory
+        - its content hash differs (size/mtime are checked first, hash only when they differ)
+        - any image it references changed or disappeared
+        - any image it published is missing from the Jekyll site
+        - any wiki-link it contains resolves differently (target published, unpublished or renamed)
+        - its output file is missing
+        signature is the note's [size, mtime_ns] if the caller already knows it.
+        """
+        entry = self.notes.get(self.note_key(source_filepath))
+        if entry is None or entry.get("failed"):
+            return False
+        config = get_config()
+        output = config.jekyll_root / entry["output"]
+        if output.parent != Path(target_directory) or not output.is_file():
+            return False
+
+        signature = signature or stat_signature(source_filepath)
+        if signature is None:
+            return False
+        if signature != entry["stat"]:
+            if file_digest(source_filepath) != entry["sha256"]:
+                return False
+            # Touched but not modified - remember the new stat so the hash is not needed next time
+            entry["stat"] = signature
+
+        for image, image_signature in entry["images"].items():
+            if stat_signature(config.obsidian_root / image) != image_signature:
+                return False
+        for image in entry["published"]:
+            if not (config.jekyll_root / image).is_file():
+                return False
+        if link_resolver is not None:
+            for target, jekyll_file in entry["links"].items():
+                if link_resolver.lookup(target) != jekyll_file:
+                    return False
+        return True
+
+    def is_unaffected(self, source_filepath: Path, target_directory: Path, changed_keys: set[str],
+                      link_resolver: Optional["LinkResolver"] = None) -> bool:
+        """
+        is_up_to_date() for a note that is not among the changed paths of a restricted run.
+
+        Trusts the recorded state of everything that did not change, so only the output is
+        stat'ed: the note is affected when its output is gone, when it embeds a changed image
+        (changed_keys are vault_key()s) or when one of its wiki-links now resolves differently
+        (a linked note was renamed, re-slugged, published or deleted).
+        """
+        entry = self.notes.get(self.note_key(source_filepath))
+        if entry is None or entry.get("failed"):
+            return False
+        output = get_config().jekyll_root / entry["output"]
+        if output.parent != Path(target_directory) or not output.is_file():
+            return False
+        if not changed_keys.isdisjoint(entry["images"]):
+            return False
+        if link_resolver is not None:
+            for target, jekyll_file in entry["links"].items():
+                if link_resolver.lookup(target) != jekyll_file:
+                    return False
+        return True
+
+    def record(self, source_filepath: Path, output: Path, images: set[Path],
+               signature: Optional[list[int]] = None, digest: Optional[str] = None,
+               links: Optional[dict[str, Optional[str]]] = None, published_images: set[Path] = frozenset()):
+        """Stores the inputs and the outputs of a successful conversion."""
+        jekyll_root = get_config().jekyll_root
+        self.held_images.pop(self.note_key(source_filepath), None)
+        self.notes[self.note_key(source_filepath)] = {
+            "stat": signature or stat_signature(source_filepath),
+            "sha256": digest or file_digest(source_filepath),
+            "output": Path(output).relative_to(jekyll_root).as_posix(),
+            "images": {
+                vault_key(image): stat_signature(image)
+                for image in sorted(images)
+            },
+            "links": dict(sorted((links or {}).items())),
+            "published": sorted(Path(image).relative_to(jekyll_root).as_posix() for image in published_images),
+        }
+
+    def published_images(self) -> set[Path]:
+        """Jekyll images (absolute) linked from the outputs of all recorded notes, or held for failed notes."""
+        jekyll_root = get_config().jekyll_root
+        return {jekyll_root / image for entry in self.notes.values() for image in entry["published"]} \
+            | {jekyll_root / image for images in self.held_images.values() for image in images}
+
+    def keep_failed(self, source_filepath: Path, output: Optional[Path]) -> Optional[dict]:
+        """
+        Entry for a note that failed to convert whose previous output, still at output, stays
+        published (with its images), so links to the note keep working. Marked "failed", the
+        note is converted again by the next run. None if there is no such output.
+        """
+        entry = self.notes.get(self.note_key(source_filepath))
+        if entry is None or output is None or get_config().jekyll_root / entry["output"] != output \
+                or not output.is_file():
+            return None
+        return {**entry, "failed": True}
+
+    def forget(self, source_filepath: Path, held_images: set[Path] = frozenset()):
+        """Drops the entry of a note, holding held_images (see the class docstring) if there are any."""
+        self.notes.pop(self.note_key(source_filepath), None)
+        self.hold(source_filepath, held_images)
+
+    def hold(self, source_filepath: Path, images: set[Path]):
+        """Holds the Jekyll images (absolute) of a failed note, see the class docstring."""
+        key = self.note_key(source_filepath)
+        self.held_images.pop(key, None)
+        if images:
+            jekyll_root = get_config().jekyll_root
+            self.held_images[key] = sorted(Path(image).relative_to(jekyll_root).as_posix() for image in images)
+
+    def retain_only(self, source_filepaths):
+        """Drops entries of notes that no longer exist in the publish directory."""
+        keep = {self.note_key(filepath) for filepath in source_filepaths}
+        for key in list(self.notes):
+            if key not in keep:
+                del self.notes[key]
+        for key in list(self.held_images):
+            if key not in keep:
+                del self.held_images[key]
+
+def same_content(a: Path, b: Path) -> bool:
+    """Byte-wise comparison of two files (size first)."""
+    if os.stat(a).st_size != os.stat(b).st_size:
+        return False
+    with open(a, 'rb') as file_a, open(b, 'rb') as file_b:
+        while True:
+            chunk_a = file_a.read(1 << 16)
+            if chunk_a != file_b.read(1 << 16):
+                return False
+            if not chunk_a:
+                return True
+
+def apply_staged(staging_directory: Path, directory: JekyllPath, keep: set[Path] = frozenset(),
+                 removable: Optional[set[Path]] = None) -> dict[str, list[Path]]:
+    """
+    Makes directory match its staged version, touching only what actually changed.
+
+    - staged files missing in directory are moved in ("added")
+    - staged files whose content differs replace the live ones ("changed"), each through an atomic rename
+    - staged files identical to the live ones are dropped, the live file keeps its bytes and mtime ("unchanged")
+    - live files that were not staged and are not in keep are removed ("removed"); with removable
+      (a restricted run) only those files are candidates, directory is not walked
+
+    Returns:
+        Dictionary of the live paths per category
+    """
+    if not Path(directory).is_relative_to(get_config().jekyll_root):
+        raise RuntimeError("Trying to apply changes outside of this project! Aborted.")
+
+    changes = {"added": [], "changed": [], "unchanged": [], "removed": []}
+    staged = set()
+    for root, dirs, files in os.walk(staging_directory):
+        for name in files:
+            staged_path = Path(root) / name
+            live_path = Path(directory) / staged_path.relative_to(staging_directory)
+            staged.add(live_path)
+            if not live_path.exists():
+                live_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(staged_path, live_path)
+                changes["added"].append(live_path)
+            elif same_content(staged_path, live_path):
+                staged_path.unlink()
+                changes["unchanged"].append(live_path)
+            else:
+                os.replace(staged_path, live_path)
+                changes["changed"].append(live_path)
+    if removable is None:
+        changes["removed"] = prune_stale_outputs(directory, staged | set(keep))
+    else:
+        stale = sorted(Path(path) for path in set(removable) - staged - set(keep)
+                       if Path(path).is_relative_to(directory) and Path(path).is_file())
+        remove_files(stale, directory)
+        changes["removed"] = stale
+    return changes
+
+def extract_references(content: Union[str, Iterable[str]]) -> list[tuple[str, str]]:
+    """
+    Lists the links and embeds of a note (its text or chunks of it) as (kind, target) pairs.
+
+    Kinds:
+        "image"    - ![alt](target)
+        "link"     - [text](target)
+        "embed"    - ![[target|...]]
+        "wikilink" - [[target#heading|...]], target without the heading
+    """
+    scan = scan_references(content) if isinstance(content, str) else scan_reference_stream(content)
+    return [reference_of(kind, match) for kind, match in scan if kind is not None]
+
+def reference_of(kind: str, match: re.Match) -> tuple[str, str]:
+    """(kind, target) pair of extract_references() for a match of scan_references()."""
+    if kind == "md":
+        return ("image" if match.group(1) == '!' else "link", match.group(3))
+    if match.group(1) == '!':
+        return ("embed", match.group(2).split('|', 1)[0].strip())
+    return ("wikilink", WikiLink.parse(match.group(2)).target)
+
+class NoteRecord:
+    """What the vault index knows about a single note."""
+    __slots__ = ("path", "size", "mtime_ns", "front_matter", "slug", "slug_error", "refs")
+
+    def __init__(self, path: str, size: int, mtime_ns: int, front_matter: dict,
+                 slug: Optional[str], slug_error: Optional[str], refs: Optional[list[tuple[str, str]]]):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.front_matter = front_matter
+        self.slug = slug
+        # Reason slugify() rejected the note, if it did
+        self.slug_error = slug_error
+        # extract_references() of the note, None until the note has been read in full
+        self.refs = refs
+
+    def is_current(self, signature: Optional[list[int]]) -> bool:
+        """Whether the record still describes a file with the given [size, mtime_ns]."""
+        return signature == [self.size, self.mtime_ns]
+
+    @classmethod
+    def parse(cls, filepath: Path, references: bool = True) -> "NoteRecord":
+        """
+        Reads and parses a note. Notes larger than STREAM_THRESHOLD are read in chunks.
+
+        Without references only the front matter is read (refs is None), the conversion finds
+        the references while it transforms the note. A note that is not valid UTF-8 gets the
+        slug_error its conversion fails with.
+        """
+        metadata, refs, slug, slug_error = {}, None, None, None
+        with open(filepath, 'rb') as file:
+            st = os.fstat(file.fileno())
+            try:
+                if not references or st.st_size > STREAM_THRESHOLD:
+                    metadata = parse_front_matter(text_lines(file))
+                    if references:
+                        file.seek(0)
+                        refs = extract_references(read_text_chunks(file))
+                else:
+                    # Same decoding and newline handling as transfer_publish_file()
+                    text = file.read().decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+                    metadata = parse_front_matter(text)
+                    refs = extract_references(text)
+            except UnicodeDecodeError:
+                slug_error = "Note is not valid UTF-8."
+                refs = [] if references else None
+        if slug_error is None:
+            try:
+                slug = slugify(filepath, metadata)
+            except PublishTransformError as e:
+                slug_error = e.reason
+        return cls(vault_key(filepath), st.st_size, st.st_mtime_ns, metadata, slug, slug_error, refs)
+
+class VaultIndex:
+    """
+    Persistent SQLite index of the publish notes: front matter, slug, links and embeds.
+
+    refresh() re-parses only the notes whose size or mtime changed since they were indexed,
+    so an unchanged vault costs one stat per note. It reads only their front matter; the
+    references come from the conversion, which reads the whole note anyway (store_refs()).
+    Besides feeding the conversion, the index answers questions about the vault without
+    scanning it, e.g. notes_referencing("img.png") lists the notes that embed an image.
+    """
+    SCHEMA_VERSION = 4
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = Path(path or get_config().vault_index_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self._create_schema()
+
+    def _create_schema(self):
+        with self.connection:
+            self.connection.executescript(f"""
+                DROP TABLE IF EXISTS notes;
+                DROP TABLE IF EXISTS refs;
+                CREATE TABLE notes (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    front_matter TEXT NOT NULL,
+                    slug TEXT,
+                    slug_error TEXT,
+                    refs_known INTEGER NOT NULL
+                );
+                CREATE TABLE refs (
+                    note TEXT NOT NULL REFERENCES notes(path) ON DELETE CASCADE,
+                    kind TEXT NOT NULL,
+                    target TEXT NOT NULL
+                );
+                CREATE INDEX refs_note ON refs(note);
+                CREATE INDEX refs_target ON refs(target);
+                PRAGMA user_version = {self.SCHEMA_VERSION};
+            """)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def refresh(self, note_paths, signatures: Optional[dict[Path, list[int]]] = None, references: bool = False,
+                removed=None) -> int:
+        """
+        Brings the index in line with note_paths (the complete list of indexed notes).
+        signatures are the [size, mtime_ns] of the notes the caller already knows.
+        With references the changed notes are read in full, for their references too.
+        With removed (a restricted run), note_paths are only the notes that may have changed:
+        the notes of removed are dropped, the others are left as they are.
+
+        Returns:
+            Number of notes that had to be (re-)parsed
+        """
+        known = self.signatures()
+        signatures = signatures or {}
+        reparsed = 0
+        with self.connection:
+            for filepath in note_paths:
+                key = vault_key(filepath)
+                signature = known.pop(key, None)
+                if signature is not None and signature == (signatures.get(filepath) or stat_signature(filepath)):
+                    continue
+                self._store(NoteRecord.parse(filepath, references))
+                reparsed += 1
+            # Whatever was not listed has been deleted (or moved out of publish)
+            for key in known if removed is None else {vault_key(filepath) for filepath in removed} & known.keys():
+                self.connection.execute("DELETE FROM refs WHERE note = ?", (key,))
+                self.connection.execute("DELETE FROM notes WHERE path = ?", (key,))
+        return reparsed
+
+    def signatures(self) -> dict[str, list[int]]:
+        """[size, mtime_ns] of every indexed note, by vault_key()."""
+        return {path: [size, mtime_ns] for path, size, mtime_ns
+                in self.connection.execute("SELECT path, size, mtime_ns FROM notes")}
+
+    def _store(self, record: NoteRecord):
+        self.connection.execute("DELETE FROM refs WHERE note = ?", (record.path,))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO notes (path, size, mtime_ns, front_matter, slug, slug_error, refs_known) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (record.path, record.size, record.mtime_ns, json.dumps(record.front_matter), record.slug,
+             record.slug_error, record.refs is not None))
+        self.connection.executemany(
+            "INSERT INTO refs (note, kind, target) VALUES (?, ?, ?)",
+            [(record.path, kind, target) for kind, target in record.refs or ()])
+
+    def store_refs(self, filepath: Path, signature: list[int], refs: list[tuple[str, str]]) -> bool:
+        """
+        Records the references a conversion found in a note read as signature ([size, mtime_ns]).
+        Nothing is stored if the index describes a different version of the note.
+        """
+        key = vault_key(filepath)
+        with self.connection:
+            updated = self.connection.execute(
+                "UPDATE notes SET refs_known = 1 WHERE path = ? AND size = ? AND mtime_ns = ?", (key, *signature)).rowcount
+            if not updated:
+                return False
+            self.connection.execute("DELETE FROM refs WHERE note = ?", (key,))
+            self.connection.executemany("INSERT INTO refs (note, kind, target) VALUES (?, ?, ?)",
+                                        [(key, kind, target) for kind, target in refs])
+        return True
+
+    def get(self, filepath: Path) -> Optional[NoteRecord]:
+        key = vault_key(filepath)
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, front_matter, slug, slug_error, refs_known FROM notes WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, front_matter, slug, slug_error, refs_known = row
+        refs = [tuple(ref) for ref in self.connection.execute(
+            "SELECT kind, target FROM refs WHERE note = ? ORDER BY rowid", (key,))] if refs_known else None
+        return NoteRecord(key, size, mtime_ns, json.loads(front_matter), slug, slug_error, refs)
+
+    def records(self, filepaths) -> dict[Path, Optional[NoteRecord]]:
+        """get() for many notes at once, in two queries whatever their number."""
+        rows = {row[0]: row[1:] for row in self.connection.execute(
+            "SELECT path, size, mtime_ns, front_matter, slug, slug_error, refs_known FROM notes")}
+        refs: dict[str, list[tuple[str, str]]] = {}
+        for note, kind, target in self.connection.execute("SELECT note, kind, target FROM refs ORDER BY rowid"):
+            refs.setdefault(note, []).append((kind, target))
+        records = {}
+        for filepath in filepaths:
+            key = vault_key(filepath)
+            row = rows.get(key)
+            if row is None:
+                records[filepath] = None
+                continue
+            size, mtime_ns, front_matter, slug, slug_error, refs_known = row
+            records[filepath] = NoteRecord(key, size, mtime_ns, json.loads(front_matter), slug, slug_error,
+                                           refs.get(key, []) if refs_known else None)
+        return records
+
+    def notes_referencing(self, target: str, kinds=("embed", "image")) -> list[str]:
+        """Notes (vault-relative paths) with a reference of one of the kinds to target."""
+        placeholders = ", ".join("?" for _ in kinds)
+        return [path for (path,) in self.connection.execute(
+            f"SELECT DISTINCT note FROM refs WHERE target = ? AND kind IN ({placeholders}) ORDER BY note",
+            (target, *kinds))]
+
+def staged_changes(root: Path) -> set[Path]:
+    """
+    Paths (absolute) staged for the next commit in the git repository root is part of.
+
+    One `git diff --cached -z` call; added, modified and deleted files and both sides of
+    renames and copies are listed. Only paths under root are reported.
+    """
+    output = subprocess.run(["git", "-C", str(root), "diff", "--cached", "-z", "--name-status", "-M", "--relative"],
+                            check=True, capture_output=True).stdout
+    fields = output.split(b'\0')
+    changed = set()
+    i = 0
+    while i < len(fields) - 1:
+        status = fields[i].decode()
+        count = 2 if status[:1] in ('R', 'C') else 1
+        changed.update(Path(root) / os.fsdecode(path) for path in fields[i + 1:i + 1 + count])
+        i += 1 + count
+    return changed
+
+def prune_stale_outputs(directory: JekyllPath, keep: set[Path], dry_run: bool = False) -> list[Path]:
+    """
+    Removes every file in a Jekyll directory that is not in keep (outputs of deleted
+    or renamed notes, leftovers of failed conversions, images nothing links to anymore).
+    With dry_run nothing is removed, the files are only listed.
+
+    Returns:
+        List of removed files
+    """
+    if not Path(directory).is_relative_to(get_config().jekyll_root):
+        raise RuntimeError("Trying to remove contents outside of this project! Aborted.")
+
+    keep = {Path(path) for path in keep}
+    removed = []
+    for root, dirs, files in os.walk(directory, topdown=False):
+        for name in files:
+            path = Path(root) / name
+            if path not in keep:
+                if not dry_run:
+                    path.unlink()
+                removed.append(path)
+        for name in dirs:
+            path = Path(root) / name
+            if not dry_run and not any(path.iterdir()):
+                path.rmdir()
+    return sorted(removed)
+
+def prune_orphan_images(recorded: set[Path], keep: set[Path], dry_run: bool = False) -> list[Path]:
+    """
+    Removes the images an earlier run published (recorded) that no note links to anymore (not
+    in keep). Other files in the image directory - theme or hand-placed images - are never
+    touched. Directories left empty are removed. With dry_run nothing is removed, the images
+    are only listed.
+
+    Returns:
+        List of removed images
+    """
+    image_dir = get_config().jekyll_image_dir
+    orphans = sorted(Path(path) for path in set(recorded) - set(keep)
+                     if Path(path).is_relative_to(image_dir) and Path(path).is_file())
+    if not dry_run:
+        remove_files(orphans, image_dir)
+    return orphans
+
+def remove_files(paths: list[Path], directory: JekyllPath):
+    """Removes files of directory, then the subdirectories of directory they leave empty."""
+    if not Path(directory).is_relative_to(get_config().jekyll_root):
+        raise RuntimeError("Trying to remove contents outside of this project! Aborted.")
+    for path in paths:
+        path.unlink()
+        parent = path.parent
+        while parent != directory and parent.is_relative_to(directory) and not any(parent.iterdir()):
+            parent.rmdir()
+            parent = parent.parent
+
+# Words of the published text: letters and digits, accents are folded away (see search_terms())
+SEARCH_TOKEN = re.compile(r'[^\W_]+')
+# Liquid tags, kramdown attributes, HTML tags, link targets and bare URLs are not searchable text
+SEARCH_MARKUP = re.compile(r'\{%.*?%\}|\{\{.*?\}\}|\{:[^}\n]*\}|<[^>\n]+>|\]\([^)\n]*\)|https?://\S+')
+# Longer tokens are hashes, encoded data, ... rather than words
+SEARCH_MAX_TOKEN = 32
+# Light English stemming, the first matching suffix is replaced if at least 3 letters remain
+SEARCH_SUFFIXES = (("sses", "ss"), ("ies", "y"), ("ied", "y"), ("ingly", ""), ("edly", ""), ("ing", ""),
+                   ("ed", ""), ("ly", ""), ("s", ""))
+POSTED_DATE_PREFIX = re.compile(r'\d{4}-\d{2}-\d{2}-')
+
+def stem_term(word: str) -> str:
+    """
+    Strips the common English inflections of a lowercase word: "machines" -> "machine",
+    "copied" -> "copy", "running" -> "run". Words with digits or non-ASCII letters are kept.
+    """
+    if not (word.isascii() and word.isalpha()):
+        return word
+    for suffix, replacement in SEARCH_SUFFIXES:
+        if not word.endswith(suffix) or len(word) - len(suffix) < 3:
+            continue
+        if suffix == "s" and word.endswith(("ss", "us", "is")):
+            return word
+        stem = word[:-len(suffix)] + replacement
+        # "running" -> "runn" -> "run", but "falling" -> "fall"
+        if suffix in ("ing", "ed") and stem[-1] == stem[-2] and stem[-1] not in "aeioulsz":
+            stem = stem[:-1]
+        return stem
+    return word
+
+def search_terms(text: str) -> list[str]:
+    """Stemmed terms of a piece of published text, in order (their index is the position)."""
+    text = SEARCH_MARKUP.sub(" ", text)
+    text = "".join(char for char in unicodedata.normalize('NFKD', text.casefold()) if not unicodedata.combining(char))
+    return [stem_term(token) for token in SEARCH_TOKEN.findall(text) if len(token) <= SEARCH_MAX_TOKEN]
+
+def jekyll_title(slug: str) -> str:
+    """Title Jekyll gives a document without one in its front matter: "2024-12-20-turing-machine" -> "Turing Machine"."""
+    return " ".join(word.capitalize() for word in POSTED_DATE_PREFIX.sub("", slug, count=1).split("-") if word)
+
+class SearchIndex:
+    """
+    Inverted index of the published notes for a client-side search, written as JSON next to the images.
+
+    Config.jekyll_search_dir holds:
+        index.json   {"version": 1, "shard_prefix": 1, "shards": ["a", "b", ...],
+                      "docs": [{"slug": "2024-12-20-turing-machine", "title": "Turing machines and whatnot",
+                                "path": "_posts/2024-12-20-turing-machine.md"}, null, ...]}
+        <prefix>.json  {"machin": [[doc, position, delta, delta, ...], ...], ...}
+    A term lives in the shard named after its first shard_prefix characters, so a query downloads
+    index.json and one shard per term. A posting lists a document (its index in "docs") and the
+    term's positions there, each after the first as the distance from the previous one. The title
+    comes first, positions of the body continue after it. Terms are search_terms() of the text: the
+    client has to casefold, strip accents (NFKD without combining marks) and stem_term() its query
+    the same way.
+
+    The terms of every document are cached in Config.search_index_path, keyed by the output's path
+    and [size, mtime_ns]: only outputs that changed are read again and only the shards whose
+    content changed are rewritten. A document keeps its number as long as it is published, numbers
+    of removed documents are reused (their "docs" entry is null until then).
+    """
+    VERSION = 1
+    SHARD_PREFIX = 1
+
+    def __init__(self, path: Optional[Path] = None, docs: Optional[dict] = None):
+        self.path = path
+        # Jekyll path -> {"id", "stat", "slug", "title", "terms": {term: [positions]}}
+        self.docs: dict[str, dict] = docs if docs is not None else {}
+
+    @classmethod
+    def load(cls, path: Path) -> "SearchIndex":
+        """Loads the cached terms, falling back to an empty index when missing, corrupt or outdated."""
+        try:
+            data = json.loads(Path(path).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return cls(path)
+        if not isinstance(data, dict) \
+                or data.get("version") != cls.VERSION \
+                or data.get("converter") != BuildManifest.converter_fingerprint():
+            return cls(path)
+        return cls(path, data.get("docs", {}))
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = {"version": self.VERSION, "converter": BuildManifest.converter_fingerprint(), "docs": self.docs}
+        write_atomic(self.path, json.dumps(data, separators=(',', ':'), ensure_ascii=False))
+
+    @staticmethod
+    def parse(output: Path) -> dict:
+        """Title, slug and term positions of a published note, read line by line."""
+        with open(output, encoding='utf-8', errors='replace') as file:
+            first = file.readline()
+            if first.lstrip('\ufeff').rstrip() == "---":
+                metadata = parse_front_matter(itertools.chain([first], file))
+                lines = file
+            else:
+                metadata = {}
+                lines = itertools.chain([first], file)
+            slug = Path(output).stem
+            title = metadata.get("title")
+            title = title if isinstance(title, str) and title else jekyll_title(slug)
+            terms: dict[str, list[int]] = {}
+            position = 0
+            for text in itertools.chain([title], lines):
+                for term in search_terms(text):
+                    terms.setdefault(term, []).append(position)
+                    position += 1
+        return {"slug": slug, "title": title, "terms": terms}
+
+    def update(self, outputs: Iterable[Path]) -> int:
+        """
+        Makes the index describe exactly the given outputs (absolute paths in the Jekyll site).
+
+        Returns:
+            Number of outputs that were (re)read
+        """
+        jekyll_root = get_config().jekyll_root
+        docs = {}
+        parsed = 0
+        for output in sorted(outputs):
+            key = Path(output).relative_to(jekyll_root).as_posix()
+            signature = stat_signature(output)
+            if signature is None:
+                continue
+            entry = self.docs.get(key)
+            if entry is None or entry["stat"] != signature:
+                with span("search_index_note", "note", note=output):
+                    entry = {"id": entry["id"] if entry is not None else None, "stat": signature, **self.parse(output)}
+                parsed += 1
+            docs[key] = entry
+        taken = {entry["id"] for entry in docs.values() if entry["id"] is not None}
+        free = (number for number in itertools.count() if number not in taken)
+        for entry in docs.values():
+            if entry["id"] is None:
+                entry["id"] = next(free)
+        self.docs = docs
+        return parsed
+
+    def files(self) -> dict[str, str]:
+        """Content of the files in Config.jekyll_search_dir, by file name."""
+        listing = [None] * (max((entry["id"] for entry in self.docs.values()), default=-1) + 1)
+        shards: dict[str, dict[str, list[list[int]]]] = {}
+        for key, entry in sorted(self.docs.items(), key=lambda item: item[1]["id"]):
+            listing[entry["id"]] = {"slug": entry["slug"], "title": entry["title"], "path": key}
+            for term, positions in entry["terms"].items():
+                deltas = [positions[0]] + [b - a for a, b in zip(positions, positions[1:])]
+                shards.setdefault(term[:self.SHARD_PREFIX], {}).setdefault(term, []).append([entry["id"], *deltas])
+
+        def dump(data) -> str:
+            return json.dumps(data, separators=(',', ':'), ensure_ascii=False, sort_keys=True)
+        files = {f"{prefix}.json": dump(shard) for prefix, shard in shards.items()}
+        files["index.json"] = dump({"version": self.VERSION, "shard_prefix": self.SHARD_PREFIX,
+                                    "shards": sorted(shards), "docs": listing})
+        return files
+
+    def write(self, directory: Path) -> dict[str, list[Path]]:
+        """
+        Writes the index into directory, leaving files whose content did not change untouched
+        and removing the shards the previous index.json listed that are no longer needed.
+        Other files of directory are never touched.
+
+        Returns:
+            The "written" and "removed" files
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        try:
+            previous = json.loads((directory / "index.json").read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            previous = {}
+        shards = previous.get("shards") if isinstance(previous, dict) else None
+        stale = {f"{prefix}.json" for prefix in (shards if isinstance(shards, list) else ())
+                 if isinstance(prefix, str) and prefix and Path(prefix).name == prefix}
+        files = self.files()
+        changes = {"written": [], "removed": []}
+        for name, content in sorted(files.items()):
+            path = directory / name
+            try:
+                if path.read_bytes() == content.encode('utf-8'):
+                    continue
+            except FileNotFoundError:
+                pass
+            write_atomic(path, content)
+            changes["written"].append(path)
+        for name in sorted(stale - files.keys()):
+            path = directory / name
+            if path.is_file():
+                path.unlink()
+                changes["removed"].append(path)
+        return changes
+
+class NoteResult:
+    """Outcome of converting a single note. Picklable, so it can come back from a worker process."""
+    __slots__ = ("source", "target_directory", "output", "context", "error", "trace_events")
+
+    def __init__(self, source: Path, target_directory: Path, output: Optional[Path] = None,
+                 context: Optional[ConversionContext] = None, error: Optional[PublishTransformError] = None):
+        self.source = source
+        self.target_directory = target_directory
+        self.output = output
+        self.context = context
+        self.error = error
+        # Profiler events recorded by a worker process
+        self.trace_events: list[dict] = []
+
+def convert_note(source_filepath: Path, target_directory: Path, image_sync: Optional[ImageSync] = None,
+                 record: Optional[NoteRecord] = None, link_resolver: Optional[LinkResolver] = None,
+                 attachments: Optional[AttachmentIndex] = None) -> NoteResult:
+    """
+    Runs transfer_publish_file(), capturing a PublishTransformError into the result.
+    A failed result keeps its context too, for the images published before the failure.
+    """
+    context = ConversionContext(image_sync, record, link_resolver, attachments)
+    output, error = None, None
+    try:
+        output = transfer_publish_file(source_filepath, target_directory, context)
     except PublishTransformError as e:
-        #Remove the already copied file from the Jekyll directory
-        dst.unlink()
-        raise e
+        error = e
+    # Per process / per run state, known to the caller
+    context.image_sync = None
+    context.record = None
+    context.link_resolver = None
+    context.attachments = None
+    return NoteResult(source_filepath, target_directory, output, context, error)
+
+def settle_images(result: NoteResult) -> NoteResult:
+    """
+    Waits for the background image copies a converted note depends on (see CopyScheduler).
 
-def main():
+    The copies are counted into the note's context. If one failed, the note fails with a
+    PublishTransformError naming the image, and its output is removed. The copies of a note
+    that failed already are only waited for.
+    """
+    context = result.context
+    if context is None or not context.image_jobs:
+        return result
+    jobs, context.image_jobs = context.image_jobs, []
+    if result.error is not None:
+        for job, _ in jobs:
+            job.future.exception()
+        return result
+    failure = None
+    for job, submitted in jobs:
+        try:
+            copied = job.future.result()
+        except PublishTransformError as error:
+            failure = failure or error.reason
+            continue
+        except Exception as error:
+            # Whatever a copy thread raised fails only this note, never the whole run
+            failure = failure or f"Publishing image {job.src} to {job.dst} failed: {error}"
+            continue
+        if submitted and copied:
+            context.images_copied += 1
+            context.images_bytes += os.stat(job.dst).st_size
+        else:
+            context.images_skipped += 1
+    if failure is None:
+        return result
+    result.output.unlink(missing_ok=True)
+    return NoteResult(result.source, result.target_directory, context=context,
+                      error=PublishTransformError(str(result.source), failure))
+
+# Per run state of a worker process, shared by all notes the worker converts
+_worker_image_sync: Optional[ImageSync] = None
+_worker_link_resolver: Optional[LinkResolver] = None
+_worker_attachments: Optional[AttachmentIndex] = None
+
+def _init_worker(profile: bool = False, link_images: bool = False, link_resolver: Optional[LinkResolver] = None,
+                 attachments: Optional[AttachmentIndex] = None, optimizer: Optional[ImageOptimizer] = None,
+                 config: Optional[Config] = None):
+    global _worker_image_sync, _worker_link_resolver, _worker_attachments
+    configure(config)  # Spawned workers would otherwise fall back to the default configuration
+    # No CopyScheduler: a worker returns a note only once its images are published, so it copies
+    # them as it goes and leaves no copy thread behind when the pool shuts down
+    _worker_image_sync = ImageSync(link_images, optimizer)
+    _worker_link_resolver = link_resolver
+    _worker_attachments = attachments
+    set_profiler(Profiler() if profile else None)
+
+def _convert_note_in_worker(note: Note, target_directory: Path) -> NoteResult:
+    result = convert_note(note.path, target_directory, _worker_image_sync, note.record,
+                          _worker_link_resolver, _worker_attachments)
+    if _profiler is not None:
+        result.trace_events = _profiler.drain()
+    return result
+
+def convert_notes(tasks: list[tuple[Union[Note, Path], Path]], jobs: int = 1, records: Optional[dict[Path, NoteRecord]] = None,
+                  link_images: bool = False, link_resolver: Optional[LinkResolver] = None,
+                  attachments: Optional[AttachmentIndex] = None, optimizer: Optional[ImageOptimizer] = None):
+    """
+    Converts (note, target directory) pairs, yielding a NoteResult per task in task order.
+
+    Notes can be given as Note objects, carrying their vault index record, or as paths with
+    the records, if available, in records.
+    link_images hard links images into the Jekyll site instead of copying them.
+    link_resolver turns wiki-links to published notes into links.
+    attachments resolves image embeds by name anywhere in the vault.
+    optimizer publishes downscaled, recompressed variants of the images.
+
+    In a single process images are published by a CopyScheduler while the notes are
+    transformed: every note is converted first and the copies are waited for once, at the
+    end. A note whose image could not be published is yielded as failed.
+
+    With jobs > 1 the notes are converted in a process pool, each worker copies a note's
+    images while converting it. Results are still yielded in task order, so the progress
+    output is the same for every run. Notes of different workers may copy the same image at
+    the same time - copy_file() writes through a rename, so the image in the Jekyll directory
+    is always complete.
+    """
+    records = records or {}
+    notes = [source if isinstance(source, Note) else Note(source, record=records.get(source)) for source, _ in tasks]
+    targets = [target_directory for _, target_directory in tasks]
+    if jobs <= 1 or len(tasks) <= 1:
+        with CopyScheduler() as scheduler:
+            image_sync = ImageSync(link_images, optimizer, scheduler)
+            results = [convert_note(note.path, target_directory, image_sync, note.record, link_resolver, attachments)
+                       for note, target_directory in zip(notes, targets)]
+            with span("wait_for_images"):
+                scheduler.wait()
+        for result in results:
+            yield settle_images(result)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), initializer=_init_worker,
+                             initargs=(_profiler is not None, link_images, link_resolver, attachments, optimizer,
+                                       get_config())) as executor:
+        for result in executor.map(_convert_note_in_worker, notes, targets):
+            if _profiler is not None:
+                _profiler.events.extend(result.trace_events)
+            yield result
+
+def parse_jobs(value: str) -> int:
+    """--jobs value: a positive number or "auto" (number of usable CPUs)."""
+    if value == "auto":
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return os.cpu_count() or 1
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive number or 'auto', got '{value}'")
+    return jobs
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Converts the Obsidian publish directory into the Jekyll site.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Rebuild only notes whose content or images changed since the last run (uses the build manifest).")
+    parser.add_argument("--jobs", "-j", type=parse_jobs, default=1, metavar="N|auto",
+                        help="Number of notes converted in parallel (default: 1).")
+    parser.add_argument("--profile", type=Path, nargs="?", const=True, metavar="DIR",
+                        help="Time the conversion stages, write summary.json and a Chrome/Perfetto trace.json to DIR "
+                             "(default: profile/ in the cache directory).")
+    parser.add_argument("--link-images", action="store_true",
+                        help="Hard link images into the Jekyll site instead of copying them "
+                             "(falls back to copying when the vault and the site are on different filesystems).")
+    parser.add_argument("--optimize-images", action="store_true",
+                        help="Publish images downscaled to the size they are embedded with and recompressed "
+                             "(needs Pillow, variants are cached in images/ in the cache directory).")
+    parser.add_argument("--webp", action="store_true", help="With --optimize-images, publish the variants as WebP.")
+    changes = parser.add_mutually_exclusive_group()
+    changes.add_argument("--staged", action="store_true",
+                         help="Convert (or, with --check, check) only the notes affected by the changes staged in git "
+                              "(implies --incremental).")
+    changes.add_argument("--changed", type=Path, nargs="+", metavar="PATH",
+                         help="Convert (or, with --check, check) only the notes affected by these changed paths "
+                              "(implies --incremental).")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="List the images in the Jekyll image directory no published note links to "
+                             "instead of removing them.")
+    parser.add_argument("--check", action="store_true",
+                        help="Only check the publish notes - missing images, post front matter and slug collisions "
+                             "are errors, links that become plain text warnings - and report the problems; writes "
+                             "nothing, exits with 1 on errors.")
+    paths = parser.add_argument_group("paths", f"Default to the {Config.ENV_PREFIX}<NAME> environment variables, "
+                                               "then to the layout around this script.")
+    paths.add_argument("--config", type=Path, metavar="FILE",
+                       help=f"JSON file with the paths below as keys (default: ${Config.ENV_PREFIX}CONFIG), "
+                            "relative paths are relative to the file.")
+    for field in Config.FIELDS:
+        paths.add_argument(f"--{field.replace('_', '-')}", type=Path, metavar="DIR")
+
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    watch_parser = commands.add_parser("watch", help="Keep converting changed notes and images until interrupted (always incremental).")
+    watch_parser.add_argument("--debounce", type=float, default=0.2, metavar="SECONDS",
+                              help="Quiet period that ends a burst of changes (default: 0.2).")
+    watch_parser.add_argument("--poll", action="store_true", help="Poll for changes instead of using inotify.")
+    watch_parser.add_argument("--interval", type=float, default=0.5, metavar="SECONDS",
+                              help="Polling interval (default: 0.5).")
+    stats_parser = commands.add_parser("stats", help="Show the recorded publish runs, their trends and the runs that "
+                                                     "got significantly slower.")
+    stats_parser.add_argument("--last", type=int, default=20, metavar="N", help="Number of runs listed (default: 20).")
+    stats_parser.add_argument("--window", type=int, default=10, metavar="N",
+                              help="Runs of the same mode the baseline is the median of (default: 10).")
+    stats_parser.add_argument("--threshold", type=float, default=1.5, metavar="FACTOR",
+                              help="How many times the baseline a run must take to be flagged (default: 1.5).")
+    args = parser.parse_args(argv)
+    if args.webp and not args.optimize_images:
+        parser.error("--webp requires --optimize-images")
+    if args.optimize_images and pillow() is None:
+        parser.error("--optimize-images needs Pillow (pip install Pillow)")
+    if args.check and args.command is not None:
+        parser.error(f"--check cannot be combined with {args.command}")
+    return args
+
+class RunHistory:
+    """
+    Record of the publish runs, one JSON object per line, newest last.
+
+    A run is appended with a single write, so an interrupted run never corrupts earlier ones;
+    lines that do not parse are skipped. Once the file grows past MAX_BYTES only its newer
+    half is kept.
+
+    Each record holds the time, the mode ("full", "incremental" or "changed" for --staged and
+    --changed), jobs, duration_ms, the top level stages (ms, see RunStats) and the COUNTERS.
+    """
+    COUNTERS = ("notes", "converted", "skipped", "failed", "images_copied", "images_skipped", "bytes_written")
+    MAX_BYTES = 1 << 20
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def append(self, run: dict):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(run, separators=(',', ':')) + '\n')
+            size = file.tell()
+        if size > self.MAX_BYTES:
+            runs = self.load()
+            write_atomic(self.path, "".join(json.dumps(run, separators=(',', ':')) + '\n'
+                                            for run in runs[len(runs) // 2:]))
+
+    def load(self) -> list[dict]:
+        try:
+            text = self.path.read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return []
+        runs = []
+        for line in text.splitlines():
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(run, dict) and isinstance(run.get("duration_ms"), (int, float)):
+                runs.append(run)
+        return runs
+
+def run_kind(run: dict) -> str:
+    """Runs are only compared with runs of the same kind: mode and number of jobs."""
+    jobs = run.get("jobs", 1)
+    return run.get("mode", "full") + (f" -j{jobs}" if jobs != 1 else "")
+
+def median(values: list[float]) -> float:
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+def find_regressions(runs: list[dict], window: int = 10, threshold: float = 1.5, min_runs: int = 3,
+                     min_ms: float = 50.0) -> dict[int, tuple[float, Optional[str]]]:
+    """
+    Runs that were significantly slower than the rolling baseline.
+
+    The baseline of a run is the median duration of the previous `window` runs of the same kind
+    (a full run is never compared with an incremental one, see run_kind()), known once there are `min_runs` of
+    them. A run is slower when it took more than `threshold` times the baseline and at least
+    `min_ms` longer - tiny incremental runs are all noise.
+
+    Returns:
+        Index of each slower run -> (its baseline in ms, the stage that grew the most)
+    """
+    previous: dict[str, list[dict]] = {}
+    regressions = {}
+    for index, run in enumerate(runs):
+        earlier = previous.setdefault(run_kind(run), [])[-window:]
+        if len(earlier) >= min_runs:
+            baseline = median([other["duration_ms"] for other in earlier])
+            if run["duration_ms"] > threshold * baseline and run["duration_ms"] - baseline >= min_ms:
+                growth = {name: elapsed - median([other.get("stages", {}).get(name, 0.0) for other in earlier])
+                          for name, elapsed in run.get("stages", {}).items()}
+                regressions[index] = (baseline, max(growth, key=growth.get) if growth else None)
+        previous[run_kind(run)].append(run)
+    return regressions
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def format_duration(ms: float) -> str:
+    return f"{ms:.0f} ms" if ms < 1000 else f"{ms / 1000:.2f} s"
+
+def print_stats(runs: list[dict], last: int = 20, window: int = 10, threshold: float = 1.5):
+    """Prints the last runs, how the runs of each kind changed over the history and the runs that got slower."""
+    if not runs:
+        print("No runs recorded yet, the history starts with the next publish.")
+        return
+    regressions = find_regressions(runs, window, threshold)
+    print(f"{len(runs)} runs since {runs[0].get('time', '?')}")
+    print(f"{'time':<19}  {'mode':<11} {'jobs':>4} {'duration':>9} {'notes':>6} {'conv':>5} {'skip':>5} {'fail':>4} "
+          f"{'img+':>5} {'img=':>5} {'written':>9}")
+    for index in range(max(0, len(runs) - last), len(runs)):
+        run = runs[index]
+        print(f"{run.get('time', '?'):<19}  {run.get('mode', '?'):<11} {run.get('jobs', 1):>4} "
+              f"{format_duration(run['duration_ms']):>9} {run.get('notes', 0):>6} {run.get('converted', 0):>5} "
+              f"{run.get('skipped', 0):>5} {run.get('failed', 0):>4} {run.get('images_copied', 0):>5} "
+              f"{run.get('images_skipped', 0):>5} {format_size(run.get('bytes_written', 0)):>9}")
+        if index in regressions:
+            baseline, stage = regressions[index]
+            print(f"    ^ {run['duration_ms'] / baseline:.1f}x slower than the baseline of {format_duration(baseline)}"
+                  + (f", mostly in {stage}" if stage else ""))
+
+    print("Trends (first -> last run of each kind):")
+    kinds: dict[str, list[dict]] = {}
+    for run in runs:
+        kinds.setdefault(run_kind(run), []).append(run)
+    for kind, kind_runs in kinds.items():
+        first, latest = kind_runs[0], kind_runs[-1]
+        change = (latest["duration_ms"] / first["duration_ms"] - 1) * 100 if first["duration_ms"] else 0.0
+        print(f"  {kind:<16} {len(kind_runs):>4} runs, {format_duration(first['duration_ms'])} -> "
+              f"{format_duration(latest['duration_ms'])} ({change:+.0f}%), "
+              f"{first.get('notes', 0)} -> {latest.get('notes', 0)} notes")
+    print(f"{len(regressions)} run(s) more than {threshold}x slower than the median of the previous {window} "
+          f"runs of the same kind")
+
+def publish(incremental: bool = False, jobs: int = 1, profile: Optional[Path] = None, link_images: bool = False,
+            optimize_images: bool = False, webp: bool = False, dry_run: bool = False,
+            changed: Optional[set[Path]] = None):
+    """
+    Converts the publish directory into the Jekyll site.
+
+    Args:
+        incremental: rebuild only notes whose inputs changed since the last run
+        jobs: number of notes converted in parallel
+        profile: directory to write the stage timings (summary.json) and a Chrome trace (trace.json) to
+        link_images: hard link images into the Jekyll site instead of copying them
+        optimize_images: publish downscaled, recompressed image variants (see ImageOptimizer)
+        webp: publish the image variants as WebP
+        dry_run: only report the orphan images instead of removing them
+        changed: absolute paths known to have changed (e.g. staged_changes()), the run is then
+                 incremental and checks only the notes these paths can affect
+
+    Every completed run is appended to the run history (see RunHistory).
+    """
+    config = get_config().validate()
+    optimizer = ImageOptimizer(config.cache_dir / "images", webp) if optimize_images else None
+    profiler = Profiler() if profile is not None else None
+    stats = RunStats()
+    set_profiler(profiler)
+    set_run_stats(stats)
+    started = time.perf_counter_ns()
+    try:
+        with profiler.span("publish") if profiler is not None else _NO_SPAN:
+            counters = _publish(incremental, jobs, link_images, optimizer, dry_run, changed)
+    finally:
+        set_profiler(None)
+        set_run_stats(None)
+    duration = time.perf_counter_ns() - started
+    mode = "changed" if changed is not None else "incremental" if incremental else "full"
+    try:
+        RunHistory(config.history_path).append({
+            "time": datetime.now().isoformat(sep=" ", timespec="seconds"), "mode": mode, "jobs": jobs,
+            "duration_ms": round(duration / 1e6, 3), "stages": stats.stages_ms(), **counters})
+    except OSError as error:
+        print(f"Could not record the run in {config.history_path}: {error}")
+    if profiler is None:
+        return
+
+    summary_path, trace_path = profiler.write(profile)
+    print("Stage timings (ms):")
+    for name, stage in sorted(profiler.summary().items(), key=lambda item: -item[1]["total_ms"]):
+        print(f"  {name:<24} {stage['total_ms']:>10.1f} total {stage['max_ms']:>9.1f} max {stage['count']:>6}x")
+    print(f"Profile written to {summary_path} and {trace_path}")
+
+def _publish(incremental: bool, jobs: int, link_images: bool, optimizer: Optional[ImageOptimizer] = None,
+             dry_run: bool = False, changed: Optional[set[Path]] = None) -> dict[str, int]:
+    """publish() without the profiling and the run history, returns the RunHistory.COUNTERS of the run."""
     print("Starting the trasnfer process...")
-    publish_subdirectories = get_publish_subdirectories()
+    config = get_config()
+    if changed is not None:
+        # Notes outside of the changed paths are trusted to be as the manifest recorded them
+        incremental = True
+        changed_keys = {vault_key(path) for path in changed if path.is_relative_to(config.obsidian_root)}
+        print(f"Restricted to {len(changed_keys)} changed path(s)")
+    with span("discovery"):
+        ignore = PublishIgnore.load(config.publish_dir)
+        publish_subdirectories = get_publish_subdirectories(config.publish_dir, ignore)
     print(f"Found {len(publish_subdirectories)} publish subdirectories: {publish_subdirectories}")
 
-    for publish_subdirectory in publish_subdirectories:
-        jekyll_subdirectory = get_jekyll_directory(publish_subdirectory)
-
-        #2. remove contents of that jekkyl subdirectory
-        remove_contents_of(jekyll_subdirectory)
-        publish_files = get_directory_md_files(publish_subdirectory)
-        
+    # A full run starts from an empty manifest so that every note gets converted; what the
+    # previous run published is still needed for the notes that fail in this one
+    options = optimizer.settings() if optimizer is not None else {}
+    previous = BuildManifest.load(config.manifest_path, options)
+    recorded_images = BuildManifest.recorded_images(config.manifest_path)
+    manifest = previous if incremental else BuildManifest(config.manifest_path, options=options)
+    notes: list[Note] = []
+    # Expected content of each Jekyll subdirectory after the run
+    outputs: dict[Path, set[Path]] = {}
+    # Notes are converted into a staging copy of each Jekyll subdirectory, the live one is
+    # only touched when the staged result is applied
+    staging_of: dict[Path, Path] = {}
+    live_of: dict[Path, Path] = {}
+    tasks = []
+    counters = dict.fromkeys(RunHistory.COUNTERS, 0)
+
+    if config.jekyll_staging_dir.exists():
+        shutil.rmtree(config.jekyll_staging_dir)  # Leftover of an interrupted run
+
+    # A restricted run takes the unchanged notes from the vault index instead of walking the
+    # publish directory, unless the ignore rules changed or the index knows no notes yet
+    known = None
+    if changed is not None and config.publish_dir / ".publishignore" not in changed:
+        with span("vault_index"), VaultIndex(config.vault_index_path) as index:
+            known = index.signatures() or None
+
+    collections = []
+    with span("discovery"):
+        for publish_subdirectory in publish_subdirectories:
+            jekyll_subdirectory = get_jekyll_directory(publish_subdirectory, config.jekyll_root, config.publish_dir)
+            outputs[jekyll_subdirectory] = set()
+            staging_subdirectory = config.jekyll_staging_dir / jekyll_subdirectory.relative_to(config.jekyll_root)
+            staging_subdirectory.mkdir(parents=True)
+            staging_of[jekyll_subdirectory] = staging_subdirectory
+            live_of[staging_subdirectory] = jekyll_subdirectory
+
+            # The notes carry [size, mtime_ns] from the walk, so the index and the manifest need not stat again
+            if known is None:
+                collection_notes = list(walk_publish_tree(publish_subdirectory, ignore, jekyll_subdirectory))
+            else:
+                collection_notes = changed_publish_tree(publish_subdirectory, ignore, jekyll_subdirectory, known, changed)
+            notes.extend(collection_notes)
+            collections.append((publish_subdirectory, jekyll_subdirectory, collection_notes))
+    all_publish_files = [note.path for note in notes]
+
+    # Front matter, slugs and references of unchanged notes come from the vault index
+    with span("vault_index"), VaultIndex(config.vault_index_path) as index:
+        if known is None:
+            reparsed = index.refresh(all_publish_files, {note.path: note.signature for note in notes})
+        else:
+            gone = {path for path in changed if path.is_relative_to(config.publish_dir)} - set(all_publish_files)
+            reparsed = index.refresh([path for path in all_publish_files if path in changed],
+                                     {note.path: note.signature for note in notes}, removed=gone)
+        records = index.records(all_publish_files)
+    for note in notes:
+        note.record = records[note.path]
+    print(f"Vault index: {reparsed}/{len(all_publish_files)} notes re-indexed")
+    reject_output_clashes(notes)
+
+    with span("link_resolver"):
+        link_resolver = LinkResolver.from_notes(notes)
+    with span("attachment_index"):
+        if changed is not None:
+            attachments = AttachmentIndex.lazy(config.obsidian_root, config.obsidian_image_dir)
+        else:
+            attachments = AttachmentIndex.build(config.obsidian_root, config.obsidian_image_dir)
+    for name, paths in sorted(attachments.collisions.items()):
+        print(f"Warning: {len(paths)} attachments named '{name}', embeds by name use {attachments.resolve(name)}")
+
+    with span("up_to_date_check"):
+        for publish_subdirectory, jekyll_subdirectory, collection_notes in collections:
+            skipped = 0
+            for note in collection_notes:
+                if note.target is None:
+                    unchanged = False  # Fails to convert, see reject_output_clashes()
+                elif changed is not None and note.path not in changed:
+                    unchanged = manifest.is_unaffected(note.path, jekyll_subdirectory, changed_keys, link_resolver)
+                else:
+                    unchanged = incremental and manifest.is_up_to_date(note.path, jekyll_subdirectory, link_resolver,
+                                                                       note.signature)
+                if unchanged:
+                    outputs[jekyll_subdirectory].add(manifest.output_of(note.path))
+                    skipped = skipped+1
+                else:
+                    tasks.append((note, staging_of[jekyll_subdirectory]))
+            counters["skipped"] += skipped
+            if incremental:
+                print(f"Up to date: {skipped}/{len(collection_notes)} notes in {publish_subdirectory.name}")
+
+    converted = {note.path for note, _ in tasks}
+    # Outputs a restricted run may remove: those of the notes it converts and of the changed notes that are gone
+    removable = None
+    if changed is not None:
+        gone = {path for path in changed if path.is_relative_to(config.publish_dir)} - set(all_publish_files)
+        removable = {manifest.output_of(path) for path in itertools.chain(converted, gone)} - {None}
+    try:
         #3. create jekyll-friendly files from the obsidian files and move them to appropriate places
-        published = 0
-        for publish_file in publish_files:
-            try:
-                transfer_publish_file(publish_file, jekyll_subdirectory)
+        failures = []
+        # References the conversion found in notes the vault index has only the front matter of
+        found_refs = []
+        images_copied = 0
+        images_skipped = 0
+        notes_by_path = {note.path: note for note in notes}
+        while tasks:
+            failed_targets = set()
+            with span("convert"):
+                for published, result in enumerate(convert_notes(tasks, jobs, None, link_images, link_resolver, attachments, optimizer), start=1):
+                    if result.error is not None:
+                        failures.append(result.error)
+                        print(f"Transfering failed for {result.error.filepath}")
+                        print(f"Reason: {result.error.reason}")
+                        target = notes_by_path[result.source].target
+                        kept = previous.keep_failed(result.source, target.path if target is not None else None)
+                        # The previous images of the note and those it published before failing
+                        # stay until it converts again
+                        held = recorded_images.get(manifest.note_key(result.source), set()) \
+                            | (result.context.published_images if result.context is not None else set())
+                        if kept:
+                            manifest.notes[manifest.note_key(result.source)] = kept
+                            manifest.hold(result.source, held)
+                            outputs[target.collection].add(target.path)
+                        else:
+                            manifest.forget(result.source, held)
+                            if target is not None:
+                                failed_targets.add(target.jekyll_file)
+                        continue
+                    context = result.context
+                    jekyll_subdirectory = live_of[result.target_directory]
+                    output = jekyll_subdirectory / result.output.relative_to(result.target_directory)
+                    manifest.record(result.source, output, context.images, context.source_stat, context.source_digest,
+                                    context.links, context.published_images)
+                    outputs[jekyll_subdirectory].add(output)
+                    if records[result.source] is None or records[result.source].refs is None:
+                        found_refs.append((result.source, context.source_stat, context.refs))
+                    images_copied += context.images_copied
+                    images_skipped += context.images_skipped
+                    counters["bytes_written"] += context.images_bytes
+                    print(f"Transfered {result.source}. [{published}/{len(tasks)}]")
+
+            # Links to a note that failed and has no earlier output would break the Jekyll build,
+            # the notes with such links are converted again with the links reduced to their text
+            tasks = []
+            if not failed_targets:
+                break
+            link_resolver = link_resolver.without(failed_targets)
+            for note in notes:
+                entry = manifest.notes.get(manifest.note_key(note.path))
+                if entry is None or entry.get("failed") or failed_targets.isdisjoint(entry["links"].values()):
+                    continue
+                if note.path not in converted:
+                    counters["skipped"] -= 1
+                outputs[note.collection].discard(manifest.output_of(note.path))
+                tasks.append((note, staging_of[note.collection]))
+            converted.update(note.path for note, _ in tasks)
+            print(f"Converting {len(tasks)} note(s) again without the links to {', '.join(sorted(failed_targets))}")
+
+        #4. apply the staged subdirectories - only real additions, changes and removals touch the live site
+        for jekyll_subdirectory, staging_subdirectory in staging_of.items():
+            with span("apply_staged", directory=jekyll_subdirectory):
+                changes = apply_staged(staging_subdirectory, jekyll_subdirectory, outputs[jekyll_subdirectory], removable)
+            for removed in changes["removed"]:
+                print(f"Removed stale {removed}")
+            counters["bytes_written"] += sum(os.stat(path).st_size for path in changes["added"] + changes["changed"])
+            print(f"{jekyll_subdirectory.name}: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+                  f"{len(changes['removed'])} removed, {len(changes['unchanged'])} unchanged")
+    finally:
+        shutil.rmtree(config.jekyll_staging_dir, ignore_errors=True)
+
+    if found_refs:
+        with span("vault_index"), VaultIndex(config.vault_index_path) as index:
+            for source, signature, refs in found_refs:
+                index.store_refs(source, signature, refs)
+
+    print(f"Images: {images_copied} copied, {images_skipped} already up to date")
+    counters.update(notes=len(notes), converted=len(converted) - len(failures), failed=len(failures),
+                    images_copied=images_copied, images_skipped=images_skipped)
+    if failures:
+        print(f"{len(failures)} note(s) failed to transfer:")
+        for error in failures:
+            print(f"  {error.filepath}: {error.reason}")
+    with span("manifest"):
+        manifest.retain_only(all_publish_files)
+
+    #5. images that no published note links to anymore (deleted or edited notes) are removed from the site
+    with span("image_gc"):
+        orphans = prune_orphan_images(set().union(*recorded_images.values()),
+                                      manifest.published_images(), dry_run)
+    for orphan in orphans:
+        print(f"{'Orphan' if dry_run else 'Removed orphan'} image {orphan.relative_to(config.jekyll_root)}")
+    if orphans:
+        print(f"Images: {len(orphans)} orphan(s) {'found, rerun without --dry-run to remove them' if dry_run else 'removed'}")
+
+    with span("manifest"):
+        manifest.save()
+
+    #6. the search index covers every published note, only outputs that changed are read again
+    with span("search_index"):
+        search_index = SearchIndex.load(config.search_index_path) if incremental else SearchIndex(config.search_index_path)
+        reindexed = search_index.update(itertools.chain.from_iterable(outputs.values()))
+        search_changes = search_index.write(config.jekyll_search_dir)
+        search_index.save()
+    counters["bytes_written"] += sum(os.stat(path).st_size for path in search_changes["written"])
+    print(f"Search index: {reindexed}/{len(search_index.docs)} notes re-indexed, "
+          f"{len(search_changes['written'])} file(s) written, {len(search_changes['removed'])} removed")
+    return counters
+
+class CheckProblem:
+    """A problem check() found in a note. Errors fail the check, warnings are only reported."""
+    __slots__ = ("source", "message", "error")
+
+    def __init__(self, source: Path, message: str, error: bool = True):
+        self.source = source
+        self.message = message
+        self.error = error
+
+    def __repr__(self) -> str:
+        return f"CheckProblem({str(self.source)!r}, {self.message!r}, error={self.error})"
+
+def check_notes(notes: list[Note], attachments: AttachmentIndex, link_resolver: LinkResolver,
+                src_dir: Optional[Path] = None) -> list[CheckProblem]:
+    """
+    Problems of notes whose records are known, without touching the file system.
 
-                published = published+1
-                print(f"Transfered {publish_file}. [{published}/{len(publish_files)}]")
-            except PublishTransformError as e:
-                print(f"Transfering failed for {e.filepath}")
-                print(f"Reason: {e.reason}")
+    Errors: what fails the conversion - front matter slugify() rejects, a note publishing to
+    the file of an earlier one (see reject_output_clashes(), done by the caller), embeds of
+    missing images. Warnings: links to notes that are not published or do not exist, which
+    the conversion reduces to their text.
+    """
+    src_dir = src_dir or get_config().obsidian_image_dir
+    problems = []
+    for note in notes:
+        record = note.record
+        if record.slug_error is not None:
+            problems.append(CheckProblem(note.path, record.slug_error))
+        for kind, target in dict.fromkeys(record.refs):  # Each reference is reported once per note
+            if kind in ("embed", "image"):
+                if kind == "image" and target.startswith(('http://', 'https://')):
+                    continue
+                if attachments.resolve(target, src_dir) is None:
+                    problems.append(CheckProblem(note.path, f"missing image '{target}'"))
+            elif kind == "wikilink" and target and link_resolver.lookup(target) is None:
+                # resolve() first: a lazy() index collects note_names only when it scans
+                if attachments.resolve(target) is not None or LinkResolver.key(target) in attachments.note_names:
+                    problems.append(CheckProblem(note.path, f"[[{target}]] is not published, it becomes plain text",
+                                                 error=False))
+                else:
+                    problems.append(CheckProblem(note.path, f"[[{target}]] links to no note, it becomes plain text",
+                                                 error=False))
+    return problems
+
+def check(jobs: int = 1, changed: Optional[set[Path]] = None) -> list[CheckProblem]:
+    """
+    Checks every publish note without writing anything, see check_notes().
+
+    The notes are parsed in parallel with jobs > 1. The Jekyll site is optional: without it
+    the collections are only checked for slug collisions, with it also for existing.
+    With changed (absolute paths, e.g. staged_changes()) only the changed notes and the notes
+    embedding a changed file are checked. Like a restricted conversion, the other notes come
+    from the vault index (only read, never refreshed) and only the changed notes and those
+    whose references the index does not know are parsed.
+    """
+    config = get_config().validate(site=False)
+    problems = []
+    notes: list[Note] = []
+    known = None
+    if changed is not None and config.publish_dir / ".publishignore" not in changed \
+            and config.vault_index_path.is_file():
+        with span("vault_index"), VaultIndex(config.vault_index_path) as index:
+            known = index.signatures() or None
+    with span("discovery"):
+        ignore = PublishIgnore.load(config.publish_dir)
+        for publish_subdirectory in get_publish_subdirectories(config.publish_dir, ignore):
+            collection = get_jekyll_directory(publish_subdirectory, config.jekyll_root, config.publish_dir,
+                                              must_exist=False)
+            if config.jekyll_root.is_dir() and not collection.is_dir():
+                problems.append(CheckProblem(publish_subdirectory, f"the Jekyll site has no {collection.name} collection"))
+            if known is None:
+                notes.extend(walk_publish_tree(publish_subdirectory, ignore, collection))
+            else:
+                notes.extend(changed_publish_tree(publish_subdirectory, ignore, collection, known, changed))
+
+    if known is not None:
+        with span("vault_index"), VaultIndex(config.vault_index_path) as index:
+            indexed = index.records([note.path for note in notes if note.path not in changed])
+        for note in notes:
+            note.record = indexed.get(note.path)
+    unparsed = [note for note in notes if note.record is None or note.record.refs is None]
+    paths = [note.path for note in unparsed]
+    with span("parse_notes"):
+        if jobs <= 1 or len(unparsed) <= 1:
+            records = list(map(NoteRecord.parse, paths))
+        else:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(unparsed)), initializer=configure,
+                                     initargs=(config,)) as executor:
+                records = list(executor.map(NoteRecord.parse, paths, chunksize=max(1, len(paths) // (jobs * 4))))
+    for note, record in zip(unparsed, records):
+        note.record = record
+    reject_output_clashes(notes)
+
+    checked = notes
+    if changed is not None:
+        names = {path.name.casefold() for path in changed}
+        checked = [note for note in notes if note.path in changed or any(
+            kind in ("embed", "image") and Path(urllib.parse.unquote(target)).name.casefold() in names
+            for kind, target in note.record.refs)]
+    with span("attachment_index"):
+        if known is not None:
+            attachments = AttachmentIndex.lazy(config.obsidian_root, config.obsidian_image_dir)
+        else:
+            attachments = AttachmentIndex.build(config.obsidian_root, config.obsidian_image_dir)
+    with span("check_notes"):
+        problems.extend(check_notes(checked, attachments, LinkResolver.from_notes(notes), config.obsidian_image_dir))
+    if changed is not None:
+        print(f"Checked the {len(checked)} of {len(notes)} notes affected by {len(changed)} changed path(s), "
+              f"{len(unparsed)} parsed")
+    else:
+        print(f"Checked {len(notes)} notes")
+    return problems
+
+def print_check_report(problems: list[CheckProblem]) -> bool:
+    """Prints the problems grouped by note, returns whether there were errors."""
+    root = get_config().obsidian_root
+    by_source: dict[Path, list[CheckProblem]] = {}
+    for problem in problems:
+        by_source.setdefault(problem.source, []).append(problem)
+    for source in sorted(by_source):
+        print(source.relative_to(root) if source.is_relative_to(root) else source)
+        for problem in sorted(by_source[source], key=lambda problem: (not problem.error, problem.message)):
+            print(f"  {'error' if problem.error else 'warning'}: {problem.message}")
+    errors = sum(problem.error for problem in problems)
+    print(f"{errors} error(s), {len(problems) - errors} warning(s)")
+    return errors > 0
+
+class PollingWatcher:
+    """Detects changes by periodically comparing [size, mtime_ns] snapshots of the watched trees."""
+    def __init__(self, directories: list[Path], interval: float = 0.5):
+        self.directories = directories
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> dict[Path, list[int]]:
+        snapshot = {}
+        for directory in self.directories:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    path = Path(root) / name
+                    signature = stat_signature(path)
+                    if signature is not None:
+                        snapshot[path] = signature
+        return snapshot
+
+    def wait(self, timeout: Optional[float] = None) -> set[Path]:
+        """Blocks until something changes or timeout (seconds) passes. Returns the changed paths."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return set()
+            time.sleep(self.interval if remaining is None else min(self.interval, remaining))
+            snapshot = self._scan()
+            changed = {path for path in snapshot.keys() | self._snapshot.keys()
+                       if snapshot.get(path) != self._snapshot.get(path)}
+            self._snapshot = snapshot
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """Linux inotify based watcher (through libc, no third party dependency), same interface as PollingWatcher."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, directories: list[Path]):
+        libc_name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform")
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches: dict[int, Path] = {}
+        for directory in directories:
+            self._add_tree(Path(directory))
+
+    def _add_tree(self, directory: Path):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        for root, dirs, files in os.walk(directory):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root), mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {root}")
+            self._watches[wd] = Path(root)
+
+    def wait(self, timeout: Optional[float] = None) -> set[Path]:
+        """Blocks until something changes or timeout (seconds) passes. Returns the changed paths."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = directory / os.fsdecode(name)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+def create_watcher(directories: list[Path], poll: bool = False, interval: float = 0.5):
+    """inotify watcher when available, polling otherwise."""
+    if not poll:
+        try:
+            return InotifyWatcher(directories)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directories, interval)
+
+def is_relevant_change(path: Path) -> bool:
+    """Ignores editor swap files and our own temporary files."""
+    if path.name == PUBLISH_IGNORE_FILE:
+        return True
+    return not path.name.startswith('.') and not path.name.endswith(('~', '.tmp', '.swp'))
+
+def watch(jobs: int = 1, debounce: float = 0.2, poll: bool = False, interval: float = 0.5, link_images: bool = False,
+          optimize_images: bool = False, webp: bool = False, dry_run: bool = False):
+    """
+    Keeps the Jekyll site in sync with the vault until interrupted.
+
+    Changes under the publish and the image directory trigger an incremental publish. A burst
+    of events (Obsidian saves a note several times while typing) is collected until the
+    watched trees are quiet for `debounce` seconds, then converted in one run restricted to
+    the changed paths (see publish()). A changed directory or .publishignore can affect notes
+    that are not among the paths, the whole vault is checked then. A failed run is reported
+    and the next change is waited for.
+    """
+    def rebuild(changed: Optional[set[Path]] = None):
+        try:
+            publish(incremental=True, jobs=jobs, link_images=link_images, optimize_images=optimize_images, webp=webp,
+                    dry_run=dry_run, changed=changed)
+        except (ConfigError, RuntimeError, OSError, sqlite3.Error) as error:
+            print(f"Rebuild failed: {error}")
+            return False
+        return True
+
+    config = get_config().validate()
+    rebuild()
+    watcher = create_watcher([config.publish_dir, config.obsidian_image_dir], poll, interval)
+    print(f"Watching {config.publish_dir} and {config.obsidian_image_dir} ({type(watcher).__name__}), press Ctrl+C to stop.")
+    try:
+        while True:
+            changed = {path for path in watcher.wait() if is_relevant_change(path)}
+            while changed:
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= {path for path in more if is_relevant_change(path)}
+            if not changed:
+                continue
+            started = time.perf_counter()
+            print(f"Detected {len(changed)} changed path(s), rebuilding...")
+            restricted = not any(path.name == PUBLISH_IGNORE_FILE or path.is_dir() or not path.suffix for path in changed)
+            if rebuild(changed if restricted else None):
+                print(f"Rebuilt in {(time.perf_counter() - started) * 1000:.0f} ms")
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        watcher.close()
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        configure(Config.from_sources(args.config, **{field: getattr(args, field) for field in Config.FIELDS}))
+        run(args)
+    except ConfigError as error:
+        sys.exit(str(error))
+
+def changed_paths(args) -> Optional[set[Path]]:
+    """Paths given with --changed or staged with --staged, None to check every note."""
+    if args.changed:
+        return {path.resolve() for path in args.changed}
+    if args.staged:
+        try:
+            return staged_changes(get_config().obsidian_root)
+        except (OSError, subprocess.CalledProcessError) as error:
+            print(f"Could not list the staged changes ({error}), checking every note")
+    return None
+
+def run(args):
+    if args.profile is True:
+        args.profile = get_config().cache_dir / "profile"
+    if args.check:
+        if print_check_report(check(args.jobs, changed_paths(args))):
+            sys.exit(1)
+    elif args.command == "stats":
+        print_stats(RunHistory(get_config().history_path).load(), args.last, args.window, args.threshold)
+    elif args.command == "watch":
+        watch(args.jobs, args.debounce, args.poll, args.interval, args.link_images, args.optimize_images, args.webp,
+              args.dry_run)
+    else:
+        changed = changed_paths(args)
+        if changed is None and (args.staged or args.changed):
+            args.incremental = True
+        publish(args.incremental, args.jobs, args.profile, args.link_images, args.optimize_images, args.webp, args.dry_run,
+                changed)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,45 @@
+import unittest
+import shutil
+import tempfile
+from pathlib import Path
+
+import obsidian_to_jekyll as otj
+from bench_obsidian_to_jekyll import *
+
+class TestBenchObsidianToJekyll(unittest.TestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        # The benchmark repoints the converter, restore it for the other tests
+        self.previous_config = otj.configure(None)
+
+    def tearDown(self):
+        otj.configure(self.previous_config)
+        shutil.rmtree(self.root)
+
+    def test_generate_vault(self):
+        info = generate_vault(self.root, notes=10, note_size=512, link_density=0.2, images=3, image_size=100)
+        notes = sorted((info["vault"] / "publish").glob("*/*.md"))
+
+        self.assertEqual(len(notes), 10)
+        self.assertEqual(len(list((info["vault"] / "publish" / "posts").iterdir())), 5)
+        self.assertEqual(info["note_bytes"], sum(note.stat().st_size for note in notes))
+        self.assertEqual(len(list((info["vault"] / "assets" / "images").iterdir())), 3)
+        self.assertEqual(info["image_bytes"], 300)
+        self.assertTrue(any("![[" in note.read_text() for note in notes))
+
+        with self.subTest("Deterministic for a seed"):
+            other = generate_vault(self.root / "other", notes=10, note_size=512, link_density=0.2, images=3, image_size=100)
+            self.assertEqual(notes[0].read_text(), (other["vault"] / notes[0].relative_to(info["vault"])).read_text())
+
+    def test_run_benchmarks(self):
+        info = generate_vault(self.root, notes=6, note_size=256, link_density=0.1, images=2, image_size=64)
+        results = run_benchmarks(info, repeat=1)
+
+        self.assertEqual([r["scenario"] for r in results], [
+            "slugify", "front_matter", "image_sync_cold", "image_sync_warm", "transform_references",
+            "transform_references_two_pass", "scan_references", "publish_cold", "publish_warm_full", "publish_warm_incremental"])
+        self.assertTrue(all(r["seconds"] >= 0 for r in results))
+        self.assertEqual(len(list((info["jekyll"] / "_posts").iterdir())), 3)
+
+if __name__ == "__main__":
+    unittest.main()
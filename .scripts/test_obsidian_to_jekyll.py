@@ -1,9 +1,18 @@
 import unittest
 from unittest.mock import patch, mock_open, Mock
 import os
+import sys
+import json
+import hashlib
+import itertools
+import pickle
 import shutil
 import tempfile
+import threading
+import subprocess
 from pathlib import Path
+from functools import partial
+from io import StringIO
 from obsidian_to_jekyll import *
 
 class TestObsidianToJekyll(unittest.TestCase):
@@ -17,8 +26,8 @@ class TestObsidianToJekyll(unittest.TestCase):
         self.jekyll_root = self.obsidian_root / "schrodlm.github.io"
         self.jekyll_img_dir = self.jekyll_root / "assets" / "img"
 
-        ObsidianPath.configure_root(self.obsidian_root)
-        JekyllPath.configure_root(self.jekyll_root)
+        self.previous_config = configure(Config(self.obsidian_root, self.jekyll_root, self.obsidian_publish_dir,
+                                                self.obsidian_img_dir, self.jekyll_img_dir))
 
         self.obsidian_publish_dir.mkdir(parents=True, exist_ok=True)
         self.obsidian_img_dir.mkdir(parents=True, exist_ok=True)
@@ -60,33 +69,32 @@ Also references [[file2#chapter]].
 """)
           
     def tearDown(self):
+        configure(self.previous_config)
         # Clean up temporary directories
         shutil.rmtree(self.obsidian_root)
         pass
 
     def test_path_validation(self):
-            """Test the ObsidianPath and JekyllPath validation."""
+            """Test the obsidian_path and jekyll_path validation."""
             # Configure the paths for testing
-            with patch('obsidian_to_jekyll.OBSIDIAN_ROOT', self.obsidian_root), \
-                patch('obsidian_to_jekyll.JEKYLL_ROOT', self.jekyll_root):
+            
+            # --- Valid Paths ---
+            with self.subTest("Valid ObsidianPath"):
+                valid_obsidian = obsidian_path(self.obsidian_subdir1 / "file1.md")
+                self.assertTrue(valid_obsidian.exists())
                 
-                # --- Valid Paths ---
-                with self.subTest("Valid ObsidianPath"):
-                    valid_obsidian = ObsidianPath(self.obsidian_subdir1 / "file1.md")
-                    self.assertTrue(valid_obsidian.exists())
+            with self.subTest("Valid JekyllPath"):
+                valid_jekyll = jekyll_path(self.jekyll_subdir1 / "post.md")
+                self.assertTrue(valid_jekyll.parent.exists())
+            
+            # --- Invalid Paths ---
+            with self.subTest("Invalid ObsidianPath"):
+                with self.assertRaises(ValueError):
+                    obsidian_path(Path(tempfile.mkdtemp()))
                     
-                with self.subTest("Valid JekyllPath"):
-                    valid_jekyll = JekyllPath(self.jekyll_subdir1 / "post.md")
-                    self.assertTrue(valid_jekyll.parent.exists())
-                
-                # --- Invalid Paths ---
-                with self.subTest("Invalid ObsidianPath"):
-                    with self.assertRaises(ValueError):
-                        ObsidianPath(Path(tempfile.mkdtemp()))
-                        
-                with self.subTest("Invalid JekyllPath"):
-                    with self.assertRaises(ValueError):
-                        JekyllPath(self.obsidian_publish_dir / "outside_jekyll.md")
+            with self.subTest("Invalid JekyllPath"):
+                with self.assertRaises(ValueError):
+                    jekyll_path(self.obsidian_publish_dir / "outside_jekyll.md")
 
     def test_get_jekyll_directory(self):
         with self.subTest("Valid directory test"):
@@ -117,52 +125,6 @@ Also references [[file2#chapter]].
             subdirectories = get_publish_subdirectories(self.obsidian_publish_dir)
             self.assertEqual(subdirectories, [self.obsidian_subdir1, self.obsidian_subdir2], "Listed publish subdirectories are not correct.")
     
-    def test_remove_contents_of(self):
-        # This function has a safety check that depends on a global constant,
-        # OBSIDIAN_DIR. We use `patch` to temporarily set this constant
-        # to our main test directory for the duration of this test.
-        with patch('obsidian_to_jekyll.JEKYLL_ROOT', self.obsidian_root):
-            
-            # --- Sub-test 1: Successful removal of contents ---
-            with self.subTest("Successful removal of contents"):
-                # Arrange: Create a directory structure to be deleted
-                target_dir = Path(self.jekyll_subdir1 / "test_removal_directory")
-                target_dir.mkdir()
-                test_file = target_dir / "file_to_delete.md"
-                test_file.write_text("some content")
-                nested_dir = target_dir / "nested_dir"
-                nested_dir.mkdir()
-                nested_file = nested_dir / "nested_file.txt"
-                nested_file.write_text("more content")
-
-                # Act: Call the function to clear the directory
-                remove_contents_of(target_dir)
-
-                # Assert: The directory should still exist, but be empty
-                self.assertTrue(target_dir.exists())
-                self.assertEqual(list(target_dir.iterdir()), [], "Directory should be empty after removal")
-                #Clean up
-                shutil.rmtree(target_dir)
-
-            
-            # --- Sub-test 2: Safety check to prevent dangerous deletion ---
-            with self.subTest("Safety check raises error for outside directory"):
-                # Arrange: Create a separate temp directory outside the "safe" zone
-                outside_dir = Path(tempfile.mkdtemp())
-                # Add a file to it to ensure it's not empty
-                (outside_dir / "do_not_delete.txt").touch()
-
-                # Act & Assert: Expect a RuntimeError when trying to delete outside the safe zone
-                with self.assertRaisesRegex(RuntimeError, "Trying to remove contents outside of this project! Aborted."):
-                    remove_contents_of(outside_dir)
-
-                # Assert that the outside directory and its contents were NOT deleted
-                self.assertTrue((outside_dir / "do_not_delete.txt").exists())
-
-                # Clean up
-                shutil.rmtree(outside_dir)
-
-
     def test_get_directory_md_files(self):
         # Test 1: Basic functionality - finds markdown files in root directory
         with self.subTest("Finds markdown files in root directory"):
@@ -177,10 +139,11 @@ Also references [[file2#chapter]].
             # Act
             result = get_directory_md_files(self.obsidian_publish_dir)
             
-            # Assert
-            self.assertEqual(len(result), 2)
+            # Assert - notes of the nested Posts/ and Projects/ are found as well
+            self.assertEqual(len(result), 4)
             self.assertIn(md_file1, result)
             self.assertIn(md_file2, result)
+            self.assertIn(self.file1, result)
             self.assertNotIn(txt_file, result)
             
             # Cleanup
@@ -236,7 +199,7 @@ Also references [[file2#chapter]].
             result = get_directory_md_files(self.obsidian_publish_dir)
             
             # Assert
-            self.assertEqual(len(result), 2)  # Both the real file and symlink should be found
+            self.assertEqual(len(result), 4)  # Both the real file and symlink should be found (+ file1, file2)
             self.assertIn(real_md, result)
             self.assertIn(symlink_md, result)
             
@@ -244,6 +207,36 @@ Also references [[file2#chapter]].
             real_md.unlink()
             symlink_md.unlink()
 
+    def test_walk_publish_tree(self):
+        """Nested notes are found in one walk, .publishignore rules and hidden entries are skipped"""
+        nested = self.obsidian_subdir1 / "2024" / "deep" / "nested.md"
+        draft = self.obsidian_subdir1 / "drafts" / "draft.md"
+        drawing = self.obsidian_subdir1 / "sketch.excalidraw.md"
+        old = self.obsidian_subdir2 / "old-project.md"
+        kept = self.obsidian_subdir2 / "old-but-kept.md"
+        hidden = self.obsidian_subdir1 / ".trash" / "deleted.md"
+        for note in (nested, draft, drawing, old, kept, hidden):
+            note.parent.mkdir(parents=True, exist_ok=True)
+            note.write_text("# Note")
+        (self.obsidian_publish_dir / ".publishignore").write_text(
+            "# not ready yet\ndrafts/\n*.excalidraw.md\nProjects/old-*.md\n!Projects/old-but-kept.md\n")
+        ignore = PublishIgnore.load(self.obsidian_publish_dir)
+
+        entries = list(walk_publish_tree(self.obsidian_publish_dir, ignore))
+
+        self.assertEqual([entry.path for entry in entries], [self.file1, nested, self.file2, kept])
+        self.assertEqual(entries[0].signature, stat_signature(self.file1))
+        self.assertEqual(get_publish_subdirectories(self.obsidian_publish_dir, ignore),
+                         [self.obsidian_subdir1, self.obsidian_subdir2])
+
+        with self.subTest("Ignored collection"):
+            self.assertEqual(get_publish_subdirectories(self.obsidian_publish_dir, PublishIgnore(self.obsidian_publish_dir, ["Projects/"])),
+                             [self.obsidian_subdir1])
+
+        with self.subTest("No .publishignore"):
+            self.assertEqual(PublishIgnore.load(self.obsidian_subdir1).rules, [])
+            self.assertIn(draft, get_directory_md_files(self.obsidian_subdir1))
+
     def test_read_md_metadata(self):
         """Test reading metadata from markdown front matter"""
         # Test 1: Normal front matter
@@ -501,29 +494,27 @@ date: 2024-1-5
             6. ![[subdir/image.png]]            → ![Image](subdir/image.png)
             7. ![[image.png|alt text|200x100]]  → ![alt text](image.png){:width="200" height="100"}
         """
-        with patch('obsidian_to_jekyll.JEKYLL_ROOT', self.jekyll_root), \
-            patch('obsidian_to_jekyll.JEKYLL_IMAGE_DIR', self.jekyll_img_dir):
-
-            relative_path = self.jekyll_img_dir.relative_to(self.jekyll_root)
-
-            test_cases = [
-                ("image.png", 
-                (f"![Image]({relative_path}/image.png)", "image.png")),
-                ("image.png|200", 
-                (f'![Image]({relative_path}/image.png){{:width="200"}}', "image.png")),
-                ("image.png|200x100", 
-                (f'![Image]({relative_path}/image.png){{:width="200" height="100"}}', "image.png")),
-                ("subdir/image.png|Alt Text", 
-                (f"![Alt Text]({relative_path}/subdir/image.png)", "subdir/image.png")),
-                ("image.png|Alt Text|200x100", 
-                (f'![Alt Text]({relative_path}/image.png){{:width="200" height="100"}}', "image.png"))
-            ]
-            
-            for input_ref, (expected_output, expected_path) in test_cases:
-                with self.subTest(input_ref=input_ref):
-                    result_output, result_path = transform_image_ref(input_ref)
-                    self.assertEqual(result_output, expected_output)
-                    self.assertEqual(result_path, Path(expected_path))
+
+        relative_path = self.jekyll_img_dir.relative_to(self.jekyll_root)
+
+        test_cases = [
+            ("image.png", 
+            (f"![Image]({relative_path}/image.png)", "image.png")),
+            ("image.png|200", 
+            (f'![Image]({relative_path}/image.png){{:width="200"}}', "image.png")),
+            ("image.png|200x100", 
+            (f'![Image]({relative_path}/image.png){{:width="200" height="100"}}', "image.png")),
+            ("subdir/image.png|Alt Text", 
+            (f"![Alt Text]({relative_path}/subdir/image.png)", "subdir/image.png")),
+            ("image.png|Alt Text|200x100", 
+            (f'![Alt Text]({relative_path}/image.png){{:width="200" height="100"}}', "image.png"))
+        ]
+        
+        for input_ref, (expected_output, expected_path) in test_cases:
+            with self.subTest(input_ref=input_ref):
+                result_output, result_path = transform_image_ref(input_ref)
+                self.assertEqual(result_output, expected_output)
+                self.assertEqual(result_path, Path(expected_path))
 
     @patch('pathlib.Path.exists')
     @patch('pathlib.Path.mkdir')
@@ -554,6 +545,1096 @@ date: 2024-1-5
             with self.assertRaises(PublishTransformError):
                 ensure_image_available(src, dst)
 
+    def test_build_manifest(self):
+        """Incremental builds rebuild only notes whose inputs changed"""
+        manifest_path = self.obsidian_root / ".publish_cache" / "manifest.json"
+        manifest = BuildManifest(manifest_path)
+        output = self.jekyll_subdir1 / "file1.md"
+        output.write_text("converted")
+        manifest.record(self.file1, output, {self.fake_image})
+        manifest.save()
+
+        with self.subTest("Unchanged note is up to date"):
+            manifest = BuildManifest.load(manifest_path)
+            self.assertTrue(manifest.is_up_to_date(self.file1, self.jekyll_subdir1))
+            self.assertEqual(manifest.output_of(self.file1), output)
+
+        with self.subTest("Touched but identical note is up to date"):
+            os.utime(self.file1, ns=(0, 0))
+            self.assertTrue(manifest.is_up_to_date(self.file1, self.jekyll_subdir1))
+
+        with self.subTest("Unknown note is not up to date"):
+            self.assertFalse(manifest.is_up_to_date(self.file2, self.jekyll_subdir2))
+
+        with self.subTest("Changed image invalidates the note"):
+            self.fake_image.write_text("different image data")
+            self.assertFalse(manifest.is_up_to_date(self.file1, self.jekyll_subdir1))
+            manifest.record(self.file1, output, {self.fake_image})
+
+        with self.subTest("Changed note is not up to date"):
+            self.file1.write_text("# File 1 edited")
+            self.assertFalse(manifest.is_up_to_date(self.file1, self.jekyll_subdir1))
+            manifest.record(self.file1, output, set())
+
+        with self.subTest("Missing output is not up to date"):
+            output.unlink()
+            self.assertFalse(manifest.is_up_to_date(self.file1, self.jekyll_subdir1))
+
+        with self.subTest("Corrupt manifest loads empty"):
+            manifest_path.write_text("{not json")
+            self.assertEqual(BuildManifest.load(manifest_path).notes, {})
+
+        with self.subTest("Deleted notes are forgotten"):
+            manifest.retain_only([self.file2])
+            self.assertEqual(manifest.notes, {})
+
+    def test_prune_stale_outputs(self):
+        kept = self.jekyll_subdir1 / "2024-12-20-kept.md"
+        stale = self.jekyll_subdir1 / "2024-12-19-renamed.md"
+        kept.write_text("kept")
+        stale.write_text("stale")
+
+        removed = prune_stale_outputs(self.jekyll_subdir1, {kept})
+
+        self.assertEqual(removed, [stale])
+        self.assertTrue(kept.exists())
+        self.assertFalse(stale.exists())
+
+        with self.assertRaises(RuntimeError):
+            prune_stale_outputs(self.obsidian_publish_dir, set())
+
+    def test_orphan_images(self):
+        """Only images an earlier run published and no recorded note links to are pruned"""
+        manifest = BuildManifest(self.obsidian_root / "manifest.json")
+        output = self.jekyll_subdir1 / "file1.md"
+        output.write_text("converted")
+        used = self.jekyll_img_dir / "test-image.png"
+        orphan = self.jekyll_img_dir / "old" / "deleted-note.png"
+        logo = self.jekyll_img_dir / "logo.png"
+        orphan.parent.mkdir(parents=True)
+        used.write_bytes(b"used")
+        orphan.write_bytes(b"orphan")
+        logo.write_bytes(b"theme")
+        manifest.record(self.file1, output, {self.fake_image}, published_images={used})
+        self.assertEqual(manifest.published_images(), {used})
+
+        with self.subTest("Dry run only lists"):
+            self.assertEqual(prune_orphan_images({used, orphan}, manifest.published_images(), dry_run=True), [orphan])
+            self.assertTrue(orphan.exists())
+
+        self.assertEqual(prune_orphan_images({used, orphan}, manifest.published_images()), [orphan])
+        self.assertFalse(orphan.parent.exists())
+        self.assertTrue(used.exists())
+        self.assertTrue(logo.exists())
+
+        with self.subTest("Missing published image invalidates the note"):
+            self.assertTrue(manifest.is_up_to_date(self.file1, self.jekyll_subdir1))
+            used.unlink()
+            self.assertFalse(manifest.is_up_to_date(self.file1, self.jekyll_subdir1))
+
+        with self.subTest("Publishing keeps hand-placed images and those of failed notes"):
+            shutil.copy(self.fake_image, self.obsidian_img_dir / "diagram.png")
+            self.file2.write_text("# File 2\n![[diagram.png]]\n")
+            diagram = self.jekyll_img_dir / "diagram.png"
+            with patch('sys.stdout', new_callable=StringIO):
+                publish()
+            self.assertTrue(diagram.exists())
+            self.assertEqual(BuildManifest.recorded_images(get_config().manifest_path)["Publish/Projects/file2.md"],
+                             {diagram})
+            (self.jekyll_subdir2 / "file2.md").unlink()
+            self.file2.write_text("# File 2\n![[diagram.png]]\n![[missing.png]]\n")
+            with patch('sys.stdout', new_callable=StringIO):
+                publish()
+            self.assertTrue(diagram.exists())
+            self.assertTrue(logo.exists())
+            self.file2.unlink()
+            with patch('sys.stdout', new_callable=StringIO):
+                publish()
+            self.assertFalse(diagram.exists())
+            self.assertTrue(logo.exists())
+            self.assertTrue(used.exists())
+
+    def test_failed_note_images(self):
+        """Images a note published before it failed are held, and collected once nothing needs them"""
+        shutil.copy(self.fake_image, self.obsidian_img_dir / "good.png")
+        good = self.jekyll_img_dir / "good.png"
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                self.file2.write_text("# File 2\n![[good.png]]\n![[missing.png]]\n")
+                with patch('sys.stdout', new_callable=StringIO):
+                    publish(jobs=jobs)
+                self.assertTrue(good.exists())
+                self.assertEqual(BuildManifest.recorded_images(get_config().manifest_path)["Publish/Projects/file2.md"],
+                                 {good})
+                self.file2.unlink()
+                with patch('sys.stdout', new_callable=StringIO):
+                    publish(jobs=jobs)
+                self.assertFalse(good.exists())
+                self.file2.write_text("# File 2\n")
+
+    def test_image_sync(self):
+        """Images are copied only when the destination differs"""
+        dst = self.jekyll_img_dir / self.fake_image.name
+
+        with self.subTest("Missing destination is copied"):
+            image_sync = ImageSync()
+            self.assertTrue(image_sync.sync(self.fake_image, dst))
+            self.assertEqual(dst.read_text(), "fake image data")
+            self.assertEqual(os.stat(dst).st_mtime_ns, os.stat(self.fake_image).st_mtime_ns)
+
+        with self.subTest("Repeated reference within a run is deduplicated"), \
+                patch('obsidian_to_jekyll.is_identical_file') as mock_identical:
+            self.assertFalse(image_sync.sync(self.fake_image, dst))
+            mock_identical.assert_not_called()
+            self.assertEqual((image_sync.copied, image_sync.skipped), (1, 1))
+
+        with self.subTest("Identical destination is skipped in a new run"), \
+                patch('obsidian_to_jekyll.copy_file') as mock_copy:
+            self.assertFalse(ImageSync().sync(self.fake_image, dst))
+            mock_copy.assert_not_called()
+
+        with self.subTest("Same content with a different mtime is skipped"), \
+                patch('obsidian_to_jekyll.copy_file') as mock_copy:
+            os.utime(dst, ns=(0, 0))
+            self.assertFalse(ImageSync().sync(self.fake_image, dst))
+            mock_copy.assert_not_called()
+            self.assertEqual(os.stat(dst).st_mtime_ns, os.stat(self.fake_image).st_mtime_ns)
+
+        with self.subTest("Same size with different content is copied"):
+            dst.write_text("fake image DATA")
+            os.utime(dst, ns=(0, 0))
+            self.assertTrue(ImageSync().sync(self.fake_image, dst))
+            self.assertEqual(dst.read_text(), "fake image data")
+
+    def test_transfer_publish_file(self):
+        """Notes are converted from a single read into a single atomic write"""
+        with self.subTest("Converted note"):
+            self.file2.write_bytes(b"---\r\ntitle: File 2\r\n---\r\nSee [[file1|the first file]].\r\n")
+            context = ConversionContext()
+
+            dst = transfer_publish_file(self.file2, self.jekyll_subdir2, context)
+
+            self.assertEqual(dst, self.jekyll_subdir2 / "file2.md")
+            self.assertEqual(dst.read_text(), "---\ntitle: File 2\n---\nSee the first file.\n")
+            self.assertEqual(context.source_digest, file_digest(self.file2))
+            self.assertEqual(context.source_stat, stat_signature(self.file2))
+            self.assertEqual(os.listdir(self.jekyll_subdir2), ["file2.md"])
+
+        with self.subTest("Failed note leaves no output"):
+            post = self.obsidian_subdir1 / "Bad Post.md"
+            post.write_text("---\nlayout: post\n---\n# Content")
+            with self.assertRaises(PublishTransformError):
+                transfer_publish_file(post, self.jekyll_subdir1)
+            self.assertEqual(os.listdir(self.jekyll_subdir1), [])
+
+    def test_convert_notes(self):
+        """Parallel conversion yields results in task order and keeps the errors"""
+        bad_post = self.obsidian_subdir1 / "Bad Post.md"
+        bad_post.write_text("---\nlayout: post\n---\n# Content")
+        notes = [self.obsidian_subdir2 / f"note{i}.md" for i in range(4)]
+        for note in notes:
+            note.write_text(f"# {note.stem}")
+        tasks = [(note, self.jekyll_subdir2) for note in notes]
+        tasks.insert(2, (bad_post, self.jekyll_subdir1))
+
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                results = list(convert_notes(tasks, jobs))
+
+                self.assertEqual([result.source for result in results], [source for source, _ in tasks])
+                self.assertIsInstance(results[2].error, PublishTransformError)
+                self.assertEqual(results[2].error.reason, "Missing date field for post layout")
+                self.assertEqual([result.output for result in results if result.error is None],
+                                 [self.jekyll_subdir2 / f"note{i}.md" for i in range(4)])
+
+    def test_copy_scheduler(self):
+        """Images are copied in the background, a failed copy fails the notes embedding the image"""
+        with self.subTest("Jobs report their result or error"), CopyScheduler(workers=2, queue_size=1) as scheduler:
+            release = threading.Event()
+            blocked = scheduler.submit(release.wait)
+            queued = scheduler.submit(lambda: 42)
+            failing = scheduler.submit(partial(os.stat, self.obsidian_root / "missing"))
+            release.set()
+            scheduler.wait()
+            self.assertEqual((blocked.result(), queued.result()), (True, 42))
+            self.assertIsInstance(failing.exception(), FileNotFoundError)
+
+        with self.subTest("Counted per note like synchronous copies"):
+            self.file2.write_text("![[test-image.png]]")
+            tasks = [(self.file1, self.jekyll_subdir1), (self.file2, self.jekyll_subdir2)]
+            first, second = convert_notes(tasks)
+            self.assertEqual((first.context.images_copied, first.context.images_skipped), (1, 0))
+            self.assertEqual((second.context.images_copied, second.context.images_skipped), (0, 1))
+            self.assertEqual(first.context.images_bytes, self.fake_image.stat().st_size)
+            self.assertEqual(first.context.image_jobs, [])
+
+        with self.subTest("A failed copy fails every note depending on it"):
+            (self.jekyll_img_dir / "test-image.png").unlink()
+            with patch('obsidian_to_jekyll.copy_file', side_effect=PermissionError(13, "Permission denied")):
+                results = list(convert_notes(tasks))
+            for result in results:
+                self.assertIsInstance(result.error, PublishTransformError)
+                self.assertIn("test-image.png failed: [Errno 13] Permission denied", result.error.reason)
+                self.assertEqual(result.error.filepath, str(result.source))
+            self.assertFalse((self.jekyll_subdir1 / "file1.md").exists())
+            self.assertFalse((self.jekyll_subdir2 / "file2.md").exists())
+
+        with self.subTest("Any error of a copy fails only the notes, not the run"):
+            with patch('obsidian_to_jekyll.copy_file', side_effect=RuntimeError("unexpected")):
+                results = list(convert_notes(tasks))
+            self.assertEqual([result.error.reason for result in results],
+                             [f"Publishing image {self.fake_image} to {self.jekyll_img_dir / 'test-image.png'} "
+                              "failed: unexpected"] * 2)
+
+        with self.subTest("A failed synchronous copy, as in a worker process, fails its note"):
+            (self.jekyll_img_dir / "test-image.png").unlink(missing_ok=True)
+            with patch('obsidian_to_jekyll.copy_file', side_effect=PermissionError(13, "Permission denied")):
+                result = convert_note(self.file1, self.jekyll_subdir1, ImageSync())
+            self.assertIn("test-image.png failed: [Errno 13] Permission denied", result.error.reason)
+            self.assertEqual(result.context.published_images, {self.jekyll_img_dir / "test-image.png"})
+
+    def test_parse_jobs(self):
+        self.assertEqual(parse_jobs("3"), 3)
+        self.assertGreaterEqual(parse_jobs("auto"), 1)
+        for value in ("0", "-1", "many"):
+            with self.subTest(value=value), self.assertRaises(argparse.ArgumentTypeError):
+                parse_jobs(value)
+
+    def test_vault_index(self):
+        """The vault index re-parses only changed notes and answers reference queries"""
+        with VaultIndex(self.obsidian_root / ".publish_cache" / "vault_index.sqlite") as index:
+            notes = [self.file1, self.file2]
+
+            with self.subTest("First refresh reads the front matter of every note"):
+                self.assertEqual(index.refresh(notes), 2)
+                record = index.get(self.file1)
+                self.assertEqual(record.slug, "file1.md")
+                self.assertIsNone(record.refs)
+
+            with self.subTest("The conversion stores the references it found"):
+                with patch('sys.stdout', new_callable=StringIO), \
+                        patch('obsidian_to_jekyll.extract_references', side_effect=AssertionError("read twice")):
+                    publish()
+                record = index.get(self.file1)
+                self.assertIn(("image", "test-image.png"), record.refs)
+                self.assertIn(("wikilink", "file2"), record.refs)
+                self.assertEqual(index.get(self.file2).refs, [])
+                self.assertFalse(index.store_refs(self.file2, [0, 0], [("wikilink", "stale")]))
+                self.assertEqual(index.get(self.file2).refs, [])
+
+            with self.subTest("Unchanged notes are not parsed again"):
+                self.assertEqual(index.refresh(notes), 0)
+
+            with self.subTest("Reference queries"):
+                self.assertEqual(index.notes_referencing("test-image.png"), ["Publish/Posts/file1.md"])
+                self.assertEqual(index.notes_referencing("file2", kinds=("wikilink",)), ["Publish/Posts/file1.md"])
+
+            with self.subTest("Changed note is re-parsed"):
+                self.file2.write_text("---\nlayout: post\n---\n![[test-image.png|200]]")
+                self.assertEqual(index.refresh(notes, references=True), 1)
+                record = index.get(self.file2)
+                self.assertEqual(record.front_matter, {"layout": "post"})
+                self.assertEqual(record.slug_error, "Missing date field for post layout")
+                self.assertEqual(record.refs, [("embed", "test-image.png")])
+
+            with self.subTest("Invalid UTF-8 fails the same way in the index and in the conversion"):
+                draft = self.obsidian_subdir1 / "draft.md"
+                draft.write_bytes(b"---\ntitle: \xff\n---\nx")
+                index.refresh(notes + [draft])
+                self.assertEqual(index.get(draft).slug_error, "Note is not valid UTF-8.")
+                with self.assertRaises(PublishTransformError) as raised:
+                    transfer_publish_file(draft, self.jekyll_subdir1)
+                self.assertEqual(raised.exception.reason, index.get(draft).slug_error)
+                draft.unlink()
+
+            with self.subTest("Deleted note is dropped"):
+                index.refresh([self.file2])
+                self.assertIsNone(index.get(self.file1))
+                self.assertEqual(index.notes_referencing("test-image.png"), ["Publish/Projects/file2.md"])
+
+            with self.subTest("Current record is used instead of re-parsing"):
+                self.file2.write_text("# No references")
+                record = NoteRecord.parse(self.file2)
+                record.slug = "from-index.md"
+                with patch('obsidian_to_jekyll.parse_front_matter') as mock_parse, \
+                        patch('obsidian_to_jekyll.transform_content') as mock_transform:
+                    dst = transfer_publish_file(self.file2, self.jekyll_subdir2, ConversionContext(record=record))
+                    mock_parse.assert_not_called()
+                    mock_transform.assert_not_called()
+                self.assertEqual(dst, self.jekyll_subdir2 / "from-index.md")
+                self.assertEqual(dst.read_text(), "# No references")
+
+    def test_watchers(self):
+        """Both watcher implementations report changed files"""
+        factories = [partial(PollingWatcher, interval=0.01), InotifyWatcher]
+        for factory in factories:
+            try:
+                watcher = factory([self.obsidian_publish_dir])
+            except OSError:
+                continue  # inotify is Linux only
+            with self.subTest(type(watcher).__name__):
+                new_dir = self.obsidian_subdir1 / f"{type(watcher).__name__}"
+                self.assertEqual(watcher.wait(0.05), set())
+
+                self.file1.write_text("# File 1 edited")
+                self.assertIn(self.file1, watcher.wait(1))
+
+                new_dir.mkdir()
+                watcher.wait(0.1)
+                (new_dir / "nested.md").write_text("# Nested")
+                changed = watcher.wait(1)
+                changed |= watcher.wait(0.1)
+                self.assertIn(new_dir / "nested.md", changed)
+                watcher.close()
+
+    def test_watch(self):
+        """watch() rebuilds only the changed paths and keeps going when a rebuild fails"""
+        bursts = [{self.file1}, set(), {self.obsidian_subdir1}, set(), {self.file2}, set()]
+        watcher = Mock()
+        def wait(timeout=None):
+            if not bursts:
+                raise KeyboardInterrupt
+            return bursts.pop(0)
+        watcher.wait.side_effect = wait
+        calls = []
+        def fake_publish(**kwargs):
+            calls.append(kwargs["changed"])
+            if kwargs["changed"] == {self.file2}:
+                raise RuntimeError("File stray.txt located in the publish directory")
+        with patch('obsidian_to_jekyll.create_watcher', return_value=watcher), \
+                patch('obsidian_to_jekyll.publish', side_effect=fake_publish), \
+                patch('sys.stdout', new_callable=StringIO) as stdout:
+            watch()
+        # The initial run and a changed directory check the whole vault
+        self.assertEqual(calls, [None, {self.file1}, None, {self.file2}])
+        self.assertIn("Rebuild failed: File stray.txt located in the publish directory", stdout.getvalue())
+        self.assertIn("Stopped watching.", stdout.getvalue())
+        watcher.close.assert_called_once()
+
+    def test_is_relevant_change(self):
+        self.assertTrue(is_relevant_change(Path("publish/posts/Note.md")))
+        self.assertTrue(is_relevant_change(Path("assets/images/Pasted image 1.png")))
+        self.assertFalse(is_relevant_change(Path("assets/img/.image.png.1234.tmp")))
+        self.assertFalse(is_relevant_change(Path("publish/posts/Note.md~")))
+
+    def test_apply_staged(self):
+        """Only real changes from the staging directory reach the live directory"""
+        staging = self.jekyll_root / ".publish_staging" / "_posts"
+        staging.mkdir(parents=True)
+        live = self.jekyll_subdir1
+        for name, content in [("same.md", "same"), ("changed.md", "old"), ("deleted.md", "gone"), ("kept.md", "kept")]:
+            (live / name).write_text(content)
+            os.utime(live / name, ns=(0, 0))
+        for name, content in [("same.md", "same"), ("changed.md", "new"), ("added.md", "added")]:
+            (staging / name).write_text(content)
+
+        changes = apply_staged(staging, live, keep={live / "kept.md"})
+
+        self.assertEqual(changes["added"], [live / "added.md"])
+        self.assertEqual(changes["changed"], [live / "changed.md"])
+        self.assertEqual(changes["unchanged"], [live / "same.md"])
+        self.assertEqual(changes["removed"], [live / "deleted.md"])
+        self.assertEqual(sorted(os.listdir(live)), ["added.md", "changed.md", "kept.md", "same.md"])
+        self.assertEqual((live / "changed.md").read_text(), "new")
+        self.assertEqual(os.stat(live / "same.md").st_mtime_ns, 0)
+        self.assertEqual(os.stat(live / "kept.md").st_mtime_ns, 0)
+        self.assertEqual(os.listdir(staging), [])
+
+        with self.assertRaises(RuntimeError):
+            apply_staged(staging, self.obsidian_subdir1)
+
+    def test_profiler(self):
+        """Stage spans are recorded only while a profiler is active, including in worker processes"""
+        with self.subTest("Disabled profiling is a shared no-op"):
+            self.assertIs(span("slugify"), span("transform_references", note="x"))
+
+        profiler = Profiler()
+        set_profiler(profiler)
+        try:
+            with span("discovery"):
+                pass
+            notes = [self.obsidian_subdir2 / f"note{i}.md" for i in range(3)]
+            for note in notes:
+                note.write_text(f"# {note.stem}")
+            list(convert_notes([(note, self.jekyll_subdir2) for note in notes], jobs=2))
+        finally:
+            set_profiler(None)
+
+        summary = profiler.summary()
+        self.assertEqual(summary["discovery"]["count"], 1)
+        self.assertEqual(summary["convert_note"]["count"], 3)
+        self.assertEqual(summary["slugify"]["count"], 3)
+        self.assertGreater(len({event["pid"] for event in profiler.events}), 1)
+
+        summary_path, trace_path = profiler.write(self.obsidian_root / "profile")
+        trace = json.loads(trace_path.read_text())
+        self.assertEqual(len(trace["traceEvents"]), len(profiler.events))
+        self.assertTrue(all(event["ph"] == "X" for event in trace["traceEvents"]))
+        self.assertEqual(json.loads(summary_path.read_text()), summary)
+
+    def test_copy_file(self):
+        """Copies stream through the kernel or in chunks, preserving content and mtime"""
+        src = self.obsidian_img_dir / "large.pdf"
+        content = os.urandom(3 * COPY_CHUNK_SIZE + 123)
+        src.write_bytes(content)
+        dst = self.jekyll_img_dir / "large.pdf"
+        unsupported = OSError(errno.ENOSYS, "not supported")
+
+        fallbacks = [
+            ("Kernel copy", []),
+            ("sendfile fallback", [patch('os.copy_file_range', side_effect=unsupported)]),
+            ("Chunked fallback", [patch('os.copy_file_range', side_effect=unsupported),
+                                  patch('os.sendfile', side_effect=unsupported)]),
+        ]
+        for name, patches in fallbacks:
+            with self.subTest(name), contextlib.ExitStack() as stack:
+                for p in patches:
+                    stack.enter_context(p)
+                copy_file(src, dst)
+                self.assertEqual(dst.read_bytes(), content)
+                self.assertEqual(os.stat(dst).st_mtime_ns, os.stat(src).st_mtime_ns)
+                dst.unlink()
+
+        with self.subTest("Real errors are not swallowed"), \
+                patch('os.copy_file_range', side_effect=OSError(errno.EIO, "I/O error")):
+            with self.assertRaises(OSError):
+                copy_file(src, dst)
+            self.assertEqual(os.listdir(self.jekyll_img_dir), [])
+
+    def test_link_file(self):
+        dst = self.jekyll_img_dir / self.fake_image.name
+
+        with self.subTest("Hard link on the same filesystem"):
+            image_sync = ImageSync(link=True)
+            self.assertTrue(image_sync.sync(self.fake_image, dst))
+            self.assertTrue(os.path.samefile(self.fake_image, dst))
+            self.assertFalse(ImageSync(link=True).sync(self.fake_image, dst))
+            dst.unlink()
+
+        with self.subTest("Copy across filesystems"), \
+                patch('os.link', side_effect=OSError(errno.EXDEV, "cross-device link")):
+            link_file(self.fake_image, dst)
+            self.assertFalse(os.path.samefile(self.fake_image, dst))
+            self.assertEqual(dst.read_text(), "fake image data")
+
+    def test_heading_anchor(self):
+        test_cases = [
+            ("Definition", "definition"),
+            ("Formal Definition", "formal-definition"),
+            ("2. Tape & Head!", "2-tape--head"),
+            ("  Spaces  ", "spaces"),
+            ("Café Crème", "café-crème"),
+            ("snake_case-name", "snake_case-name"),
+        ]
+        for heading, expected in test_cases:
+            with self.subTest(heading=heading):
+                self.assertEqual(heading_anchor(heading), expected)
+
+    def test_link_resolver(self):
+        """Wiki-links to published notes become Liquid links, others keep their display text"""
+        self.file2.write_text("---\naliases: [Second File, The Other One]\n---\n# File 2")
+        draft = self.obsidian_subdir1 / "Draft.md"
+        draft.write_text("---\nlayout: post\n---\n# Missing date")
+        records = {note: NoteRecord.parse(note) for note in (self.file1, self.file2, draft)}
+        collection_of = {self.file1: self.jekyll_subdir1, self.file2: self.jekyll_subdir2, draft: self.jekyll_subdir1}
+        resolver = LinkResolver.from_records(records, collection_of)
+
+        test_cases = [
+            ("file2", "[file2]({% link _projects/file2.md %})"),
+            ("File2|reference", "[reference]({% link _projects/file2.md %})"),
+            ("file2 | reference", "[reference]({% link _projects/file2.md %})"),
+            ("Projects/file2.md#Some Chapter", "[Projects/file2.md > Some Chapter]({% link _projects/file2.md %}#some-chapter)"),
+            ("second file#Intro|see", "[see]({% link _projects/file2.md %}#intro)"),
+            ("file2#2. Formal Definition!|def", "[def]({% link _projects/file2.md %}#2-formal-definition)"),
+            ("#Local Heading", "[Local Heading](#local-heading)"),
+            ("Draft|not published", None),
+            ("Unknown note", None),
+        ]
+        for full_ref, expected in test_cases:
+            with self.subTest(full_ref=full_ref):
+                self.assertEqual(resolver.resolve(full_ref), expected)
+
+        with self.subTest("Conversion records the resolved links"):
+            context = ConversionContext(link_resolver=resolver)
+            content = transform_content("[[file2|ref]] and [[Draft|a draft]]", context=context)
+            self.assertEqual(content, "[ref]({% link _projects/file2.md %}) and a draft")
+            self.assertEqual(context.links, {"file2": "_projects/file2.md", "draft": None})
+
+        with self.subTest("Newly published link target invalidates the note"):
+            manifest = BuildManifest(self.obsidian_root / "manifest.json")
+            output = self.jekyll_subdir1 / "file1.md"
+            output.write_text("converted")
+            manifest.record(self.file1, output, set(), links=context.links)
+            self.assertTrue(manifest.is_up_to_date(self.file1, self.jekyll_subdir1, resolver))
+            resolver.add("Draft", "_posts/2024-12-20-draft.md")
+            self.assertFalse(manifest.is_up_to_date(self.file1, self.jekyll_subdir1, resolver))
+
+    def test_failed_link_target(self):
+        """Links never point to the output of a note that failed to convert"""
+        published = self.jekyll_subdir2 / "file2.md"
+        self.file2.write_text("# File 2\n![[missing.png]]\n")
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            publish()
+        self.assertIn("Converting 1 note(s) again without the links to _projects/file2.md", stdout.getvalue())
+        self.assertFalse(published.exists())
+        content = (self.jekyll_subdir1 / "file1.md").read_text()
+        self.assertNotIn("{% link", content)
+        self.assertIn("This file references reference, reference, reference", content)
+        runs = RunHistory(get_config().history_path).load()
+        self.assertEqual((runs[-1]["converted"], runs[-1]["failed"]), (1, 1))
+
+        with self.subTest("A note that fails later keeps its published version"):
+            self.file2.write_text("# File 2\n")
+            with patch('sys.stdout', new_callable=StringIO):
+                publish(incremental=True)
+            self.assertIn("{% link _projects/file2.md %}", (self.jekyll_subdir1 / "file1.md").read_text())
+            self.file2.write_text("# File 2 edited\n![[missing.png]]\n")
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                publish(incremental=True)
+            self.assertNotIn("again without the links", stdout.getvalue())
+            self.assertEqual(published.read_text(), "# File 2\n")
+            self.assertIn("{% link _projects/file2.md %}", (self.jekyll_subdir1 / "file1.md").read_text())
+            manifest = BuildManifest.load(get_config().manifest_path)
+            self.assertTrue(manifest.notes["Publish/Projects/file2.md"]["failed"])
+            self.assertFalse(manifest.is_up_to_date(self.file2, self.jekyll_subdir2))
+
+    def test_output_clash(self):
+        """Of two nested notes with the same slug, the later one fails instead of overwriting the other"""
+        nested = self.obsidian_subdir2 / "nested" / "file2.md"
+        nested.parent.mkdir()
+        nested.write_text("# Nested file 2\n")
+        published = self.jekyll_subdir2 / "file2.md"
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            publish()
+        self.assertIn("Publishes to _projects/file2.md like Publish/Projects/file2.md.", stdout.getvalue())
+        self.assertIn("This is file 2.", published.read_text())
+        manifest = BuildManifest.load(get_config().manifest_path)
+        self.assertIn("Publish/Projects/file2.md", manifest.notes)
+        self.assertNotIn("Publish/Projects/nested/file2.md", manifest.notes)
+        runs = RunHistory(get_config().history_path).load()
+        self.assertEqual((runs[-1]["converted"], runs[-1]["failed"]), (2, 1))
+
+        with self.subTest("The clash fails again in an incremental run"):
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                publish(incremental=True)
+            self.assertIn("Publish/Projects/nested/file2.md", stdout.getvalue())
+            self.assertIn("This is file 2.", published.read_text())
+            self.assertEqual(RunHistory(get_config().history_path).load()[-1]["failed"], 1)
+
+    def test_attachment_index(self):
+        """Embeds resolve by path or by bare name anywhere in the vault, preferring the attachment folder"""
+        nested = self.obsidian_subdir2 / "diagrams" / "Flow Chart.png"
+        nested.parent.mkdir(parents=True)
+        nested.write_bytes(b"flow")
+        duplicate = self.obsidian_subdir1 / "test-image.png"
+        duplicate.write_bytes(b"other")
+        hidden = self.obsidian_root / ".obsidian" / "icon.png"
+        hidden.parent.mkdir()
+        hidden.write_bytes(b"icon")
+        index = AttachmentIndex.build(self.obsidian_root, self.obsidian_img_dir)
+
+        test_cases = [
+            ("test-image.png", self.fake_image),
+            ("Test-Image.PNG", self.fake_image),
+            ("Flow Chart.png", nested),
+            ("Flow%20Chart.png", nested),
+            ("Publish/Projects/diagrams/Flow Chart.png", nested),
+            ("Publish/Posts/test-image.png", duplicate),
+            ("icon.png", None),
+            ("file1.md", None),
+        ]
+        for reference, expected in test_cases:
+            with self.subTest(reference=reference):
+                self.assertEqual(index.resolve(reference, self.obsidian_img_dir), expected)
+        self.assertEqual(list(index.collisions), ["test-image.png"])
+        self.assertCountEqual(index.collisions["test-image.png"], [self.fake_image, duplicate])
+
+        with self.subTest("Embed by name is copied from where it lives"):
+            context = ConversionContext(attachments=index)
+            content = transform_content("![[Flow Chart.png]]", self.obsidian_img_dir, self.jekyll_img_dir, context)
+            self.assertIn("Flow Chart.png", content)
+            self.assertEqual(context.images, {nested})
+            self.assertEqual((self.jekyll_img_dir / "Flow Chart.png").read_bytes(), b"flow")
+
+        with self.subTest("URL-encoded image is published under the decoded name"):
+            content = transform_content("![x](Flow%20Chart.png)", self.obsidian_img_dir, self.jekyll_img_dir,
+                                        ConversionContext(attachments=index))
+            self.assertEqual(content, "![x](Flow%20Chart.png)")
+            self.assertFalse((self.jekyll_img_dir / "Flow%20Chart.png").exists())
+            self.assertEqual((self.jekyll_img_dir / "Flow Chart.png").read_bytes(), b"flow")
+
+        with self.subTest("Unknown embed still fails"):
+            with self.assertRaises(PublishTransformError):
+                transform_content("![[missing.png]]", self.obsidian_img_dir, self.jekyll_img_dir,
+                                  ConversionContext(attachments=index))
+
+    @unittest.skipIf(pillow() is None, "Pillow is not installed")
+    def test_image_optimizer(self):
+        """Sized embeds are published as cached, downscaled variants"""
+        Image = pillow()
+        Image.new("RGB", (400, 200), "red").save(self.obsidian_img_dir / "big.png")
+        cache_dir = self.obsidian_root / ".publish_cache" / "images"
+        optimizer = ImageOptimizer(cache_dir)
+
+        context = ConversionContext(ImageSync(optimizer=optimizer))
+        content = transform_content("![[big.png|100]] ![[big.png|50x50]] ![full](big.png)",
+                                    self.obsidian_img_dir, self.jekyll_img_dir, context)
+        self.assertEqual(content, '![Image](/assets/img/big-100w.png){:width="100"} '
+                                  '![Image](/assets/img/big-50x50.png){:width="50" height="50"} ![full](big.png)')
+        for name, size in [("big-100w.png", (100, 50)), ("big-50x50.png", (50, 25)), ("big.png", (400, 200))]:
+            with self.subTest(name=name), Image.open(self.jekyll_img_dir / name) as image:
+                self.assertEqual(image.size, size)
+        self.assertEqual(len(list(cache_dir.glob("*.png"))), 3)
+
+        with self.subTest("Variants are rendered once"), patch.object(ImageOptimizer, 'render') as mock_render, \
+                patch('obsidian_to_jekyll.file_digest') as mock_digest:
+            (self.jekyll_img_dir / "big-100w.png").unlink()
+            ensure_image_available(self.obsidian_img_dir / "big.png", self.jekyll_img_dir / "big-100w.png",
+                                   ConversionContext(ImageSync(optimizer=optimizer)), ("100", None))
+            mock_render.assert_not_called()
+            mock_digest.assert_not_called()  # The warm cache is found by [size, mtime_ns]
+            self.assertTrue((self.jekyll_img_dir / "big-100w.png").exists())
+
+        with self.subTest("A corrupt image fails only its note"):
+            (self.obsidian_img_dir / "broken.png").write_bytes(b"\x89PNG\r\n\x1a\ntruncated")
+            with self.assertRaises(PublishTransformError) as raised:
+                transform_content("![[broken.png|100]]", self.obsidian_img_dir, self.jekyll_img_dir,
+                                  ConversionContext(ImageSync(optimizer=optimizer)))
+            self.assertIn("Cannot optimize image", raised.exception.reason)
+            with CopyScheduler() as scheduler:
+                context = ConversionContext(ImageSync(optimizer=optimizer, scheduler=scheduler))
+                transform_content("![[broken.png|100]]", self.obsidian_img_dir, self.jekyll_img_dir, context)
+                scheduler.wait()
+            output = self.jekyll_subdir1 / "file1.md"
+            output.write_text("converted")
+            result = settle_images(NoteResult(self.file1, self.jekyll_subdir1, output, context))
+            self.assertIn("Cannot optimize image", result.error.reason)
+            self.assertFalse(output.exists())
+
+        with self.subTest("WebP variants"):
+            context = ConversionContext(ImageSync(optimizer=ImageOptimizer(cache_dir, webp=True)))
+            content = transform_content("![[big.png|100]]", self.obsidian_img_dir, self.jekyll_img_dir, context)
+            self.assertEqual(content, '![Image](/assets/img/big-100w.webp){:width="100"}')
+            with Image.open(self.jekyll_img_dir / "big-100w.webp") as image:
+                self.assertEqual((image.format, image.size), ("WEBP", (100, 50)))
+
+        with self.subTest("Other options invalidate the manifest"):
+            manifest_path = self.obsidian_root / "manifest.json"
+            BuildManifest(manifest_path, {"Posts/file1.md": {}}, optimizer.settings()).save()
+            self.assertEqual(BuildManifest.load(manifest_path, optimizer.settings()).notes, {"Posts/file1.md": {}})
+            self.assertEqual(BuildManifest.load(manifest_path).notes, {})
+
+    def test_scan_references(self):
+        """References are found in one pass, code blocks and inline code are left alone"""
+        content = (
+            "[[Note A|alias]] and `[[not a link]]` and ``a ` [[inside]]``\n"
+            "```python\n"
+            "text = \"![[not-an-image.png]]\"\n"
+            "```\n"
+            "  ~~~\n"
+            "[md](inside.md)\n"
+            "  ~~~\n"
+            "![alt](image.png) [[Note B#Heading]] `unclosed [[Note C]]\n"
+        )
+        self.assertEqual(extract_references(content), [
+            ("wikilink", "Note A"), ("image", "image.png"), ("wikilink", "Note B"), ("wikilink", "Note C")])
+        self.assertEqual([kind for kind, _ in scan_references(content)], ["wiki", "md", "wiki", "wiki"])
+
+        with self.subTest("Code is copied verbatim"):
+            code = "`[[x]]`\n```\n![[x.png]]\n```\n"
+            self.assertEqual(transform_content(code + "[[x|shown]]"), code + "shown")
+
+        with self.subTest("Unclosed fence runs to the end of the note"):
+            self.assertEqual(extract_references("```\n[[x]]\n"), [])
+
+        with self.subTest("Same result as the two substitutions outside of code"):
+            text = "See [[Note A|a]], ![[test-image.png|200]] and [doc](README.md) or [[b]](c)."
+            expected = MD_LINK_PATTERN.sub(
+                partial(transform_md_match, src_dir=self.obsidian_img_dir, dest_dir=self.jekyll_img_dir), text)
+            expected = OBSIDIAN_LINK_PATTERN.sub(
+                partial(transform_obsidian_match, src_dir=self.obsidian_img_dir, dest_dir=self.jekyll_img_dir), expected)
+            self.assertEqual(transform_content(text, self.obsidian_img_dir, self.jekyll_img_dir), expected)
+
+    def test_transform_stream(self):
+        """Chunked transformation gives the same result as transforming the whole note"""
+        notes = [
+            "[[a|b]] `x` ``y ` z``\n```py\n[[in fence]]\n```\nafter [[c]]\n",
+            "`  ![a](b.png) ``````` ![a](b.png)\nx` [[d]]\n\n[e](f)",   # Inline code closes on the next line
+            "`unclosed [[e]]\n\n[[f]] and ![[g\n\n]] and [[h]",        # A link across a blank line
+            "  ~~~~\n~~~\n[[in fence]]\n ~~~~~ \n[[i]]\n```\nunclosed [[j]]",
+            "``a ```b [[k]]\n\n``c ``` ````d [[l]]",                   # Closed by the tail of the last longer run
+            "`` ``[[note]]```````````````~~~```````\n```\n```````py\n]]",  # Never closes, was exponential
+            "",
+        ]
+        def show(match, *args):
+            return f"<{match.group(0)}>"
+        with patch('obsidian_to_jekyll.transform_obsidian_match', show), patch('obsidian_to_jekyll.transform_md_match', show):
+            for note in notes:
+                expected = transform_content(note)
+                with self.subTest(note=note):
+                    self.assertEqual("".join(transform_stream(list(note))), expected)
+                    for cut in range(len(note) + 1):
+                        self.assertEqual("".join(transform_stream([note[:cut], note[cut:]])), expected, cut)
+                    self.assertEqual(extract_references([note]), extract_references(note))
+
+        with self.subTest("Text chunks of a file"):
+            source = self.obsidian_root / "crlf.md"
+            source.write_bytes("a\r\nb\rč\r\n".encode())
+            digest = hashlib.sha256()
+            with open(source, 'rb') as file:
+                self.assertEqual("".join(read_text_chunks(file, digest, size=2)), "a\nb\nč\n")
+            self.assertEqual(digest.hexdigest(), file_digest(source))
+            source.write_bytes(b"ok\n\xff")
+            with open(source, 'rb') as file, self.assertRaises(UnicodeDecodeError):
+                list(read_text_chunks(file, size=2))
+
+        with self.subTest("Large notes are converted in chunks"):
+            self.file1.write_text(self.file1.read_text() + "```\n[[file2]]\n```\n" * 100)
+            context = ConversionContext()
+            expected = transfer_publish_file(self.file1, self.jekyll_subdir1, context).read_text()
+            with patch('obsidian_to_jekyll.STREAM_THRESHOLD', 0), patch('obsidian_to_jekyll.STREAM_CHUNK_SIZE', 7), \
+                    patch('obsidian_to_jekyll.transform_content', side_effect=AssertionError("not streamed")):
+                large_context = ConversionContext()
+                dst = transfer_publish_file(self.file1, self.jekyll_subdir1, large_context)
+                self.assertEqual(dst.read_text(), expected)
+                self.assertEqual((large_context.source_digest, large_context.source_stat),
+                                 (context.source_digest, context.source_stat))
+                self.assertEqual(large_context.images, context.images)
+                self.assertEqual(NoteRecord.parse(self.file1).refs, extract_references(self.file1.read_text()))
+
+                self.file2.write_bytes(b"# File 2\n\xff\n")
+                with self.assertRaises(PublishTransformError) as error:
+                    transfer_publish_file(self.file2, self.jekyll_subdir2)
+                self.assertEqual(error.exception.reason, "Note is not valid UTF-8.")
+                self.assertEqual(os.listdir(self.jekyll_subdir2), [])
+
+    def test_staged_changes(self):
+        """One git diff lists added, modified, deleted and renamed paths"""
+        def git(*args):
+            subprocess.run(["git", "-C", str(self.obsidian_root), "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+                           check=True, capture_output=True)
+        git("init", "-q")
+        git("add", "-A")
+        git("commit", "-q", "-m", "initial")
+
+        renamed = self.obsidian_subdir1 / "file1 renamed.md"
+        git("mv", str(self.file1), str(renamed))
+        self.file2.write_text("# File 2 edited")
+        git("rm", "-q", str(self.fake_image))
+        added = self.obsidian_subdir2 / "new.md"
+        added.write_text("# New")
+        git("add", str(self.file2), str(added))
+
+        self.assertEqual(staged_changes(self.obsidian_root), {self.file1, renamed, self.file2, self.fake_image, added})
+
+    def test_restricted_run(self):
+        """Outside of the changed paths, only notes embedding a changed image or linking to a changed note are affected"""
+        manifest = BuildManifest(self.obsidian_root / "manifest.json")
+        output = self.jekyll_subdir1 / "file1.md"
+        output.write_text("converted")
+        manifest.record(self.file1, output, {self.fake_image}, links={"file2": "_projects/file2.md"})
+        resolver = LinkResolver()
+        resolver.add("file2", "_projects/file2.md")
+
+        self.assertTrue(manifest.is_unaffected(self.file1, self.jekyll_subdir1, set(), resolver))
+        with self.subTest("Output removed from the site"):
+            output.unlink()
+            self.assertFalse(manifest.is_unaffected(self.file1, self.jekyll_subdir1, set(), resolver))
+            output.write_text("converted")
+        with self.subTest("Embedded image changed"):
+            self.assertFalse(manifest.is_unaffected(self.file1, self.jekyll_subdir1, {vault_key(self.fake_image)}, resolver))
+        with self.subTest("Linked note got another slug"):
+            resolver.add("file2", "_projects/2024-12-20-file2.md", overwrite=True)
+            self.assertFalse(manifest.is_unaffected(self.file1, self.jekyll_subdir1, set(), resolver))
+        with self.subTest("Unknown note"):
+            self.assertFalse(manifest.is_unaffected(self.file2, self.jekyll_subdir2, set(), resolver))
+
+        with self.subTest("A restricted run neither walks the publish directory nor scans the vault"):
+            with patch('sys.stdout', new_callable=StringIO):
+                publish()
+            hand_placed = self.jekyll_subdir2 / "hand-placed.md"
+            hand_placed.write_text("not converted")
+            added = self.obsidian_subdir2 / "nested" / "file3.md"
+            added.parent.mkdir()
+            added.write_text("# File 3\n![[test-image.png]]\n")
+            with patch('obsidian_to_jekyll.walk_publish_tree') as walk, \
+                    patch.object(AttachmentIndex, '_scan') as scan, patch('sys.stdout', new_callable=StringIO):
+                publish(changed={added})
+            walk.assert_not_called()
+            scan.assert_not_called()
+            self.assertIn("test-image.png", (self.jekyll_subdir2 / "file3.md").read_text())
+            self.assertTrue(hand_placed.exists())
+            added.unlink()
+            with patch('obsidian_to_jekyll.walk_publish_tree') as walk, patch('sys.stdout', new_callable=StringIO):
+                publish(changed={added})
+            walk.assert_not_called()
+            self.assertFalse((self.jekyll_subdir2 / "file3.md").exists())
+            self.assertTrue(hand_placed.exists())
+            self.assertNotIn("Publish/Projects/nested/file3.md", BuildManifest.load(get_config().manifest_path).notes)
+
+        with self.subTest("The converter is hashed once per process"), \
+                patch('obsidian_to_jekyll.file_digest') as digest:
+            BuildManifest.converter_fingerprint()
+            digest.assert_not_called()
+
+    def test_config(self):
+        """Paths come from a config file, the environment and flags, and are checked only on validate()"""
+        config_file = self.obsidian_root / "config.json"
+        config_file.write_text(json.dumps({"jekyll_root": "schrodlm.github.io", "publish_dir": "Publish"}))
+        environ = {"OBSIDIAN_TO_JEKYLL_CONFIG": str(config_file),
+                   "OBSIDIAN_TO_JEKYLL_OBSIDIAN_ROOT": str(self.obsidian_root),
+                   "OBSIDIAN_TO_JEKYLL_PUBLISH_DIR": str(self.obsidian_root / "Elsewhere")}
+
+        with self.subTest("Later sources win, file paths are relative to the file"):
+            config = Config.from_sources(environ=environ, obsidian_image_dir=self.obsidian_img_dir)
+            self.assertEqual(config.jekyll_root, self.jekyll_root)
+            self.assertEqual(config.publish_dir, self.obsidian_root / "Elsewhere")
+            self.assertEqual(config.obsidian_image_dir, self.obsidian_img_dir)
+            self.assertEqual(config.jekyll_image_dir, self.jekyll_img_dir)
+            self.assertEqual(config.manifest_path, self.obsidian_root / ".publish_cache" / "manifest.json")
+        with self.subTest("Missing directories are reported by validate()"):
+            with self.assertRaises(ConfigError) as raised:
+                config.validate()
+            self.assertIn("publish_dir", str(raised.exception))
+            environ.pop("OBSIDIAN_TO_JEKYLL_PUBLISH_DIR")
+            Config.from_sources(environ=environ, obsidian_image_dir=self.obsidian_img_dir).validate()
+        with self.subTest("Unknown keys are rejected"):
+            config_file.write_text(json.dumps({"jekyll_rot": "site"}))
+            with self.assertRaises(ConfigError):
+                Config.from_sources(config_file, environ={})
+        with self.subTest("Importing needs no site"):
+            script = "import obsidian_to_jekyll as otj; print(otj.get_config().jekyll_root)"
+            result = subprocess.run([sys.executable, "-c", script], cwd=Path(__file__).parent, capture_output=True,
+                                    text=True, env={**os.environ, "OBSIDIAN_TO_JEKYLL_JEKYLL_ROOT": "/nonexistent"})
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(result.stdout.strip(), "/nonexistent")
+
+    def test_parse_front_matter(self):
+        """Lists, quotes and nested YAML are understood, and only the front matter is read"""
+        cases = [
+            ('layout: post\ntitle: "Turing: machines"\ndate: 2024-12-20',
+             {"layout": "post", "title": "Turing: machines", "date": "2024-12-20"}),
+            ("tags: [a, b]\naliases:\n  - One\n  - 'Two'", {"tags": ["a", "b"], "aliases": ["One", "Two"]}),
+            ("summary: |\n  First line\n  second line\nmeta:\n  draft: true # not yet",
+             {"summary": "First line\nsecond line\n", "meta": {"draft": "true"}}),
+            ("title: 'It''s' # comment", {"title": "It's"}),
+            ("# only a comment", {}),
+        ]
+        for block, expected in cases:
+            with self.subTest(block=block):
+                self.assertEqual(parse_front_matter(f"---\n{block}\n---\n# Body"), expected)
+                self.assertEqual(parse_front_matter(iter(f"---\n{block}\n---\n".splitlines(keepends=True))), expected)
+
+        with self.subTest("Fast path agrees with the YAML parser"):
+            lines = ["layout: post", "title: \"Quoted\"", "empty:", "tags:", "- a", "- 'b c'", "list: [x, y, ]"]
+            self.assertEqual(parse_simple_front_matter(lines),
+                             {"layout": "post", "title": "Quoted", "empty": "", "tags": ["a", "b c"], "list": ["x", "y"]})
+            for needs_yaml in (["k: v # comment"], ["k: |", "  text"], ["k:", "  nested: v"], ['k: "esc\\"aped"']):
+                self.assertIsNone(parse_simple_front_matter(needs_yaml))
+
+        with self.subTest("Front matter starts on the first line"):
+            self.assertEqual(parse_front_matter("# Title\n---\nlayout: post\n---\n"), {})
+
+        with self.subTest("Reading stops at the closing delimiter"):
+            lines = iter(["---\n", "layout: post\n", "---\n", "body\n"])
+            self.assertEqual(parse_front_matter(lines), {"layout": "post"})
+            self.assertEqual(list(lines), ["body\n"])
+
+        with self.subTest("Invalid YAML is read line by line"):
+            self.assertEqual(parse_front_matter("---\ntitle: [unclosed\nauthor: Smith\n---\n"),
+                             {"title": "[unclosed", "author": "Smith"})
+
+        with self.subTest("Cached per file until it changes"):
+            note = self.obsidian_publish_dir / "cached.md"
+            note.write_text("---\nlayout: post\n---\n")
+            self.assertEqual(read_md_metadata(note), {"layout": "post"})
+            read_md_metadata(note)["layout"] = "changed"
+            with patch('obsidian_to_jekyll.parse_front_matter') as mock_parse:
+                self.assertEqual(read_md_metadata(note), {"layout": "post"})
+                mock_parse.assert_not_called()
+            note.write_text("---\nlayout: project\n---\n")
+            os.utime(note, ns=(0, 0))
+            self.assertEqual(read_md_metadata(note), {"layout": "project"})
+
+    def test_domain_model(self):
+        """Notes, links and embeds are small slotted objects the pipeline passes around"""
+        with self.subTest("Validated paths are plain paths"):
+            path = obsidian_path(self.file1)
+            self.assertIs(type(path), type(self.file1))
+
+        with self.subTest("WikiLink"):
+            link = WikiLink.parse(" Turing Machine #Tape | the tape ")
+            self.assertEqual((link.target, link.heading, link.alias, link.display),
+                             ("Turing Machine", "Tape", "the tape", "the tape"))
+            self.assertEqual(WikiLink.parse("note|200").display, "")
+
+        with self.subTest("ImageRef"):
+            ref = ImageRef.parse("sub/img.png|Alt|200x100")
+            self.assertEqual((ref.path, ref.alt, ref.width, ref.height), (Path("sub/img.png"), "Alt", "200", "100"))
+
+        with self.subTest("Note and its output target"):
+            record = NoteRecord.parse(self.file1)
+            note = Note(self.file1, stat_signature(self.file1), self.jekyll_subdir1, record)
+            self.assertEqual(note.target.path, self.jekyll_subdir1 / "file1.md")
+            self.assertEqual(note.target.jekyll_file, "_posts/file1.md")
+            self.assertIsNone(Note(self.file1).target)
+            self.assertFalse(hasattr(note, "__dict__"))
+            copy = pickle.loads(pickle.dumps(note))
+            self.assertEqual((copy.path, copy.signature, copy.record.slug), (note.path, note.signature, "file1.md"))
+            self.assertEqual(LinkResolver.from_notes([note]).lookup("FILE1"), "_posts/file1.md")
+
+    def test_check(self):
+        """--check reports what would break the site without writing anything"""
+        (self.obsidian_root / "Draft.md").write_text("Not published")
+        (self.obsidian_subdir2 / "broken.md").write_text(
+            "![[missing.png]] ![x](gone.png) ![x](https://example.com/a.png) ![[test-image.png]]\n"
+            "[[Nowhere]] [[Nowhere]] [[Draft]] [[file2]]\n")
+        (self.obsidian_subdir1 / "untitled.md").write_text("---\nlayout: post\n---\n")
+        before = sorted(self.jekyll_root.rglob("*"))
+
+        with patch('sys.stdout', new_callable=StringIO):
+            problems = check()
+        self.assertEqual(sorted(self.jekyll_root.rglob("*")), before)
+
+        found = {(problem.source.name, problem.message, problem.error) for problem in problems}
+        self.assertLessEqual({("broken.md", "missing image 'missing.png'", True),
+                              ("broken.md", "missing image 'gone.png'", True),
+                              ("broken.md", "[[Nowhere]] links to no note, it becomes plain text", False),
+                              ("broken.md", "[[Draft]] is not published, it becomes plain text", False)}, found)
+        self.assertEqual(len([problem for problem in problems if "Nowhere" in problem.message]), 1)
+        self.assertFalse(any("example.com" in message or "test-image" in message or "file2" in message
+                             for _, message, _ in found))
+        self.assertTrue(any(source == "untitled.md" and error for source, _, error in found))
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            self.assertTrue(print_check_report(problems))
+        self.assertIn("warning: [[Draft]] is not published", stdout.getvalue())
+
+        with self.subTest("Slug collisions"):
+            (self.obsidian_subdir2 / "Sub").mkdir()
+            (self.obsidian_subdir2 / "Sub" / "broken.md").write_text("Same output file")
+            with patch('sys.stdout', new_callable=StringIO):
+                problems = check()
+            clashes = [problem for problem in problems if "Publishes to _projects/broken.md" in problem.message]
+            self.assertEqual([(problem.source, problem.error) for problem in clashes],
+                             [(self.obsidian_subdir2 / "Sub" / "broken.md", True)])
+
+        with self.subTest("Only the notes affected by the changed paths are reported"):
+            with patch('sys.stdout', new_callable=StringIO):
+                problems = check(changed={self.obsidian_img_dir / "missing.png"})
+            self.assertEqual({problem.source.name for problem in problems}, {"broken.md"})
+            self.assertIn("missing image 'missing.png'", [problem.message for problem in problems])
+            with patch('sys.stdout', new_callable=StringIO):
+                problems = check(changed={self.file1})
+            self.assertEqual(problems, [])
+
+        with self.subTest("With a vault index the unaffected notes are not parsed"):
+            with patch('sys.stdout', new_callable=StringIO):
+                publish()
+            with patch('sys.stdout', new_callable=StringIO), \
+                    patch('obsidian_to_jekyll.walk_publish_tree') as walk, \
+                    patch.object(NoteRecord, 'parse', wraps=NoteRecord.parse) as parse:
+                problems = check(changed={self.file1, self.obsidian_img_dir / "missing.png"})
+            walk.assert_not_called()
+            parsed = {call.args[0] for call in parse.call_args_list}
+            self.assertIn(self.file1, parsed)
+            self.assertNotIn(self.file2, parsed)  # Converted, its references are indexed
+            self.assertEqual({problem.source.name for problem in problems}, {"broken.md"})
+            self.assertLessEqual({"missing image 'missing.png'", "[[Draft]] is not published, it becomes plain text",
+                                  "[[Nowhere]] links to no note, it becomes plain text"},
+                                 {problem.message for problem in problems})
+
+        with self.subTest("The Jekyll site is optional"):
+            shutil.rmtree(self.jekyll_root)
+            with patch('sys.stdout', new_callable=StringIO):
+                self.assertTrue(check())
+            with patch('sys.stdout', new_callable=StringIO) as stdout, self.assertRaises(SystemExit) as exit:
+                run(parse_args(["--check"]))
+            self.assertEqual(exit.exception.code, 1)
+            self.assertIn("error(s)", stdout.getvalue())
+
+    def test_run_history(self):
+        """Every publish run is recorded, stats flags the runs that got slower"""
+        history = RunHistory(get_config().history_path)
+        with patch('sys.stdout', new_callable=StringIO):
+            publish()
+            publish(incremental=True)
+        full, incremental = history.load()
+        self.assertEqual((full["mode"], incremental["mode"]), ("full", "incremental"))
+        self.assertEqual(full["converted"] + full["failed"], full["notes"])
+        self.assertEqual(incremental["skipped"], incremental["notes"])
+        self.assertGreater(full["bytes_written"], 0)
+        self.assertLessEqual({"discovery", "vault_index", "convert", "apply_staged", "manifest"}, set(full["stages"]))
+        self.assertLessEqual(sum(full["stages"].values()), full["duration_ms"])
+
+        with self.subTest("Corrupt lines are skipped"):
+            with open(history.path, 'a', encoding='utf-8') as file:
+                file.write('{"mode": "full", "dur\n')
+            self.assertEqual(len(history.load()), 2)
+
+        with self.subTest("Regressions against the rolling baseline of the same kind"):
+            runs = [{"mode": "full", "duration_ms": 1000.0, "stages": {"convert": 800.0, "manifest": 10.0}}] * 4
+            runs += [{"mode": "incremental", "duration_ms": 20.0}] * 4
+            runs += [{"mode": "full", "duration_ms": 2400.0, "stages": {"convert": 2100.0, "manifest": 20.0}},
+                     {"mode": "full", "jobs": 4, "duration_ms": 3000.0},
+                     {"mode": "incremental", "duration_ms": 60.0}]  # 3x, but within the noise
+            self.assertEqual(find_regressions(runs), {8: (1000.0, "convert")})
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                print_stats(runs, last=5)
+            self.assertIn("2.4x slower than the baseline of 1.00 s, mostly in convert", stdout.getvalue())
+            self.assertIn("full -j4", stdout.getvalue())
+
+        with self.subTest("stats command"):
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                run(parse_args(["stats"]))
+            self.assertIn("2 runs since", stdout.getvalue())
+
+    def test_search_index(self):
+        """The published notes are indexed into shards, an incremental run rewrites only what changed"""
+        self.assertEqual([stem_term(word) for word in ["machines", "copied", "running", "falling", "class", "this", "héros", "go"]],
+                         ["machine", "copy", "run", "fall", "class", "this", "héros", "go"])
+        self.assertEqual(search_terms("Café {% link _posts/a.md %} [Links](https://example.com){:width=\"2\"} <b>x</b>"),
+                         ["cafe", "link", "x"])
+        self.assertEqual(jekyll_title("2024-12-20-turing-machine"), "Turing Machine")
+
+        search_dir = get_config().jekyll_search_dir
+        def load(name):
+            return json.loads((search_dir / name).read_text(encoding='utf-8'))
+        def positions(term):
+            postings = load(f"{term[0]}.json").get(term, [])
+            return {load("index.json")["docs"][doc]["path"]: list(itertools.accumulate(deltas)) for doc, *deltas in postings}
+
+        with patch('sys.stdout', new_callable=StringIO):
+            publish()
+        index = load("index.json")
+        self.assertEqual(sorted(doc["path"] for doc in index["docs"]), ["_posts/file1.md", "_projects/file2.md"])
+        self.assertEqual({doc["title"] for doc in index["docs"]}, {"File1", "File2"})
+        self.assertEqual(positions("file"), {"_posts/file1.md": [1, 4], "_projects/file2.md": [1, 5]})
+        self.assertEqual(positions("reference")["_posts/file1.md"][:2], [5, 6])  # "references" and a link text
+        self.assertEqual(positions("referenc"), {})
+        self.assertEqual(sorted(path.stem for path in search_dir.iterdir()), sorted(index["shards"] + ["index"]))
+
+        stats = {path.name: path.stat().st_mtime_ns for path in search_dir.iterdir()}
+        self.file2.write_text("# File 2\nZebras are running.\n")
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            publish(incremental=True)
+        self.assertIn("Search index: 1/2 notes re-indexed", stdout.getvalue())
+        self.assertEqual(positions("zebra"), {"_projects/file2.md": [3]})
+        self.assertEqual(positions("run"), {"_projects/file2.md": [5]})
+        self.assertEqual(search_dir.joinpath("c.json").stat().st_mtime_ns, stats["c.json"])  # Only file1 has "chapter"
+
+        with self.subTest("A removed note frees its number"):
+            file1_number = next(number for number, doc in enumerate(load("index.json")["docs"]) if doc["slug"] == "file1")
+            hand_placed = search_dir / "synonyms.json"
+            hand_placed.write_text("{}")
+            self.file1.unlink()
+            with patch('sys.stdout', new_callable=StringIO):
+                publish(incremental=True)
+            self.assertIsNone(load("index.json")["docs"][file1_number])
+            self.assertFalse((search_dir / "c.json").exists())
+            self.assertTrue(hand_placed.exists())  # Only shards of the previous index.json are removed
+            self.assertEqual(positions("zebra"), {"_projects/file2.md": [3]})
+
     # def test_transform_md_match(self):
     #     image_test = ['!', 'alt text', 'subdir/image.png', '![alt text | JEKYLL_IMG_DIR/image.png]']
     #     external_link_test = ['', '']